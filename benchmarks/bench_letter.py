@@ -0,0 +1,264 @@
+"""
+measure the phases of building a letter on synthetic letters of growing size:
+wall time, peak RSS and python allocations of each phase, written as JSON
+
+every scenario runs in a fresh process, allocations are measured in a second
+run so tracemalloc does not slow down the timed one
+
+usage:
+    python benchmarks/bench_letter.py [--recipients 100 1000 ...]
+        [--attachment-mb 0 5 ...] [--render-processes 4]
+        [--output results.json] [--compare old.json]
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ntuee_mailer.synthetic import generate_letter
+
+SENDER = "臺大電機系學會"
+FROM_ADDR = "b09901000@ntu.edu.tw"
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_phases(letter_path: Path, max_render: int, render_processes: int = 1):
+    """(phase, function) pairs, each phase uses the results of the ones before"""
+    from ntuee_mailer.Letter import Letter
+    from ntuee_mailer.LetterTemplate import LetterTemplate
+    from ntuee_mailer.Recipients import load_recipients
+
+    state = {}
+
+    def recipients():
+        return len(load_recipients(letter_path / "recipients.csv", offline=True))
+
+    def template():
+        return len(
+            LetterTemplate.load(letter_path / "content.html", cache_dir=None).fields
+        )
+
+    def check():
+        state["checked"] = Letter.check_letter(letter_path, offline=True)
+        assert state["checked"], f"{letter_path} is not a valid letter"
+        return len(state["checked"].recipients)
+
+    def letter():
+        state["letter"] = Letter(letter_path, SENDER, checked=state["checked"])
+        state["letter"].set_from_addr(FROM_ADDR)
+        state["letter"].set_render_processes(render_processes)
+        return len(state["letter"])
+
+    def render():
+        size = 0
+        for i, email in enumerate(state["letter"]):
+            size += len(email)
+            if i + 1 >= max_render:
+                break
+        return size
+
+    return [
+        ("recipients", recipients),
+        ("template", template),
+        ("check", check),
+        ("letter", letter),
+        ("render", render),
+    ]
+
+
+def run_scenario(scenario: dict) -> list:
+    """run every phase of a scenario, in its own process"""
+    with tempfile.TemporaryDirectory() as tmp:
+        letter_path = generate_letter(
+            Path(tmp) / "letter",
+            scenario["recipients"],
+            scenario["attachment_mb"],
+            attachments=scenario["attachments"],
+        )
+        rendered = min(scenario["recipients"], scenario["max_render"])
+
+        results = []
+        for phase, run in run_phases(
+            letter_path, scenario["max_render"], scenario["render_processes"]
+        ):
+            start = time.perf_counter()
+            output = run()
+            wall = time.perf_counter() - start
+            result = {
+                "recipients": scenario["recipients"],
+                "attachment_mb": scenario["attachment_mb"],
+                "phase": phase,
+                "wall_s": round(wall, 6),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            if phase == "render":
+                result["emails"] = rendered
+                result["bytes"] = output
+                result["ms_per_email"] = round(wall / max(rendered, 1) * 1000, 4)
+                result["render_processes"] = scenario["render_processes"]
+            results.append(result)
+
+        if scenario["allocations"]:
+            for result, (phase, run) in zip(
+                results,
+                run_phases(
+                    letter_path, scenario["max_render"], scenario["render_processes"]
+                ),
+            ):
+                tracemalloc.start()
+                run()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                result["alloc_peak_mb"] = round(peak / 2**20, 3)
+                result["alloc_retained_mb"] = round(current / 2**20, 3)
+
+    return results
+
+
+def put_results(scenario: dict, results) -> None:
+    try:
+        results.put((True, run_scenario(scenario)))
+    except BaseException:
+        results.put((False, traceback.format_exc()))
+
+
+def run_isolated(context, scenario: dict) -> list:
+    """
+    run a scenario in a fresh process, so peak RSS is not inherited,
+    not a pool worker, those cannot start the render processes
+    """
+    results = context.SimpleQueue()
+    process = context.Process(target=put_results, args=(scenario, results))
+    process.start()
+    ok, output = results.get()
+    process.join()
+    if not ok:
+        raise RuntimeError(f"scenario {scenario} failed:\n{output}")
+    return output
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old: dict, new: dict):
+    """print the relative change of every phase against an older run"""
+    key = lambda r: (r["recipients"], r["attachment_mb"], r["phase"])
+    old_results = {key(r): r for r in old["results"]}
+    print(f"\ncompared with {old.get('commit')}:")
+    for result in new["results"]:
+        before = old_results.get(key(result))
+        if before is None or before["wall_s"] == 0:
+            continue
+        change = (result["wall_s"] / before["wall_s"] - 1) * 100
+        print(
+            f"{result['recipients']:>7} recipients {result['attachment_mb']:>5} MB "
+            f"{result['phase']:>10}: {change:+7.1f}% wall"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--recipients", type=int, nargs="+", default=[100, 1000, 10000, 100000]
+    )
+    parser.add_argument("--attachment-mb", type=float, nargs="+", default=[0, 5, 20])
+    parser.add_argument("--attachments", type=int, default=2)
+    parser.add_argument(
+        "--max-render",
+        type=int,
+        default=1000,
+        help="emails rendered per scenario, rendering every email of large "
+        "letters with big attachments takes very long",
+    )
+    parser.add_argument(
+        "--render-processes",
+        type=int,
+        default=1,
+        help="render in this many worker processes, the pool is started in "
+        "the render phase, so its start-up time is included",
+    )
+    parser.add_argument("--no-allocations", action="store_true")
+    parser.add_argument("--output", "-o", type=Path, help="write results as JSON")
+    parser.add_argument("--compare", type=Path, help="JSON results of an older run")
+    args = parser.parse_args()
+
+    scenarios = [
+        {
+            "recipients": recipients,
+            "attachment_mb": attachment_mb,
+            "attachments": args.attachments,
+            "max_render": args.max_render,
+            "render_processes": args.render_processes,
+            "allocations": not args.no_allocations,
+        }
+        for recipients in args.recipients
+        for attachment_mb in args.attachment_mb
+    ]
+
+    results = []
+    # a fresh process per scenario, so peak RSS is not inherited
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        scenario_results = run_isolated(context, scenario)
+        for r in scenario_results:
+            print(
+                f"{r['recipients']:>7} recipients {r['attachment_mb']:>5} MB "
+                f"{r['phase']:>10}: {r['wall_s']:9.4f}s "
+                f"rss {r['peak_rss_mb'] or 0:8.1f} MB "
+                f"alloc {r.get('alloc_peak_mb', 0):8.1f} MB"
+            )
+        results.extend(scenario_results)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"\nresults written to {args.output}")
+
+    if args.compare is not None:
+        compare(json.loads(args.compare.read_text(encoding="utf-8")), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+compare the MIMEMultipart / as_string() serialization path with the compiled
+message skeleton
+
+usage: python benchmarks/bench_skeleton.py [--recipients N] [--attachment-mb MB]
+"""
+import argparse
+import os
+import secrets
+import sys
+import tempfile
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate
+from pathlib import Path
+from string import Template
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ntuee_mailer.Attachment import EncodedAttachment
+from ntuee_mailer.MessageSkeleton import MessageSkeleton
+
+SUBJECT = "電機系學術部 測試信件"
+FROM_NAME = "臺大電機系學會學術部"
+FROM_ADDR = "b09901000@ntu.edu.tw"
+TEMPLATE = Template(
+    "<html><body><h3>$name您好：</h3>" + "lorem ipsum " * 200 + "$sender 敬上</body></html>"
+)
+
+
+def mime_path(recipients, attachment_path):
+    """the serialization path used before the message skeleton"""
+    with open(attachment_path, "rb") as f:
+        attachment = MIMEApplication(f.read(), Name=attachment_path.name)
+    attachment["Content-Disposition"] = f"attachment; filename={attachment_path.name}"
+
+    size = 0
+    for name, addr in recipients:
+        email = MIMEMultipart()
+        email["Date"] = formatdate(localtime=True)
+        email["Subject"] = SUBJECT
+        email["To"] = addr
+        email.attach(MIMEText(TEMPLATE.substitute(name=name, sender="me"), "html"))
+        email.attach(attachment)
+        email["From"] = formataddr((FROM_NAME, FROM_ADDR))
+        size += len(email.as_string().encode("ascii"))
+    return size
+
+
+def skeleton_path(recipients, attachment_path):
+    skeleton = MessageSkeleton(
+        SUBJECT,
+        f"{'=' * 15}{secrets.token_hex(16)}==",
+        [EncodedAttachment(attachment_path)],
+        from_name=FROM_NAME,
+        from_addr=FROM_ADDR,
+    )
+
+    size = 0
+    for name, addr in recipients:
+        size += len(
+            skeleton.render([addr], [], TEMPLATE.substitute(name=name, sender="me"))
+        )
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recipients", type=int, default=200)
+    parser.add_argument("--attachment-mb", type=float, default=5)
+    args = parser.parse_args()
+
+    recipients = [("王小明", f"b09901{i:03d}@ntu.edu.tw") for i in range(args.recipients)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        attachment_path = Path(tmp) / "attachment.pdf"
+        attachment_path.write_bytes(os.urandom(int(args.attachment_mb * 1024 * 1024)))
+
+        results = {}
+        for name, bench in (("as_string", mime_path), ("skeleton", skeleton_path)):
+            start = time.perf_counter()
+            size = bench(recipients, attachment_path)
+            results[name] = time.perf_counter() - start
+            print(
+                f"{name:>10}: {results[name]:8.3f}s "
+                f"({results[name] / args.recipients * 1000:.2f} ms/email, {size / 2**20:.0f} MiB)"
+            )
+
+    print(f"   speedup: {results['as_string'] / results['skeleton']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
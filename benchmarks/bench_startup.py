@@ -0,0 +1,157 @@
+"""
+measure how long ntuee-mailer takes to start, the tool is often invoked from
+scripts in loops, so commands that do no work should return quickly
+
+every command runs in a fresh interpreter, the wall time is the median of
+--runs runs, the import time added on top of typer (which imports click and
+rich by itself) is read from `python -X importtime`
+
+exits with 1 when a budget is exceeded or a heavy dependency is imported
+
+usage:
+    python benchmarks/bench_startup.py [--runs 10] [--budget-ms 500]
+        [--import-budget-ms 30] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# commands that should never need more than typer
+COMMANDS = [
+    ["--help"],
+    ["send", "--help"],
+    ["config", "--list"],
+]
+
+# only the commands that use them may import these
+HEAVY_MODULES = (
+    "cerberus",
+    "yaml",
+    "email_validator",
+    "dns",
+    "smtplib",
+    "poplib",
+    "ssl",
+    "socketserver",
+    "argparse",
+)
+
+
+def run(args: list, importtime: bool = False) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    flags = ["-X", "importtime"] if importtime else []
+    return subprocess.run(
+        [sys.executable, *flags, *args],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_times(args: list) -> dict:
+    """{module: self import time in microseconds}"""
+    times = {}
+    for line in run(args, importtime=True).stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def measure(command: list, runs: int) -> dict:
+    args = ["-m", "ntuee_mailer", *command]
+    walls = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(args)
+        walls.append(time.perf_counter() - start)
+
+    baseline = import_times(["-c", "import typer"])
+    modules = import_times(args)
+    added = {name: us for name, us in modules.items() if name not in baseline}
+    heavy = sorted({name.split(".")[0] for name in modules} & set(HEAVY_MODULES))
+
+    return {
+        "command": " ".join(command),
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "wall_min_ms": round(min(walls) * 1000, 2),
+        "import_ms": round(sum(modules.values()) / 1000, 2),
+        "added_import_ms": round(sum(added.values()) / 1000, 2),
+        "slowest_added": sorted(added, key=added.get, reverse=True)[:5],
+        "heavy_modules": heavy,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=500,
+        help="median wall time allowed for each command",
+    )
+    parser.add_argument(
+        "--import-budget-ms",
+        type=float,
+        default=30,
+        help="import time allowed on top of importing typer",
+    )
+    parser.add_argument("--output", "-o", type=Path, help="write results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    failed = False
+    for command in COMMANDS:
+        result = measure(command, args.runs)
+        results.append(result)
+
+        problems = []
+        if result["wall_ms"] > args.budget_ms:
+            problems.append(f"wall time over {args.budget_ms:g} ms")
+        if result["added_import_ms"] > args.import_budget_ms:
+            problems.append(
+                f"import time over {args.import_budget_ms:g} ms, slowest: "
+                + ", ".join(result["slowest_added"])
+            )
+        if len(result["heavy_modules"]) > 0:
+            problems.append("imports " + ", ".join(result["heavy_modules"]))
+        failed = failed or len(problems) > 0
+
+        print(
+            f"{result['command']:>15}: {result['wall_ms']:8.1f} ms wall "
+            f"(min {result['wall_min_ms']:.1f}), {result['import_ms']:7.1f} ms "
+            f"imports, {result['added_import_ms']:6.1f} ms on top of typer"
+        )
+        for problem in problems:
+            print(f"{'':>15}  over budget: {problem}")
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "budget_ms": args.budget_ms,
+        "import_budget_ms": args.import_budget_ms,
+        "results": results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"\nresults written to {args.output}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import threading
+from collections import OrderedDict
+from email.generator import BytesGenerator
+from email.mime.application import MIMEApplication
+from io import BytesIO
+from pathlib import Path
+
+__all__ = ["EncodedAttachment", "AttachmentCache", "attachment_cache"]
+
+CRLF = "\r\n"
+
+# encoded attachments kept for the letters a process sends later, e.g. the
+# spool daemon, the least recently used are dropped beyond this many bytes
+MAX_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class EncodedAttachment:
+    """
+    an attachment whose MIME part (headers and base64 body) is rendered once,
+    the rendered bytes are spliced into every message it is attached to,
+    the content of the file is not kept
+    """
+
+    name: str = None
+    rendered: bytes = None
+
+    def __init__(self, path: str):
+        path = Path(path)
+        with open(path, "rb") as f:
+            part = MIMEApplication(f.read(), Name=path.name)
+
+        part["Content-Disposition"] = f"attachment; filename={path.name}"
+
+        buffer = BytesIO()
+        BytesGenerator(
+            buffer, mangle_from_=False, policy=part.policy.clone(linesep=CRLF)
+        ).flatten(part, unixfrom=False)
+        self.name = path.name
+        self.rendered = buffer.getvalue()
+
+    def __len__(self) -> int:
+        return len(self.rendered)
+
+
+class AttachmentCache:
+    """
+    cache of encoded attachments, keyed by path, size and modification time,
+    holding at most `max_size` bytes, least recently used first out
+    """
+
+    max_size: int = MAX_CACHE_SIZE
+
+    def __init__(self, max_size: int = MAX_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+        self.__attachments = OrderedDict()
+        self.__size = 0
+
+    @property
+    def size(self) -> int:
+        """bytes of the cached attachments"""
+        return self.__size
+
+    def get(self, path: str) -> EncodedAttachment:
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        with self.__lock:
+            attachment = self.__attachments.get(key)
+            if attachment is not None:
+                self.__attachments.move_to_end(key)
+                return attachment
+
+            attachment = EncodedAttachment(path)
+            self.__attachments[key] = attachment
+            self.__size += len(attachment)
+            # an attachment larger than the cache is still returned
+            while self.__size > self.max_size:
+                _, evicted = self.__attachments.popitem(last=False)
+                self.__size -= len(evicted)
+            return attachment
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__attachments.clear()
+            self.__size = 0
+
+
+attachment_cache = AttachmentCache()
@@ -6,26 +6,46 @@ from rich.progress import (
     TimeRemainingColumn,
     BarColumn,
 )
-from rich.prompt import Prompt
+from rich.prompt import Confirm, Prompt
 from cerberus import Validator
 
 import time
 import os
-import re
 import logging
-from typing import List
+import threading
+from contextlib import ExitStack
+from typing import Iterable, List, Tuple
 from configparser import ConfigParser
 from pathlib import Path
 import smtplib
-from email.mime.multipart import MIMEMultipart
-import poplib
-from email.parser import Parser as EmailParser
 
 from .utils import *
 from .globals import *
 from .Letter import Letter
+from .MessageSkeleton import Email
+from .RateLimiter import RateLimiter
+from .Retry import (
+    DeliveryQueue,
+    ReconnectFailed,
+    backoff_delay,
+    breaks_connection,
+    is_throttling,
+    is_transient,
+)
+from .DeadLetters import DeadLetters
+from .BounceChecker import BounceChecker, record_bounces
+from .MessageIndex import MessageIndex
+from .Outbox import Outbox
+from .Journal import SendJournal, SENT, FAILED
+from .endpoints import endpoint
+from .Metrics import metrics
+from .Pipelining import pipelined_transfer, supports_pipelining
+from .Suppressions import SuppressionList
+
+__all__ = ["AutoMailer", "ACCOUNT_SECTION_PREFIX"]
 
-__all__ = ["AutoMailer"]
+# [account.<id>] sections configure the accounts a letter is sharded across
+ACCOUNT_SECTION_PREFIX = "account."
 
 auto_mailer_config_schema = {
     "account": {
@@ -35,6 +55,26 @@ auto_mailer_config_schema = {
             "userid": {"type": "string"},
         },
     },
+    # the [account.<id>] sections, by id, options left out are taken from
+    # the smtp and ratelimit sections
+    "accounts": {
+        "type": "dict",
+        "default": {},
+        "valuesrules": {
+            "type": "dict",
+            "schema": {
+                "userid": {"type": "string", "required": True, "empty": False},
+                "connections": {"type": "integer", "coerce": int, "min": 1},
+                "rate": {"type": "float", "coerce": float, "min": 0},
+                "burst": {"type": "integer", "coerce": int, "min": 1},
+                "max_rate": {"type": "float", "coerce": float, "min": 0},
+                "limits": {
+                    "type": "string",
+                    "regex": r"(\s*\d+\s*/\s*\d+(\.\d+)?\s*,?)*",
+                },
+            },
+        },
+    },
     "smtp": {
         "require_all": True,
         "type": "dict",
@@ -42,6 +82,71 @@ auto_mailer_config_schema = {
             "host": {"type": "string"},
             "port": {"type": "integer", "coerce": int},
             "timeout": {"type": "integer", "coerce": int},
+            "connections": {
+                "type": "integer",
+                "coerce": int,
+                "min": 1,
+                "required": False,
+                "default": 1,
+            },
+            "retries": {
+                "type": "integer",
+                "coerce": int,
+                "min": 0,
+                "required": False,
+                "default": 3,
+            },
+            "retry_delay": {
+                "type": "float",
+                "coerce": float,
+                "min": 0,
+                "required": False,
+                "default": 5.0,
+            },
+            "verp": {
+                "type": "boolean",
+                "coerce": to_bool,
+                "required": False,
+                "default": False,
+            },
+            "ssl": {
+                "type": "boolean",
+                "coerce": to_bool,
+                "required": False,
+                "default": True,
+            },
+            "pipelining": {
+                "type": "boolean",
+                "coerce": to_bool,
+                "required": False,
+                "default": True,
+            },
+            "bulk_size": {
+                "type": "integer",
+                "coerce": int,
+                "min": 1,
+                "required": False,
+                "default": 100,
+            },
+        },
+    },
+    "ratelimit": {
+        "type": "dict",
+        "default": {},
+        "schema": {
+            "rate": {"type": "float", "coerce": float, "min": 0, "default": 1.0},
+            "burst": {"type": "integer", "coerce": int, "min": 1, "default": 10},
+            "min_rate": {"type": "float", "coerce": float, "min": 0, "default": 0.1},
+            "max_rate": {"type": "float", "coerce": float, "min": 0, "default": 10.0},
+            "increase": {"type": "float", "coerce": float, "min": 0, "default": 0.05},
+            "decrease": {"type": "float", "coerce": float, "min": 0, "default": 0.5},
+            "window": {"type": "integer", "coerce": int, "min": 1, "default": 10},
+            "cooldown": {"type": "float", "coerce": float, "min": 0, "default": 30.0},
+            "limits": {
+                "type": "string",
+                "regex": r"(\s*\d+\s*/\s*\d+(\.\d+)?\s*,?)*",
+                "default": "10/10, 130/150, 260/320",
+            },
         },
     },
     "pop3": {
@@ -51,16 +156,49 @@ auto_mailer_config_schema = {
             "host": {"type": "string"},
             "port": {"type": "integer", "coerce": int},
             "timeout": {"type": "integer", "coerce": int},
+            "ssl": {
+                "type": "boolean",
+                "coerce": to_bool,
+                "required": False,
+                "default": True,
+            },
+        },
+    },
+    # in-process stand-ins for the SMTP and POP3 servers, see FakeServers
+    "fake": {
+        "type": "dict",
+        "default": {},
+        "schema": {
+            "enabled": {"type": "boolean", "coerce": to_bool, "default": False},
+            "smtp_port": {"type": "integer", "coerce": int, "min": 0, "default": 2465},
+            "pop3_port": {"type": "integer", "coerce": int, "min": 0, "default": 2995},
+            "latency": {"type": "float", "coerce": float, "min": 0, "default": 0.0},
+            "rate": {"type": "float", "coerce": float, "min": 0, "default": 0.0},
+            "burst": {"type": "integer", "coerce": int, "min": 1, "default": 10},
+            "error_rate": {"type": "float", "coerce": float, "min": 0, "default": 0.0},
+            "error_code": {"type": "integer", "coerce": int, "default": 451},
+            "reject_rate": {"type": "float", "coerce": float, "min": 0, "default": 0.0},
+            "reject_pattern": {"type": "string", "default": ""},
+            "reject_code": {"type": "integer", "coerce": int, "default": 550},
+            "lenient_data": {"type": "boolean", "coerce": to_bool, "default": False},
+            "disconnect_rate": {
+                "type": "float",
+                "coerce": float,
+                "min": 0,
+                "default": 0.0,
+            },
+            "bounce_rate": {"type": "float", "coerce": float, "min": 0, "default": 0.0},
+            "bounce_pattern": {"type": "string", "default": ""},
         },
     },
 }
 v = Validator(auto_mailer_config_schema)
 
-email_re = re.compile("[a-z0-9-_\.]+@[a-z0-9-\.]+\.[a-z\.]{2,5}")
-
 
 class AutoMailer:
     verbose: bool = True
+    # nothing is asked and nothing waits for the user to read it
+    batch: bool = False
     SMTPserver: smtplib.SMTP_SSL = None
     config: dict = None
     total_count: int = 0
@@ -68,17 +206,52 @@ class AutoMailer:
     email_addrs: List[str] = []
     userid: str = None
     password: str = None
-
-    def __init__(self, config: dict = None, quiet: bool = False) -> None:
+    workers: int = 1
+    message_index: MessageIndex = None
+    sent_at: float = None
+    pool: List[smtplib.SMTP_SSL] = None
+
+    def __init__(
+        self,
+        config: dict = None,
+        quiet: bool = False,
+        workers: int = None,
+        rate_limiter: RateLimiter = None,
+        batch: bool = False,
+    ) -> None:
         self.config = config
         self.verbose = not quiet
+        self.batch = batch
+        self.workers = workers if workers is not None else config["smtp"]["connections"]
+        self.email_addrs = []
+        self.message_index = MessageIndex()
+        self.__count_lock = threading.Lock()
+        self.rate_limiter = rate_limiter
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter.from_config(config)
         self.SMTPserver = self.__createSMTPServer()
+        self.pool = [self.SMTPserver]
+
+    def login(self, userid: str = None, password: str = None) -> None:
+        """login to SMTP server, asks for the credentials unless given"""
+        if userid is not None and password is not None:
+            self.userid = userid
+            self.password = password
+            try:
+                self.__login(self.SMTPserver, userid, password)
+            except Exception as e:
+                logging.critical(e)
+                richError("Login failed", prefix="", code=EXIT_LOGIN_FAILED)
+            logging.info("Login success")
+            return
+
+        if self.batch:
+            self.login_batch()
+            return
 
-    def login(self) -> None:
-        """login to SMTP server"""
         for i in range(3):
             try:
-                self.SMTPserver.login(*self.__get_login_info())
+                self.__login(self.SMTPserver, *self.__get_login_info())
             except KeyboardInterrupt:
                 exit(1)
             except:
@@ -91,16 +264,55 @@ class AutoMailer:
             richSuccess("Login success")
             return
 
-        richError("Too many failed login attempts", prefix="")
+        richError("Too many failed login attempts", prefix="", code=EXIT_LOGIN_FAILED)
+
+    def login_batch(self, password: str = None) -> None:
+        """
+        login without asking, `password` if given, else from the environment
+        or the keyring, see credentials.batch_login_info
+        """
+        from .credentials import batch_login_info
+
+        self.login(*batch_login_info(self.config, password))
+
+    @property
+    def senders(self) -> List[str]:
+        """user ids of the accounts that sent emails, their mailboxes get the bounces"""
+        return [self.userid] if self.total_count > 0 else []
 
     def __get_login_info(self) -> dict:
         """get login info"""
+        userid, password = self.prompt_login_info(self.config)
+
+        self.userid = userid
+        self.password = password
+        return userid, password
+
+    @staticmethod
+    def prompt_password(userid: str) -> str:
+        """ask for the password of `userid`"""
+        print(f"\n[blue]\\[User login][/blue] {userid}")
+        password = Prompt.ask("[blue]password", password=True)
+        print("\n")
+        return password
+
+    @classmethod
+    def prompt_login_info(cls, config: dict, batch: bool = False) -> tuple:
+        """
+        ask for the user id and password of the school account, in `batch`
+        mode, they are looked up instead
+        """
+        if batch:
+            from .credentials import batch_login_info
+
+            return batch_login_info(config)
+
         print("\n[blue]\[User login]")
 
-        if "userid" in self.config["account"]:
+        if "userid" in config["account"]:
             userid = Prompt.ask(
                 "[blue]Username[/blue] saved user id:",
-                default=self.config["account"]["userid"],
+                default=config["account"]["userid"],
             )
         else:
             userid = Prompt.ask("[blue]Username[/blue] (e.g. b09901000)",)
@@ -108,23 +320,154 @@ class AutoMailer:
 
             save_id = Confirm.ask("[blue]remember this userid?[/blue]", default=True)
             if save_id:
-                new_config = self.config.copy()
-                new_config["account"] = self.config["account"].copy()
+                new_config = config.copy()
+                new_config["account"] = config["account"].copy()
                 new_config["account"]["userid"] = userid
-                self.save_config(new_config)
+                cls.save_config(new_config)
 
         password = Prompt.ask("[blue]password", password=True)
 
         print("\n")
 
-        self.userid = userid
-        self.password = password
         return userid, password
 
     def send_emails(
-        self, letter: Letter, *, test_mode: bool = False, dry: bool = False
+        self,
+        letter: Letter,
+        *,
+        test_mode: bool = False,
+        dry: bool = False,
+        journal: SendJournal = None,
+        dead_letters: DeadLetters = None,
+        message_index: MessageIndex = None,
+        confirm: bool = True,
+        progress: Progress = None,
     ) -> None:
-        """send emails"""
+        """
+        send emails, recording the outcome of each one in `journal`, emails
+        that could not be delivered in `dead_letters` and the Message-ID token
+        of each email in `message_index` if given,
+        without `confirm` or in batch mode, nothing is asked before sending,
+        given a started `progress`, the emails get a task of it named after
+        the account instead of a progress bar of their own
+        """
+        if confirm and not self.batch:
+            self.confirm_sending(letter)
+
+        if self.SMTPserver is None:
+            logging.info("SMTP server is not connected, please connect first")
+            richError("SMTP server is not connected, please connect first")
+
+        if self.sent_at is None:
+            self.sent_at = time.time()
+
+        self.set_sender(letter)
+        if message_index is not None:
+            self.message_index = message_index
+        outbox = Outbox(letter, journal, dead_letters, self.message_index)
+
+        shared_progress = progress is not None
+        with ExitStack() as stack:
+            description = self.userid
+            if not shared_progress:
+                progress = stack.enter_context(self.create_progress())
+                description = "Sending emails..."
+
+            logging.info(f"Sending {len(letter)} emails from {self.userid}")
+            outbox.task = progress.add_task(description, total=len(letter))
+            self.send_outboxes(
+                ((email, outbox) for email in outbox.emails()),
+                progress,
+                test_mode=test_mode,
+                dry=dry,
+            )
+
+            if dry:
+                if not shared_progress:
+                    print("[red]This is a dry run, no emails were actually sent")
+            else:
+                self.rate_limiter.save()
+                if dead_letters is not None:
+                    dead_letters.save()
+
+    def send_as_is(self, emails: Iterable[Email]) -> None:
+        """
+        send emails as they are, without a letter, e.g. those exported by
+        `ntuee-mailer export`, `len(emails)` is the number of recipients,
+        outcomes are only counted
+        """
+        if self.sent_at is None:
+            self.sent_at = time.time()
+
+        outbox = Outbox(emails)
+        with self.create_progress() as progress:
+            outbox.task = progress.add_task("Sending emails...", total=len(emails))
+            self.send_outboxes(((email, outbox) for email in outbox.emails()), progress)
+        self.rate_limiter.save()
+
+    def set_sender(self, letter: Letter) -> None:
+        """send the letter from the logged in account"""
+        self.email_addrs += letter.email_addrs
+        letter.set_from_addr(
+            complete_school_email(self.userid), verp=self.config["smtp"]["verp"]
+        )
+
+    def send_outboxes(
+        self,
+        feed: Iterable[Tuple[Email, Outbox]],
+        progress: Progress,
+        *,
+        test_mode: bool = False,
+        dry: bool = False,
+    ) -> None:
+        """
+        send the emails of `feed` over the connection pool, each along with
+        the outbox of its letter, so emails of several letters can be
+        interleaved, returns once every email got its final outcome,
+        raises the error that stopped a sending thread
+        """
+        if not dry:
+            self.__open_pool()
+        logging.info(f"Sending over {len(self.pool)} connection(s)")
+
+        # bounded, so rendering never runs far ahead of sending
+        email_queue = DeliveryQueue(maxsize=2 * len(self.pool))
+        workers = [
+            threading.Thread(
+                target=self.__send_worker,
+                args=(i, email_queue, progress),
+                kwargs={"test_mode": test_mode, "dry": dry},
+                daemon=True,
+            )
+            for i in range(len(self.pool))
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for email, outbox in feed:
+                email_queue.put((email, 0, outbox))
+        finally:
+            email_queue.close()
+            for worker in workers:
+                worker.join()
+
+        if email_queue.error is not None:
+            raise email_queue.error
+
+    @staticmethod
+    def create_progress() -> Progress:
+        """the progress bars of sending emails"""
+        return Progress(
+            TextColumn("[bold blue]{task.description}", justify="right"),
+            BarColumn(bar_width=None),
+            "[progress.percentage]{task.completed} of {task.total:.0f}",
+            "•",
+            TimeRemainingColumn(),
+        )
+
+    def confirm_sending(self, letter: Letter) -> None:
+        """show the content and ask before sending, exits if the user cancels"""
         if self.verbose:
             print("-" * 50)
             print(Path(letter.paths["content"]).read_text(encoding="utf-8"))
@@ -148,76 +491,270 @@ Do you want to continue?""",
             logging.info("User cancelled on sending emails")
             richError("Canceled", prefix="")
 
-        if self.SMTPserver is None:
-            logging.info("SMTP server is not connected, please connect first")
-            richError("SMTP server is not connected, please connect first")
-
-        self.email_addrs += letter.email_addrs
-
-        letter.set_from_addr(complete_school_email(self.userid))
-
-        progress = Progress(
-            TextColumn("[bold blue]{task.description}", justify="right"),
-            BarColumn(bar_width=None),
-            "[progress.percentage]{task.completed} of {task.total:.0f}",
-            "•",
-            TimeRemainingColumn(),
-        )
-
-        with progress:
-            logging.info(f"Sending {len(letter)} emails")
-            for email in progress.track(letter, description="Sending emails..."):
-                self.__server_rest(progress)
+    def __send_worker(
+        self,
+        index: int,
+        email_queue: DeliveryQueue,
+        progress: Progress,
+        *,
+        test_mode: bool = False,
+        dry: bool = False,
+    ) -> None:
+        """send emails from the queue over connection `index` of the pool"""
+        total_count = 0
+        success_count = 0
+        retries = self.config["smtp"]["retries"]
+
+        while True:
+            item = email_queue.get()
+            if item is None:
+                break
+            # the email stays in the queue when it is put back for a retry
+            retried = False
+            try:
+                email, attempt, outbox = item
+                if test_mode:
+                    to = f"{complete_school_email(self.userid)} (yourself)"
+                elif email.batch is not None and len(email.to_addrs) > 1:
+                    to = f"{email.to_addrs[0]} and {len(email.to_addrs) - 1} others"
+                else:
+                    to = ",".join(email.to_addrs)
 
+                error = None
+                refused = {}
                 if not dry:
-                    success = self.send_email(email, test_mode=test_mode)
-                else:
-                    success = True
+                    if self.pool[index] is None:
+                        self.pool[index] = self.__reconnect()
+
+                    if self.pool[index] is None:
+                        error = ReconnectFailed("failed to reconnect")
+                    else:
+                        self.__acquire_send_slot(progress)
+                        try:
+                            refused = self.__deliver(
+                                self.pool[index], email, test_mode=test_mode
+                            )
+                        except Exception as e:
+                            error = e
+
+                if error is not None:
+                    logging.error(error)
+                    logging.error(f"Failed to send email to {email.to_addrs}")
+
+                    if is_throttling(error):
+                        self.rate_limiter.throttled()
+
+                    # a pipelined transaction that could not be aborted
+                    # otherwise leaves its connection closed
+                    closed = (
+                        self.pool[index] is not None and self.pool[index].sock is None
+                    )
+                    if breaks_connection(error) or closed:
+                        self.__close(self.pool[index])
+                        self.pool[index] = None
 
-                if success:
+                    if is_transient(error) and attempt < retries:
+                        delay = backoff_delay(
+                            attempt, self.config["smtp"]["retry_delay"]
+                        )
+                        progress.print(
+                            f"[yellow]failed to send email to {to}, "
+                            f"retrying in {delay:.1f} seconds..."
+                        )
+                        email_queue.retry((email, attempt + 1, outbox), delay)
+                        metrics.inc("retries_total")
+                        retried = True
+                        continue
+
+                delivered = 0
+                for row, address, token in email.deliveries:
+                    if dry:
+                        break
+                    # a refused recipient fails on its own, even when the email
+                    # went out to the others
+                    row_error = error
+                    if row_error is None and address in refused:
+                        row_error = smtplib.SMTPRecipientsRefused(
+                            {address: refused[address]}
+                        )
+
+                    total_count += 1
+                    delivered += 1 if row_error is None else 0
+                    metrics.inc(
+                        "emails_sent_total"
+                        if row_error is None
+                        else "emails_failed_total"
+                    )
+                    if outbox.journal is not None:
+                        outbox.journal.record(
+                            row,
+                            address,
+                            SENT if row_error is None else FAILED,
+                            token=token,
+                        )
+                    if row_error is None and outbox.message_index is not None:
+                        outbox.message_index.add(token, row, address)
+                    if outbox.dead_letters is not None:
+                        if row_error is None:
+                            outbox.dead_letters.resolve(row)
+                        else:
+                            outbox.dead_letters.add(
+                                row, outbox.letter.csv[row], row_error
+                            )
+                success_count += delivered
+
+                if error is None:
                     if self.verbose:
+                        progress.print(f"[green]successfully sent email to {to}")
+                    for addr, (code, _) in refused.items():
                         progress.print(
-                            f"[green]successfully sent email to {(complete_school_email(self.userid)+' (yourself)') if test_mode else email['To']}"
+                            f"[yellow]  {addr} was refused by the server ({code})"
                         )
                 else:
-                    progress.print(
-                        f"[red]failed to send email to {(complete_school_email(self.userid)+' (yourself)') if test_mode else email['To']}"
-                    )
-
-            if dry:
-                print("[red]This is a dry run, no emails were actually sent")
+                    progress.print(f"[red]failed to send email to {to}")
 
-    def send_email(self, email: MIMEMultipart, *, test_mode: bool = False) -> None:
+                progress.advance(outbox.task, len(email.deliveries))
+                outbox.settle(
+                    delivered, 0 if dry else len(email.deliveries) - delivered
+                )
+            except BaseException as e:
+                # the error of bookkeeping, e.g. writing the journal, fails the
+                # whole send instead of leaving the other threads waiting
+                logging.exception(e)
+                email_queue.abort(e)
+                break
+            finally:
+                if not retried:
+                    email_queue.done()
+
+        with self.__count_lock:
+            self.total_count += total_count
+            self.success_count += success_count
+
+    def __acquire_send_slot(self, progress: Progress) -> None:
+        """rate limit the pool as a whole, workers wait while the server rests"""
+
+        def on_wait(seconds):
+            # short waits between emails are expected, only report real rests
+            if seconds >= 1:
+                progress.print(f"[blue]resting for {seconds:.0f} seconds...")
+
+        metrics.observe("ratelimit_wait_seconds", self.rate_limiter.acquire(on_wait))
+
+    def send_email(self, email: Email, *, test_mode: bool = False) -> bool:
         """send email"""
         if self.SMTPserver is None:
             richError("SMTP server is not connected, please connect first")
 
-        self.total_count += 1
-
+        try:
+            self.__deliver(self.SMTPserver, email, test_mode=test_mode)
+            for row, address, token in email.deliveries:
+                self.message_index.add(token, row, address)
+            success = True
+        except Exception as e:
+            logging.error(e)
+            logging.error(f"Failed to send email to {email.to_addrs}")
+            if is_throttling(e):
+                self.rate_limiter.throttled()
+            success = False
+
+        metrics.inc("emails_sent_total" if success else "emails_failed_total")
+        with self.__count_lock:
+            self.total_count += 1
+            self.success_count += 1 if success else 0
+
+        return success
+
+    def __deliver(
+        self, server: smtplib.SMTP_SSL, email: Email, *, test_mode: bool = False
+    ) -> dict:
+        """
+        send email over the given connection, raises on failure,
+        returns {address: (code, response)} of the refused recipients
+        """
         if test_mode:
-            toaddrs = complete_school_email(self.userid)
-            ccaddrs = ""
-            bccaddrs = ""
+            toaddrs = [complete_school_email(self.userid)]
         else:
-            toaddrs = email["To"].split(",")
-            ccaddrs = email["Cc"].split(",") if email["Cc"] is not None else []
-            bccaddrs = email["Bcc"].split(",") if email["Bcc"] is not None else []
+            toaddrs = email.recipients
 
-        try:
-            self.SMTPserver.sendmail(
-                email["From"], toaddrs + ccaddrs + bccaddrs, email.as_string(),
+        server.ehlo_or_helo_if_needed()
+        options = []
+        if server.does_esmtp and server.has_extn("size"):
+            options.append(f"size={len(email.data)}")
+
+        with metrics.timer("smtp_send_seconds"):
+            if self.config["smtp"]["pipelining"] and supports_pipelining(server):
+                refused = pipelined_transfer(
+                    server, email.envelope_from, toaddrs, email.data, options
+                )
+            else:
+                refused = self.__transfer(
+                    server, email.envelope_from, toaddrs, email.data, options
+                )
+        metrics.inc("bytes_sent_total", len(email.data))
+
+        for addr, (code, response) in refused.items():
+            metrics.inc("recipients_refused_total")
+            logging.warning(
+                f"Recipient {addr} of {email.token} refused: {code} {response}"
             )
-        except Exception as e:
-            logging.error(e)
-            logging.error(f"Failed to send email to {email['To']}")
-            return False
 
+        self.rate_limiter.success()
         logging.info(f"Sent email {toaddrs}")
 
-        self.success_count += 1
-        return True
+        return refused
+
+    @staticmethod
+    def __transfer(
+        server: smtplib.SMTP_SSL,
+        from_addr: str,
+        to_addrs: List[str],
+        data: bytes,
+        options: List[str],
+    ) -> dict:
+        """
+        smtplib.SMTP.sendmail with every round-trip timed,
+        raises the same exceptions and returns the refused recipients
+        """
+        with metrics.timer("smtp_mail_seconds"):
+            code, response = server.mail(from_addr, options)
+        if code != 250:
+            if code == 421:
+                server.close()
+            else:
+                server.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+        refused = {}
+        for addr in to_addrs:
+            with metrics.timer("smtp_rcpt_seconds"):
+                code, response = server.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, response)
+            if code == 421:
+                server.close()
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(to_addrs):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        with metrics.timer("smtp_data_seconds"):
+            code, response = server.data(data)
+        if code != 250:
+            if code == 421:
+                server.close()
+            else:
+                server.rset()
+            raise smtplib.SMTPDataError(code, response)
 
-    def check_bounce_backs(self) -> None:
+        return refused
+
+    @staticmethod
+    def __login(server: smtplib.SMTP_SSL, userid: str, password: str) -> None:
+        with metrics.timer("login_seconds"):
+            server.login(userid, password)
+
+    def check_bounce_backs(self, journal: SendJournal = None) -> None:
         """show help message if emails are bounced back, this usually happens when trying to email a wrong school email address"""
         if self.total_count == 0:
             print("No emails were sent, nothing to check")
@@ -229,92 +766,27 @@ Do you want to continue?""",
         )
         with progress:
             progress.add_task(description="checking for bounce-backs...", total=None)
-            time.sleep(5)  # wait for bounce back
 
+            checker = BounceChecker(self.config, self.userid, self.password)
             try:
-                # connect to pop3 server
-                pop3 = poplib.POP3_SSL(
-                    host=self.config["pop3"]["host"],
-                    port=self.config["pop3"]["port"],
-                    timeout=self.config["pop3"]["timeout"],
-                )
-                pop3.user(self.userid)
-                pop3.pass_(self.password)
+                bounces = checker.scan(since=self.sent_at)
             except Exception as e:
                 logging.error(e)
-                logging.error("Failed to connect to pop3 server")
-                progress.print("[red]Failed to connect to pop3 server")
+                logging.error("Failed to check bounce-backs on pop3 server")
+                progress.print("[red]Failed to check bounce-backs on pop3 server")
                 return 0
 
-            progress.print("Connected to POP3 server")
-            logging.info("Connected to POP3 server")
-            # retrieve last n emails
-            _, mails, _ = pop3.list()
-            emails = [
-                pop3.retr(i)[1]
-                for i in range(len(mails), len(mails) - len(self.email_addrs), -1)
-            ]
-            pop3.quit()
-
-            email_contents = []
-            # Concat message pieces:
-            for msg in emails:
-                # some chinese character may not be able to parse,
-                # however, we only care about the bounce back notifications,
-                # which are always in English
-                try:
-                    email_contents.append(b"\r\n".join(msg).decode("utf-8"))
-                except:
-                    continue
-
-            # Parse message into an email object:
-            email_contents = [
-                EmailParser().parsestr(content, headersonly=True)
-                for content in email_contents
-            ]
-
-            bounced_list = []
-
-            for content in email_contents:
-                if not re.match(
-                    "(Delivery Status Notification)|(Undelivered Mail Returned to Sender)",
-                    content["subject"],
-                ):
-                    continue
-
-                # match for email addresses
-                addr = email_re.search(content.get_payload()).group()
-                bounced_list.append(addr)
+            progress.print("Checked POP3 server")
+            bounced_list = checker.resolve(bounces, self.message_index)
+            print_bounces(bounced_list, progress.print)
 
-            bounced_list = list(filter(lambda x: x in self.email_addrs, bounced_list))
+        if journal is not None:
+            with SuppressionList(flag="c") as suppressions:
+                record_bounces(journal, bounced_list, suppressions)
 
-            if len(bounced_list) > 0:
-                progress.print(
-                    "[red]Emails sent to these addresses are bounced back (failed):"
-                )
-                for address in bounced_list:
-                    progress.print(f"\t{address},")
-                progress.print("[red]Please check these emails.")
-            else:
-                progress.print(
-                    "[green]No bounce-backs found, all emails are delivered successfully",
-                )
-
-        self.success_count -= len(bounced_list)
-
-    def __server_rest(self, progress):
-        """for bypassing email server limitation"""
-
-        def rest(seconds):
-            progress.print(f"[blue]resting for {seconds} seconds...")
-            time.sleep(seconds)
-
-        if self.total_count % 260 == 0 and self.total_count > 0:
-            rest(50)
-        elif self.total_count % 130 == 0 and self.total_count > 0:
-            rest(30)
-        elif self.total_count % 10 == 0 and self.total_count > 0:
-            rest(10)
+        self.success_count -= len(
+            {bounce.row for bounce in bounced_list if not bounce.delayed}
+        )
 
     def __createSMTPServer(self) -> smtplib.SMTP_SSL:
         """create SMTP server"""
@@ -326,55 +798,119 @@ Do you want to continue?""",
         ) as progress:
             progress.add_task(description="Connecting to SMTP Server...", total=None)
 
-            time.sleep(1)
+            if not self.batch:
+                time.sleep(1)
 
             try:
-                server = smtplib.SMTP_SSL(
-                    host=self.config["smtp"]["host"],
-                    port=self.config["smtp"]["port"],
-                    timeout=self.config["smtp"]["timeout"],
-                )
+                server = self.__connect()
             except Exception as e:
                 logging.critical(e)
                 logging.critical("Failed to connect to SMTP server")
                 progress.print("[red]Failed to connect to SMTP server")
-                exit(1)
+                exit(EXIT_CONNECTION_FAILED)
 
-            if server.has_extn("STARTTLS"):
-                server.starttls()
+        logging.info("Connected to SMTP server")
+        richSuccess("SMTP server connected")
+
+        return server
+
+    def __connect(self) -> smtplib.SMTP_SSL:
+        """open a new connection to the SMTP server"""
+        host, port = endpoint(self.config, "smtp")
+        smtp_class = smtplib.SMTP_SSL if self.config["smtp"]["ssl"] else smtplib.SMTP
+        with metrics.timer("connect_seconds"):
+            server = smtp_class(
+                host=host,
+                port=port,
+                timeout=self.config["smtp"]["timeout"],
+            )
 
             server.ehlo_or_helo_if_needed()
 
-        logging.info("Connected to SMTP server")
-        richSuccess("SMTP server connected")
+            if not self.config["smtp"]["ssl"] and server.has_extn("STARTTLS"):
+                server.starttls()
+                server.ehlo()
 
         return server
 
-    @classmethod
-    def load_mailer_config(cls, config_path: str) -> dict:
-        """load auto mailer configuration from config.ini"""
-        config_path = Path(config_path)
-        automailer_config = ConfigParser()
-        if not os.path.exists(config_path):
-            richError(f"{config_path} not found")
+    def __reconnect(self) -> smtplib.SMTP_SSL:
+        """open and authenticate a connection with the saved credentials"""
+        try:
+            server = self.__connect()
+            self.__login(server, self.userid, self.password)
+        except Exception as e:
+            logging.error(e)
+            logging.error("Failed to reconnect to SMTP server")
+            return None
 
-        automailer_config.read({config_path}, encoding="utf-8")
+        metrics.inc("reconnects_total")
+        logging.info("Reconnected to SMTP server")
+        return server
 
-        sections = automailer_config.sections()
+    @staticmethod
+    def __close(server: smtplib.SMTP_SSL) -> None:
+        if server is None:
+            return
+        try:
+            server.close()
+        except Exception:
+            pass
 
-        config = {}
+    def __open_pool(self) -> None:
+        """open and authenticate the remaining connections of the pool"""
+        while len(self.pool) < self.workers:
+            try:
+                server = self.__connect()
+                self.__login(server, self.userid, self.password)
+            except Exception as e:
+                logging.error(e)
+                logging.error(
+                    f"Failed to open SMTP connection {len(self.pool) + 1}, "
+                    f"continuing with {len(self.pool)}"
+                )
+                richWarning(
+                    f"failed to open SMTP connection {len(self.pool) + 1}, "
+                    f"continuing with {len(self.pool)}"
+                )
+                return
+            self.pool.append(server)
+
+        logging.info(f"Opened {len(self.pool)} SMTP connection(s)")
+
+    def refresh_pool(self) -> None:
+        """
+        check the connections of the pool after sitting idle, those the server
+        closed in the meantime are reopened when they are next used
+        """
+        for i, server in enumerate(self.pool):
+            if server is None:
+                continue
+            try:
+                code, _ = server.noop()
+                if code == 250:
+                    continue
+            except Exception as e:
+                logging.info(f"SMTP connection {i + 1} was closed: {e}")
+            self.__close(server)
+            self.pool[i] = None
 
-        for section in sections:
-            options = automailer_config.options(section)
-            temp_dict = {}
-            for option in options:
-                temp_dict[option] = automailer_config.get(section, option)
+    @classmethod
+    def load_mailer_config(cls, config_path: str, batch: bool = False) -> dict:
+        """
+        load auto mailer configuration from config.ini, asks for the name of
+        the sender if it is empty, unless in `batch` mode
+        """
+        config_path = Path(config_path)
+        if not os.path.exists(config_path):
+            richError(f"{config_path} not found")
 
-            config[section] = temp_dict
+        config = cls.read_config_file(config_path)
 
         if cls.validate_config(config, verbose=True):
             config = v.document.copy()
             if config["account"]["name"] == "":
+                if batch:
+                    richError(f"Please set account.name in {config_path}")
                 config["account"]["name"] = Prompt.ask(
                     'Your name is currently set to [blue]""[/blue], Please enter your name',
                 )
@@ -386,6 +922,30 @@ Do you want to continue?""",
             logging.critical(config)
             richError(f"mailer config validation failed, please check {config_path}",)
 
+    @staticmethod
+    def read_config_file(config_path: str) -> dict:
+        """the options written in a config file, as strings, without defaults"""
+        automailer_config = ConfigParser()
+        automailer_config.read({config_path}, encoding="utf-8")
+
+        sections = automailer_config.sections()
+
+        config = {}
+
+        for section in sections:
+            options = automailer_config.options(section)
+            temp_dict = {}
+            for option in options:
+                temp_dict[option] = automailer_config.get(section, option)
+
+            if section.startswith(ACCOUNT_SECTION_PREFIX):
+                account_id = section[len(ACCOUNT_SECTION_PREFIX) :]
+                config.setdefault("accounts", {})[account_id] = temp_dict
+            else:
+                config[section] = temp_dict
+
+        return config
+
     @classmethod
     def validate_config(cls, config: dict, verbose=False) -> bool:
         """validate config"""
@@ -403,7 +963,9 @@ Do you want to continue?""",
 
         new_config_parser = ConfigParser()
 
-        for section, vals in config.items():
+        # defaults filled in by validation are left out of the file
+        written = cls.read_config_file(CONFIG_PATH)
+        for section, vals in cls.config_sections(config, written).items():
             new_config_parser[section] = vals
 
         with open(CONFIG_PATH, "w", encoding="utf-8") as f:
@@ -411,6 +973,32 @@ Do you want to continue?""",
 
         return True
 
+    @classmethod
+    def config_sections(cls, config: dict, written: dict = None) -> dict:
+        """
+        the sections of config.ini, accounts as [account.<id>] sections,
+        given the options `written` in the file, only those and the account
+        fields are kept
+        """
+        sections = {
+            section: vals for section, vals in config.items() if section != "accounts"
+        }
+        for account_id, vals in config.get("accounts", {}).items():
+            sections[ACCOUNT_SECTION_PREFIX + account_id] = vals
+        if written is None:
+            return sections
+
+        written = cls.config_sections(written)
+        return {
+            section: {
+                key: value
+                for key, value in vals.items()
+                if section == "account" or key in written.get(section, {})
+            }
+            for section, vals in sections.items()
+            if section == "account" or section in written
+        }
+
 
 if __name__ == "__main__":
     auto_mailer_config = AutoMailer.load_mailer_config("config.ini")
@@ -0,0 +1,396 @@
+import json
+import logging
+import poplib
+import re
+from email import policy as email_policy
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Iterable, List
+
+from .globals import *
+
+from .MessageIndex import MessageIndex, message_token
+from .Journal import SendJournal, BOUNCED
+from .endpoints import endpoint
+from .Metrics import metrics
+from .Suppressions import SuppressionList, REASON_BOUNCED
+
+__all__ = ["BounceChecker", "Bounce", "record_bounces"]
+
+SEEN_STATE_PATH = APP_DIR / "pop3-seen.json"
+BOUNCE_STATE_FILE = "bounce-state.json"
+
+# tolerated difference between our clock and the Date of incoming mail
+CLOCK_SKEW = 600
+
+dsn_subject_re = re.compile(
+    r"(Delivery Status Notification)|(Undelivered Mail Returned to Sender)"
+    r"|(Mail delivery failed)|(Delivery Failure)|(Returned mail)",
+    re.I,
+)
+
+
+def decode_subject(message: Message) -> str:
+    subject = message["subject"]
+    if subject is None:
+        return ""
+    try:
+        return str(make_header(decode_header(subject)))
+    except (LookupError, UnicodeError, ValueError):
+        return str(subject)
+
+
+def message_time(headers: Message) -> float:
+    """timestamp of the Date header, infinity if it cannot be parsed"""
+    try:
+        return parsedate_to_datetime(headers["Date"]).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return float("inf")
+
+
+def looks_like_dsn(headers: Message) -> bool:
+    """whether the headers of a message look like a delivery status notification"""
+    if headers.get_content_type() == "multipart/report":
+        return True
+    return dsn_subject_re.search(decode_subject(headers)) is not None
+
+
+class Bounce:
+    """a recipient an email could not be delivered to"""
+
+    row: int = None
+    email: str = None
+    status: str = None
+    diagnostic: str = None
+    # the address in the email column of the row, `email` may be a cc
+    recipient: str = None
+    # the server is still trying, the email may yet be delivered
+    delayed: bool = False
+
+    def __init__(
+        self,
+        row: int,
+        email: str,
+        status: str = None,
+        diagnostic: str = None,
+        *,
+        recipient: str = None,
+        delayed: bool = False,
+    ) -> None:
+        self.row = row
+        self.email = email
+        self.status = status
+        self.diagnostic = diagnostic
+        self.recipient = recipient if recipient is not None else email
+        self.delayed = delayed
+
+    def __repr__(self) -> str:
+        return (
+            f"Bounce(row={self.row}, email={self.email!r}, status={self.status!r}"
+            f"{', delayed' if self.delayed else ''})"
+        )
+
+
+def parse_address_field(value: str) -> str:
+    """`rfc822; user@example.com` -> `user@example.com`"""
+    if value is None:
+        return None
+    address = str(value).split(";", 1)[-1].strip().strip("<>")
+    return address.lower() if "@" in address else None
+
+
+def is_delay(action: str, status: str) -> bool:
+    """
+    whether a recipient of a DSN is only delayed: action `delayed` or a 4.x.x
+    status, a 5.x.x status always means the delivery failed for good
+    """
+    status = (status or "").strip()
+    if status.startswith("5"):
+        return False
+    return action == "delayed" or status.startswith("4")
+
+
+def parse_dsn(bounce: Message):
+    """
+    extract the token of the original email and the failed or delayed
+    recipients from a delivery status notification (RFC 3464)
+
+    returns (token, [(address, status, diagnostic, delayed), ...])
+    """
+    token = None
+    recipients = []
+
+    # bounce-backs are sent to the envelope sender, which carries the token
+    # when VERP is enabled
+    for header in ("X-Original-To", "Delivered-To", "To"):
+        token = message_token(bounce[header])
+        if token is not None:
+            break
+
+    for part in bounce.walk():
+        content_type = part.get_content_type()
+
+        if content_type == "message/delivery-status":
+            # the first group describes the message, the others one recipient each
+            for group in part.get_payload()[1:]:
+                address = parse_address_field(
+                    group["Final-Recipient"] or group["Original-Recipient"]
+                )
+                if address is None:
+                    continue
+                action = (group["Action"] or "failed").strip().lower()
+                if action not in ("failed", "delayed"):
+                    continue
+                status = group["Status"]
+                recipients.append(
+                    (
+                        address,
+                        status,
+                        group["Diagnostic-Code"],
+                        is_delay(action, status),
+                    )
+                )
+
+        elif token is None and content_type == "message/rfc822":
+            original = part.get_payload()
+            if isinstance(original, list) and len(original) > 0:
+                token = message_token(original[0]["Message-ID"])
+
+        elif token is None and content_type == "text/rfc822-headers":
+            payload = part.get_payload(decode=True) or b""
+            headers = BytesParser(policy=email_policy.compat32).parsebytes(
+                payload, headersonly=True
+            )
+            token = message_token(headers["Message-ID"])
+
+    return token, recipients
+
+
+class BounceChecker:
+    """
+    scans a POP3 mailbox for bounce-backs,
+    only the headers of new messages are downloaded, the full message is only
+    retrieved when the headers look like a delivery status notification,
+    UIDL values of scanned messages are remembered in `state_path` so they are
+    never fetched again
+    """
+
+    config: dict = None
+    userid: str = None
+    password: str = None
+    state_path: Path = None
+
+    def __init__(
+        self,
+        config: dict,
+        userid: str,
+        password: str,
+        *,
+        state_path: Path = SEEN_STATE_PATH,
+    ) -> None:
+        self.config = config
+        self.userid = userid
+        self.password = password
+        self.state_path = Path(state_path)
+        self.parser = BytesParser(policy=email_policy.compat32)
+
+    @classmethod
+    def for_letter(cls, config: dict, userid: str, password: str, letter_path: str):
+        """a checker whose scanning state is kept in the letter directory"""
+        return cls(
+            config, userid, password, state_path=Path(letter_path) / BOUNCE_STATE_FILE
+        )
+
+    @classmethod
+    def record_send(cls, letter_path: str, userid: str, sent_at: float) -> None:
+        """
+        remember when a letter was sent, so the first scan can stop there,
+        and from which account, whose mailbox gets the bounce-backs
+        """
+        state_path = Path(letter_path) / BOUNCE_STATE_FILE
+        state = cls.__read_state(state_path)
+        state["userids"] = sorted(set(cls.__userids(state)) | {userid})
+        state.pop("userid", None)
+        state["sent_at"] = min(sent_at, state.get("sent_at", sent_at))
+        cls.__write_state(state_path, state)
+
+    @classmethod
+    def senders(cls, letter_path: str) -> List[str]:
+        """user ids of every account the letter was sent from"""
+        return cls.__userids(cls.__read_state(Path(letter_path) / BOUNCE_STATE_FILE))
+
+    @staticmethod
+    def __userids(state: dict) -> List[str]:
+        # letters sent before several accounts were recorded keep one userid
+        if "userid" in state:
+            return [state["userid"]]
+        return list(state.get("userids", []))
+
+    @property
+    def mailbox(self) -> str:
+        host, _ = endpoint(self.config, "pop3")
+        return f"{self.userid}@{host}"
+
+    @property
+    def sent_at(self) -> float:
+        return self.__read_state(self.state_path).get("sent_at")
+
+    def connect(self) -> poplib.POP3_SSL:
+        host, port = endpoint(self.config, "pop3")
+        pop3_class = poplib.POP3_SSL if self.config["pop3"]["ssl"] else poplib.POP3
+        pop3 = pop3_class(
+            host=host,
+            port=port,
+            timeout=self.config["pop3"]["timeout"],
+        )
+        pop3.user(self.userid)
+        pop3.pass_(self.password)
+        return pop3
+
+    def scan(self, since: float = None) -> List[Message]:
+        """
+        return the bounce-backs among messages that were not scanned before,
+        when the mailbox was never scanned, messages dated before `since`
+        (a timestamp) are skipped, messages arrive in order so the scan stops
+        at the first one
+        """
+        with metrics.timer("bounce_scan_seconds"):
+            return self.__scan(since)
+
+    def __scan(self, since: float = None) -> List[Message]:
+        state = self.__read_state(self.state_path)
+        mailboxes = state.setdefault("mailboxes", {})
+        first_scan = self.mailbox not in mailboxes
+        seen = set(mailboxes.get(self.mailbox, []))
+
+        pop3 = self.connect()
+        logging.info("Connected to POP3 server")
+        try:
+            _, listing, _ = pop3.uidl()
+            messages = []
+            for line in listing:
+                number, uid = line.decode("ascii", errors="replace").split(None, 1)
+                messages.append((int(number), uid))
+
+            new_messages = [(n, uid) for n, uid in messages if uid not in seen]
+            logging.info(f"Scanning {len(new_messages)} new messages for bounces")
+
+            bounces = []
+            # newest first, so the first scan can stop at the send time
+            for number, uid in reversed(new_messages):
+                _, header_lines, _ = pop3.top(number, 0)
+                headers = self.parser.parsebytes(
+                    b"\r\n".join(header_lines), headersonly=True
+                )
+                if (
+                    first_scan
+                    and since is not None
+                    and message_time(headers) < since - CLOCK_SKEW
+                ):
+                    break
+                if looks_like_dsn(headers):
+                    _, lines, _ = pop3.retr(number)
+                    bounces.append(self.parser.parsebytes(b"\r\n".join(lines)))
+        finally:
+            try:
+                pop3.quit()
+            except Exception:
+                pass
+
+        # older messages are never scanned, messages deleted from the mailbox
+        # are forgotten
+        mailboxes[self.mailbox] = sorted(uid for _, uid in messages)
+        self.__write_state(self.state_path, state)
+
+        return bounces
+
+    def resolve(self, bounces: Iterable[Message], index: MessageIndex) -> List[Bounce]:
+        """
+        resolve every bounce-back to the recipient row of the failed email,
+        a failure of a recipient takes precedence over its delays
+        """
+        resolved = {}
+
+        def add(bounce: Bounce) -> None:
+            key = (bounce.row, bounce.email)
+            if key not in resolved or (resolved[key].delayed and not bounce.delayed):
+                resolved[key] = bounce
+
+        for bounce in bounces:
+            token, recipients = parse_dsn(bounce)
+            entry = index.lookup(token) if token is not None else None
+
+            if entry is not None:
+                row, email = entry
+                if len(recipients) == 0:
+                    recipients = [(email, None, None, False)]
+                for address, status, diagnostic, delayed in recipients:
+                    add(
+                        Bounce(
+                            row,
+                            address,
+                            status,
+                            diagnostic,
+                            recipient=email,
+                            delayed=delayed,
+                        )
+                    )
+                continue
+
+            # not one of our tokens, fall back to the failed addresses
+            for address, status, diagnostic, delayed in recipients:
+                row = index.row_of(address)
+                if row is not None:
+                    add(Bounce(row, address, status, diagnostic, delayed=delayed))
+
+        metrics.inc("bounces_total", sum(1 for b in resolved.values() if not b.delayed))
+        return list(resolved.values())
+
+    @staticmethod
+    def __read_state(state_path: Path) -> dict:
+        try:
+            state = json.loads(state_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    @staticmethod
+    def __write_state(state_path: Path, state: dict) -> None:
+        try:
+            state_path.write_text(json.dumps(state), encoding="utf-8")
+        except OSError as e:
+            logging.error(e)
+            logging.error(f"Failed to save bounce checking state to {state_path}")
+
+
+def record_bounces(
+    journal: SendJournal,
+    bounces: Iterable[Bounce],
+    suppressions: SuppressionList = None,
+) -> None:
+    """
+    mark the rows of bounced emails in the send journal, and add their
+    addresses to `suppressions`, delays are left out, the server is still
+    trying and the email may yet be delivered
+    """
+    for bounce in bounces:
+        if bounce.delayed:
+            continue
+        journal.record(
+            bounce.row,
+            bounce.recipient,
+            BOUNCED,
+            address=bounce.email,
+            dsn_status=bounce.status,
+            diagnostic=bounce.diagnostic,
+        )
+        if suppressions is not None:
+            suppressions.add(
+                bounce.email,
+                REASON_BOUNCED,
+                detail=bounce.status or bounce.diagnostic,
+                source=str(journal.path.parent),
+            )
@@ -0,0 +1,88 @@
+import csv
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import List
+
+__all__ = ["DeadLetters"]
+
+DEAD_LETTERS_FILE = "dead-letters.csv"
+
+
+class DeadLetters:
+    """
+    recipients whose emails failed permanently or ran out of retries,
+    stored as recipients.csv rows prefixed with their row number and the error,
+    so they can be re-sent later with `send --dead-letters`
+    """
+
+    path: Path = None
+    fieldnames: List[str] = None
+
+    def __init__(self, path: str, fieldnames: List[str]) -> None:
+        self.path = Path(path)
+        self.fieldnames = ["row", "error", *fieldnames]
+        self.__lock = threading.Lock()
+        # row -> record
+        self.__records = {}
+        self.load()
+
+    @classmethod
+    def for_letter(cls, letter) -> "DeadLetters":
+        return cls(
+            Path(letter.paths["recipients"]).parent / DEAD_LETTERS_FILE,
+            list(letter.csv[0].keys()),
+        )
+
+    def load(self) -> None:
+        self.__records = {}
+        if not self.path.is_file():
+            return
+
+        with open(self.path, encoding="utf-8", newline="") as f:
+            for record in csv.DictReader(f):
+                try:
+                    self.__records[int(record["row"])] = record
+                except (KeyError, TypeError, ValueError):
+                    logging.warning(f"Skipping corrupted dead letter: {record}")
+
+    @property
+    def rows(self) -> set:
+        return set(self.__records.keys())
+
+    def __len__(self) -> int:
+        return len(self.__records)
+
+    def add(self, row: int, recipient: dict, error: Exception) -> None:
+        """record a dead letter, it is appended to the file right away"""
+        record = {"row": row, "error": str(error), **recipient}
+        with self.__lock:
+            self.__records[row] = record
+            is_new = not self.path.is_file()
+            with open(self.path, "a", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, self.fieldnames, extrasaction="ignore")
+                if is_new:
+                    writer.writeheader()
+                writer.writerow(record)
+
+    def resolve(self, row: int) -> None:
+        """the email of a dead letter was delivered after all"""
+        with self.__lock:
+            self.__records.pop(row, None)
+
+    def save(self) -> None:
+        """rewrite the file with the remaining dead letters only"""
+        with self.__lock:
+            if len(self.__records) == 0:
+                if self.path.is_file():
+                    self.path.unlink()
+                return
+
+            temp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(temp_path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, self.fieldnames, extrasaction="ignore")
+                writer.writeheader()
+                for row in sorted(self.__records):
+                    writer.writerow(self.__records[row])
+            os.replace(temp_path, self.path)
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from email_validator import (
+    EmailUndeliverableError,
+    caching_resolver,
+    validate_email_deliverability,
+)
+
+from .globals import *
+
+__all__ = ["DomainCache", "check_domains"]
+
+DOMAIN_CACHE_PATH = APP_DIR / "domain-cache.json"
+
+# how long the deliverability of a domain is trusted, in seconds
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DNS_TIMEOUT = 15
+DNS_WORKERS = 8
+
+
+class DomainCache:
+    """
+    deliverability of email domains, kept on disk so the same domains are not
+    resolved on every run, entries expire after `ttl` seconds
+    """
+
+    path: Path = None
+    ttl: float = DEFAULT_TTL
+
+    def __init__(self, path: str = DOMAIN_CACHE_PATH, ttl: float = DEFAULT_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        # domain -> {"error": str or None, "checked_at": timestamp}
+        self.__entries = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            entries = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+
+        self.__entries = {
+            domain: entry
+            for domain, entry in entries.items()
+            if isinstance(entry, dict) and self.__is_fresh(entry)
+        }
+
+    def __is_fresh(self, entry: dict) -> bool:
+        try:
+            return time.time() - float(entry["checked_at"]) < self.ttl
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __contains__(self, domain: str) -> bool:
+        with self.__lock:
+            entry = self.__entries.get(domain)
+            return entry is not None and self.__is_fresh(entry)
+
+    def get(self, domain: str) -> Optional[str]:
+        """the reason a cached domain is undeliverable, None if it is deliverable"""
+        with self.__lock:
+            return self.__entries[domain]["error"]
+
+    def put(self, domain: str, error: str = None) -> None:
+        with self.__lock:
+            self.__entries[domain] = {"error": error, "checked_at": time.time()}
+
+    def save(self) -> None:
+        with self.__lock:
+            entries = {
+                domain: entry
+                for domain, entry in self.__entries.items()
+                if self.__is_fresh(entry)
+            }
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(json.dumps(entries), encoding="utf-8")
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error(e)
+            logging.error(f"Failed to save domain cache to {self.path}")
+
+
+def check_domain(domain: str, resolver) -> Optional[str]:
+    """
+    returns the reason mail cannot be delivered to `domain`, None if it can,
+    raises TimeoutError if the resolver timed out
+    """
+    try:
+        result = validate_email_deliverability(
+            domain, domain, timeout=DNS_TIMEOUT, dns_resolver=resolver
+        )
+    except EmailUndeliverableError as e:
+        return str(e)
+    if "unknown-deliverability" in result:
+        raise TimeoutError(f"DNS lookup of {domain} timed out")
+    return None
+
+
+def check_domains(
+    domains: Iterable[str],
+    *,
+    cache: DomainCache = None,
+    resolver=None,
+    workers: int = DNS_WORKERS,
+) -> Dict[str, Optional[str]]:
+    """
+    check the deliverability of every distinct domain, domains missing from
+    the cache are resolved concurrently and added to it
+
+    returns {domain: reason it is undeliverable, or None}
+    """
+    domains = set(domains)
+    results = {}
+    unknown = []
+    for domain in domains:
+        if cache is not None and domain in cache:
+            results[domain] = cache.get(domain)
+        else:
+            unknown.append(domain)
+
+    if len(unknown) == 0:
+        return results
+
+    if resolver is None:
+        resolver = caching_resolver(timeout=DNS_TIMEOUT)
+
+    logging.info(f"Resolving {len(unknown)} email domains")
+    with ThreadPoolExecutor(max_workers=min(workers, len(unknown))) as executor:
+        futures = {
+            domain: executor.submit(check_domain, domain, resolver)
+            for domain in unknown
+        }
+        for domain, future in futures.items():
+            try:
+                results[domain] = future.result()
+            except TimeoutError as e:
+                # not worth failing over, and not worth remembering
+                logging.warning(e)
+                results[domain] = None
+                continue
+            if cache is not None:
+                cache.put(domain, results[domain])
+
+    if cache is not None:
+        cache.save()
+
+    return results
@@ -0,0 +1,332 @@
+import os
+import re
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parseaddr
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+from .MessageSkeleton import Email
+
+__all__ = [
+    "FORMATS",
+    "EmlExporter",
+    "MaildirExporter",
+    "MboxExporter",
+    "ExportedEmails",
+    "create_exporter",
+    "envelopes_path",
+]
+
+FORMATS = ("eml", "maildir", "mbox")
+
+# where each exported email is and its SMTP envelope, one line per email:
+# file, offset, length, token, envelope sender, space separated recipients
+ENVELOPES_FILE = "envelopes.tsv"
+
+# mbox files and the envelopes are written in chunks of this size
+WRITE_BUFFER = 1 << 20
+# emails handed to the writer threads ahead of the slowest write
+WRITES_PER_THREAD = 4
+
+CRLF = b"\r\n"
+LF = b"\n"
+
+# mboxrd quoting, `From ` at the start of a line would start a new message
+from_line_re = re.compile(rb"^(>*From )", re.MULTILINE)
+quoted_from_line_re = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+def envelopes_path(path: str) -> Path:
+    """the envelopes of an export, inside the directory or beside the mbox"""
+    path = Path(path)
+    if path.is_dir():
+        return path / ENVELOPES_FILE
+    return path.with_name(f"{path.name}.{ENVELOPES_FILE}")
+
+
+class Exporter(ABC):
+    """
+    writes rendered emails to `path`, one at a time and in order, along with
+    the envelopes needed to send them again, see ExportedEmails
+
+    emails are SMTP-ready, with CRLF line endings, exporters of formats stored
+    with LF line endings convert them, the attachments part shared by every
+    email (`tail`) is converted only once
+    """
+
+    path: Path = None
+    # the bytes every email ends with, the attachments of the letter
+    tail: bytes = b""
+    count: int = 0
+
+    def __init__(self, path: str, tail: bytes = b"") -> None:
+        self.path = Path(path)
+        self.tail = tail
+        self.count = 0
+        self.__envelopes = None
+
+    def open(self) -> None:
+        self.__envelopes = open(
+            envelopes_path(self.path), "w", encoding="utf-8", buffering=WRITE_BUFFER
+        )
+
+    def close(self) -> None:
+        if self.__envelopes is not None:
+            self.__envelopes.close()
+            self.__envelopes = None
+
+    def __enter__(self) -> "Exporter":
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def export(self, emails: Iterable[Email]) -> int:
+        """write every email, returns how many were written"""
+        for email in emails:
+            self.write(email)
+        return self.count
+
+    @abstractmethod
+    def write(self, email: Email) -> None:
+        """write one email and record it"""
+
+    def record(self, file: str, offset: int, length: int, email: Email) -> None:
+        """remember where the email is and its envelope"""
+        self.count += 1
+        self.__envelopes.write(
+            f"{file}\t{offset}\t{length}\t{email.token or ''}\t"
+            f"{email.envelope_from or ''}\t{' '.join(email.recipients)}\n"
+        )
+
+    def chunks(self, data: bytes) -> List[bytes]:
+        """the email as written to disk, in chunks to spare copying the tail"""
+        return [data]
+
+
+class LFExporter(Exporter):
+    """an exporter of a format stored with LF line endings"""
+
+    def __init__(self, path: str, tail: bytes = b"") -> None:
+        super().__init__(path, tail)
+        self.__tail = self.convert(tail)
+
+    def convert(self, data: bytes) -> bytes:
+        return data.replace(CRLF, LF)
+
+    def chunks(self, data: bytes) -> List[bytes]:
+        if len(self.tail) > 0 and data.endswith(self.tail):
+            return [self.convert(data[: -len(self.tail)]), self.__tail]
+        return [self.convert(data)]
+
+
+class FileExporter(Exporter):
+    """
+    writes every email to a file of its own with a pool of threads, so the
+    many small writes and renames overlap, at most WRITES_PER_THREAD emails
+    per thread wait to be written
+    """
+
+    writers: int = 4
+
+    def __init__(self, *args, writers: int = 4, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.writers = writers
+        self.__pool = None
+        self.__pending = deque()
+
+    def open(self) -> None:
+        super().open()
+        self.__pool = ThreadPoolExecutor(max_workers=self.writers)
+
+    def close(self) -> None:
+        if self.__pool is not None:
+            try:
+                while len(self.__pending) > 0:
+                    self.__pending.popleft().result()
+            finally:
+                self.__pool.shutdown()
+                self.__pool = None
+        super().close()
+
+    def write(self, email: Email) -> None:
+        name = self.file_name(self.count, email)
+        chunks = self.chunks(email.data)
+        self.__pending.append(self.__pool.submit(self.write_file, name, chunks))
+        self.record(name, 0, sum(len(chunk) for chunk in chunks), email)
+
+        while len(self.__pending) >= WRITES_PER_THREAD * self.writers:
+            # raises the error of a failed write
+            self.__pending.popleft().result()
+
+    @abstractmethod
+    def file_name(self, index: int, email: Email) -> str:
+        """the file of the `index`-th email, relative to `path`"""
+
+    def write_file(self, name: str, chunks: List[bytes]) -> None:
+        with open(self.path / name, "wb") as f:
+            f.writelines(chunks)
+
+
+class EmlExporter(FileExporter):
+    """a directory of .eml files, byte for byte what would be sent"""
+
+    def open(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        super().open()
+
+    def file_name(self, index: int, email: Email) -> str:
+        return f"{index + 1:06d}.eml"
+
+
+class MaildirExporter(FileExporter, LFExporter):
+    """
+    a Maildir, every email is written to tmp/ and moved to new/ once
+    complete, as a mail delivery agent would
+    """
+
+    def open(self) -> None:
+        for subdir in ("tmp", "new", "cur"):
+            (self.path / subdir).mkdir(parents=True, exist_ok=True)
+        # unique names, see https://cr.yp.to/proto/maildir.html
+        host = socket.gethostname().replace("/", r"\057").replace(":", r"\072")
+        self.__unique = f"{int(time.time())}.P{os.getpid()}Q{{}}.{host}"
+        super().open()
+
+    def file_name(self, index: int, email: Email) -> str:
+        return f"new/{self.__unique.format(index + 1)}"
+
+    def write_file(self, name: str, chunks: List[bytes]) -> None:
+        temp_path = self.path / "tmp" / Path(name).name
+        with open(temp_path, "wb") as f:
+            f.writelines(chunks)
+        os.replace(temp_path, self.path / name)
+
+
+class MboxExporter(LFExporter):
+    """
+    one mbox file, mboxrd flavor, written sequentially through a large
+    buffer, the offset of every email is recorded so it can be read back
+    without parsing the file
+    """
+
+    def __init__(self, path: str, tail: bytes = b"") -> None:
+        super().__init__(path, tail)
+        self.__file = None
+        self.__offset = 0
+
+    def open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.__file = open(self.path, "wb", buffering=WRITE_BUFFER)
+        self.__offset = 0
+        super().open()
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        super().close()
+
+    def convert(self, data: bytes) -> bytes:
+        return from_line_re.sub(rb">\1", super().convert(data))
+
+    def write(self, email: Email) -> None:
+        sender = parseaddr(email.envelope_from or "")[1] or "MAILER-DAEMON"
+        from_line = f"From {sender} {time.asctime()}\n".encode("ascii", "replace")
+        chunks = self.chunks(email.data)
+        length = sum(len(chunk) for chunk in chunks)
+
+        self.__file.write(from_line)
+        self.__file.writelines(chunks)
+        # a blank line ends every message
+        self.__file.write(LF if chunks[-1].endswith(LF) else LF + LF)
+
+        offset = self.__offset + len(from_line)
+        self.record(self.path.name, offset, length, email)
+        self.__offset = self.__file.tell()
+
+
+def create_exporter(
+    path: str, export_format: str, tail: bytes = b"", writers: int = 4
+) -> Exporter:
+    if export_format == "eml":
+        return EmlExporter(path, tail, writers=writers)
+    if export_format == "maildir":
+        return MaildirExporter(path, tail, writers=writers)
+    if export_format == "mbox":
+        return MboxExporter(path, tail)
+    raise ValueError(f"unknown export format: {export_format}")
+
+
+class ExportedEmails:
+    """
+    the emails of an export, read back one at a time with CRLF line endings,
+    to be sent as they were exported, e.g. by load-test --fixture
+    """
+
+    path: Path = None
+    export_format: str = None
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        if self.path.is_dir():
+            is_maildir = (self.path / "new").is_dir() and (self.path / "cur").is_dir()
+            self.export_format = "maildir" if is_maildir else "eml"
+        else:
+            self.export_format = "mbox"
+        self.envelopes_path = envelopes_path(self.path)
+        if not self.envelopes_path.is_file():
+            raise FileNotFoundError(f"{self.envelopes_path} not found")
+
+    def __envelopes(self) -> Iterator[Tuple[str, int, int, str, str, List[str]]]:
+        with open(self.envelopes_path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                file, offset, length, token, envelope_from, recipients = fields
+                yield (
+                    file,
+                    int(offset),
+                    int(length),
+                    token,
+                    envelope_from,
+                    recipients.split(" "),
+                )
+
+    def __len__(self) -> int:
+        """recipients of every email"""
+        return sum(len(envelope[-1]) for envelope in self.__envelopes())
+
+    def __iter__(self) -> Iterator[Email]:
+        directory = self.path if self.path.is_dir() else self.path.parent
+        mbox = open(self.path, "rb") if self.export_format == "mbox" else None
+        try:
+            for i, envelope in enumerate(self.__envelopes()):
+                file, offset, length, token, envelope_from, recipients = envelope
+                if mbox is not None:
+                    mbox.seek(offset)
+                    data = mbox.read(length)
+                    data = quoted_from_line_re.sub(rb"\1", data)
+                else:
+                    data = (directory / file).read_bytes()
+                if self.export_format != "eml":
+                    data = data.replace(LF, CRLF)
+
+                yield Email(
+                    envelope_from or None,
+                    recipients,
+                    [],
+                    [],
+                    data,
+                    row=i,
+                    token=token or None,
+                    envelope_from=envelope_from or None,
+                    batch=[(i, recipient, token) for recipient in recipients],
+                )
+        finally:
+            if mbox is not None:
+                mbox.close()
@@ -0,0 +1,548 @@
+import base64
+import logging
+import random
+import re
+import secrets
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from email import policy as email_policy
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from pathlib import Path
+from typing import List, Tuple
+
+from .globals import *
+from .RateLimiter import TokenBucket
+
+__all__ = ["FAKE_HOST", "FakeServers", "FakeMailbox", "start_fake_servers"]
+
+FAKE_HOST = "127.0.0.1"
+MAX_LINE = 64 * 1024
+
+# the address in `MAIL FROM:<address> SIZE=...` and `RCPT TO:<address>`
+path_re = re.compile(r":\s*<?([^<>\s]*)>?")
+
+# the servers started by start_fake_servers, one set per process
+running_servers = None
+running_lock = threading.Lock()
+
+# the self-signed certificate of the servers, made when the first one with
+# TLS starts, removed when the process exits
+cert_dir = None
+cert_lock = threading.Lock()
+
+
+def self_signed_cert() -> Tuple[Path, Path]:
+    """(certificate, key) for localhost, made with the openssl command on first use"""
+    global cert_dir
+    with cert_lock:
+        if cert_dir is None:
+            directory = tempfile.TemporaryDirectory(prefix="ntuee-mailer-")
+            root = Path(directory.name)
+            try:
+                subprocess.run(
+                    [
+                        "openssl",
+                        "req",
+                        "-x509",
+                        "-newkey",
+                        "ec",
+                        "-pkeyopt",
+                        "ec_paramgen_curve:prime256v1",
+                        "-nodes",
+                        "-keyout",
+                        str(root / "key.pem"),
+                        "-out",
+                        str(root / "cert.pem"),
+                        "-days",
+                        "1",
+                        "-subj",
+                        f"/CN={FAKE_HOST}",
+                    ],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    check=True,
+                )
+            except (OSError, subprocess.CalledProcessError) as e:
+                directory.cleanup()
+                raise RuntimeError(
+                    "the fake servers need the openssl command for their TLS "
+                    "certificate, or set ssl = false in [smtp] and [pop3]"
+                ) from e
+            cert_dir = directory
+        root = Path(cert_dir.name)
+        return root / "cert.pem", root / "key.pem"
+
+
+class FakeMailbox:
+    """the inbox of the account, where bounce-backs end up"""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        # (uid, message)
+        self.__messages = []
+
+    def add(self, message: bytes) -> None:
+        with self.__lock:
+            self.__messages.append((secrets.token_hex(8), message))
+
+    def messages(self) -> List[Tuple[str, bytes]]:
+        with self.__lock:
+            return list(self.__messages)
+
+    def delete(self, uids: set) -> None:
+        with self.__lock:
+            self.__messages = [m for m in self.__messages if m[0] not in uids]
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__messages)
+
+
+class FakeOptions:
+    """behaviour of the fake servers, the [fake] section of config.ini"""
+
+    latency: float = 0
+    rate: float = 0
+    burst: int = 10
+    error_rate: float = 0
+    error_code: int = 451
+    reject_rate: float = 0
+    reject_pattern: str = ""
+    reject_code: int = 550
+    # reply 354 to DATA without accepted recipients, as some servers do
+    lenient_data: bool = False
+    disconnect_rate: float = 0
+    bounce_rate: float = 0
+    bounce_pattern: str = ""
+    seed: int = None
+
+    def __init__(self, **options) -> None:
+        for key, value in options.items():
+            if hasattr(type(self), key):
+                setattr(self, key, value)
+        self.random = random.Random(self.seed)
+        self.random_lock = threading.Lock()
+        self.bounce_re = (
+            re.compile(self.bounce_pattern) if self.bounce_pattern else None
+        )
+        self.reject_re = (
+            re.compile(self.reject_pattern) if self.reject_pattern else None
+        )
+
+    def chance(self, probability: float) -> bool:
+        if probability <= 0:
+            return False
+        with self.random_lock:
+            return self.random.random() < probability
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+def make_dsn(envelope_from: str, recipient: str, original_headers: bytes) -> bytes:
+    """a delivery status notification for an email that could not be delivered"""
+    report = MIMEMultipart("report", report_type="delivery-status")
+    report["From"] = "Mail Delivery System <MAILER-DAEMON@localhost>"
+    report["To"] = envelope_from
+    report["Subject"] = "Undelivered Mail Returned to Sender"
+    report["Date"] = formatdate(localtime=True)
+    report["Message-ID"] = make_msgid(domain="localhost")
+
+    report.attach(
+        MIMEText(f"Your message could not be delivered to {recipient}.\n", "plain")
+    )
+
+    per_message = Message()
+    per_message["Reporting-MTA"] = "dns; localhost"
+    per_message["Arrival-Date"] = formatdate(localtime=True)
+    per_recipient = Message()
+    per_recipient["Final-Recipient"] = f"rfc822; {recipient}"
+    per_recipient["Action"] = "failed"
+    per_recipient["Status"] = "5.1.1"
+    per_recipient["Diagnostic-Code"] = "smtp; 550 5.1.1 user unknown"
+    status = MIMEBase("message", "delivery-status")
+    status.set_payload([per_message, per_recipient])
+    report.attach(status)
+
+    headers = MIMEBase("text", "rfc822-headers")
+    headers.set_payload(original_headers.decode("ascii", errors="replace"))
+    report.attach(headers)
+
+    return report.as_bytes(policy=email_policy.SMTP)
+
+
+class FakeHandler(socketserver.StreamRequestHandler):
+    # pipelined commands get their replies in separate small writes, with
+    # nagle on each of them waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        if self.server.context is not None:
+            self.request = self.server.context.wrap_socket(
+                self.request, server_side=True
+            )
+        super().setup()
+
+    def readline(self) -> str:
+        line = self.rfile.readline(MAX_LINE)
+        if not line:
+            raise ConnectionError("client disconnected")
+        return line.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def write(self, *lines: str) -> None:
+        self.wfile.write("".join(line + "\r\n" for line in lines).encode("utf-8"))
+
+    def handle(self) -> None:
+        try:
+            self.session()
+        except (ConnectionError, ssl.SSLError, OSError):
+            pass
+
+    def finish(self) -> None:
+        try:
+            super().finish()
+        except OSError:
+            pass
+        # the server only closes the socket it accepted, not the TLS wrapper
+        self.request.close()
+
+
+class FakeSMTPHandler(FakeHandler):
+    """
+    accepts any login, delivers nothing, replies to MAIL, RCPT and DATA after
+    `latency` seconds, with injected errors, disconnects and rate limits
+    """
+
+    def reply(self, code: int, text: str) -> None:
+        self.write(f"{code} {text}")
+
+    @staticmethod
+    def path(argument: str) -> str:
+        match = path_re.search(argument)
+        return match.group(1) if match is not None else ""
+
+    def session(self) -> None:
+        options = self.server.options
+        stats = self.server.stats
+        bucket = None
+        if options.rate > 0:
+            bucket = TokenBucket(options.burst, options.rate)
+
+        stats.add("connections")
+        self.reply(220, "localhost ESMTP fake server ready")
+        mail_from = None
+        rcpt_to = []
+
+        while True:
+            command, _, argument = self.readline().partition(" ")
+            command = command.upper()
+
+            if command == "EHLO":
+                self.write(
+                    "250-localhost",
+                    "250-AUTH LOGIN PLAIN",
+                    "250-PIPELINING",
+                    "250-8BITMIME",
+                    "250 SIZE 52428800",
+                )
+            elif command == "HELO":
+                self.reply(250, "localhost")
+            elif command == "AUTH":
+                self.authenticate(argument)
+            elif command == "MAIL":
+                options.delay()
+                if bucket is not None:
+                    bucket.refill(time.monotonic())
+                if bucket is not None and bucket.wait_time() > 0:
+                    stats.add("throttled")
+                    self.reply(451, "4.7.0 too many messages, slow down")
+                    continue
+                if options.chance(options.error_rate):
+                    stats.add("errors")
+                    self.reply(options.error_code, "4.3.0 injected temporary failure")
+                    continue
+                if bucket is not None:
+                    bucket.tokens -= 1
+                mail_from = self.path(argument)
+                rcpt_to = []
+                self.reply(250, "2.1.0 ok")
+            elif command == "RCPT":
+                options.delay()
+                if mail_from is None:
+                    self.reply(503, "5.5.1 need MAIL first")
+                elif options.reject_re is not None and options.reject_re.search(
+                    self.path(argument)
+                ):
+                    stats.add("rejected")
+                    if options.reject_code == 421:
+                        # the server goes away, the commands after it are lost
+                        self.reply(421, "4.3.2 service shutting down")
+                        return
+                    self.reply(options.reject_code, "recipient rejected")
+                elif options.chance(options.reject_rate):
+                    stats.add("rejected")
+                    self.reply(550, "5.1.1 injected permanent failure")
+                else:
+                    rcpt_to.append(self.path(argument))
+                    self.reply(250, "2.1.5 ok")
+            elif command == "DATA":
+                if len(rcpt_to) == 0 and not options.lenient_data:
+                    self.reply(503, "5.5.1 need RCPT first")
+                    continue
+                self.reply(354, "end data with <CR><LF>.<CR><LF>")
+                data = self.read_data()
+                if len(rcpt_to) == 0:
+                    stats.add("empty_transactions")
+                    mail_from = None
+                    self.reply(554, "5.5.1 no valid recipients")
+                    continue
+                options.delay()
+                if options.chance(options.disconnect_rate):
+                    stats.add("disconnects")
+                    return
+                self.deliver(mail_from, rcpt_to, data)
+                mail_from, rcpt_to = None, []
+                self.reply(250, "2.0.0 ok queued")
+            elif command == "RSET":
+                mail_from, rcpt_to = None, []
+                self.reply(250, "2.0.0 ok")
+            elif command == "NOOP":
+                self.reply(250, "2.0.0 ok")
+            elif command == "QUIT":
+                self.reply(221, "2.0.0 bye")
+                return
+            else:
+                self.reply(502, "5.5.2 command not implemented")
+
+    def authenticate(self, argument: str) -> None:
+        mechanism, _, initial = argument.partition(" ")
+        mechanism = mechanism.upper()
+        if mechanism == "PLAIN":
+            if initial == "":
+                self.write("334 ")
+                self.readline()
+        elif mechanism == "LOGIN":
+            if initial == "":
+                self.write("334 " + base64.b64encode(b"Username:").decode())
+                self.readline()
+            self.write("334 " + base64.b64encode(b"Password:").decode())
+            self.readline()
+        else:
+            self.reply(504, "5.5.4 unrecognized authentication type")
+            return
+        self.reply(235, "2.7.0 authentication successful")
+
+    def read_data(self) -> bytes:
+        lines = []
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line:
+                raise ConnectionError("client disconnected")
+            if line == b".\r\n":
+                return b"".join(lines)
+            lines.append(line[1:] if line.startswith(b".") else line)
+
+    def deliver(self, mail_from: str, rcpt_to: List[str], data: bytes) -> None:
+        options = self.server.options
+        stats = self.server.stats
+        stats.add("messages")
+        stats.add("bytes", len(data))
+
+        for recipient in rcpt_to:
+            bounced = (
+                options.bounce_re is not None and options.bounce_re.search(recipient)
+            ) or options.chance(options.bounce_rate)
+            if bounced:
+                stats.add("bounces")
+                original_headers = data.split(b"\r\n\r\n", 1)[0] + b"\r\n"
+                self.server.mailbox.add(
+                    make_dsn(mail_from, recipient, original_headers)
+                )
+
+
+class FakePOP3Handler(FakeHandler):
+    """serves the fake mailbox, accepts any login"""
+
+    def session(self) -> None:
+        self.write("+OK fake POP3 server ready")
+        messages = self.server.mailbox.messages()
+        deleted = set()
+
+        def message(argument: str):
+            try:
+                index = int(argument.split()[0]) - 1
+            except (ValueError, IndexError):
+                return None
+            if 0 <= index < len(messages) and messages[index][0] not in deleted:
+                return index
+            return None
+
+        while True:
+            command, _, argument = self.readline().partition(" ")
+            command = command.upper()
+            self.server.options.delay()
+
+            if command in ("USER", "PASS", "NOOP"):
+                self.write("+OK")
+            elif command == "CAPA":
+                self.write("+OK", "TOP", "UIDL", "USER", ".")
+            elif command == "STAT":
+                alive = [m for m in messages if m[0] not in deleted]
+                self.write(f"+OK {len(alive)} {sum(len(m[1]) for m in alive)}")
+            elif command in ("LIST", "UIDL"):
+                value = (lambda m: len(m[1])) if command == "LIST" else (lambda m: m[0])
+                if argument.strip() != "":
+                    index = message(argument)
+                    if index is None:
+                        self.write("-ERR no such message")
+                    else:
+                        self.write(f"+OK {index + 1} {value(messages[index])}")
+                    continue
+                self.write(
+                    "+OK",
+                    *(
+                        f"{i + 1} {value(m)}"
+                        for i, m in enumerate(messages)
+                        if m[0] not in deleted
+                    ),
+                    ".",
+                )
+            elif command in ("RETR", "TOP"):
+                index = message(argument)
+                if index is None:
+                    self.write("-ERR no such message")
+                    continue
+                data = messages[index][1]
+                if command == "TOP":
+                    head, _, body = data.partition(b"\r\n\r\n")
+                    count = int(argument.split()[1]) if len(argument.split()) > 1 else 0
+                    data = (
+                        head + b"\r\n\r\n" + b"\r\n".join(body.split(b"\r\n")[:count])
+                    )
+                self.write("+OK")
+                self.wfile.write(
+                    b"".join(
+                        (b"." + line if line.startswith(b".") else line) + b"\r\n"
+                        for line in data.rstrip(b"\r\n").split(b"\r\n")
+                    )
+                    + b".\r\n"
+                )
+            elif command == "DELE":
+                index = message(argument)
+                if index is None:
+                    self.write("-ERR no such message")
+                else:
+                    deleted.add(messages[index][0])
+                    self.write("+OK")
+            elif command == "RSET":
+                deleted.clear()
+                self.write("+OK")
+            elif command == "QUIT":
+                self.server.mailbox.delete(deleted)
+                self.write("+OK bye")
+                return
+            else:
+                self.write("-ERR command not implemented")
+
+
+class FakeStats:
+    """counters of a fake server"""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__counts = {}
+
+    def add(self, name: str, value: int = 1) -> None:
+        with self.__lock:
+            self.__counts[name] = self.__counts.get(name, 0) + value
+
+    def __getitem__(self, name: str) -> int:
+        with self.__lock:
+            return self.__counts.get(name, 0)
+
+    def as_dict(self) -> dict:
+        with self.__lock:
+            return dict(self.__counts)
+
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        port: int,
+        handler,
+        *,
+        options: FakeOptions,
+        mailbox: FakeMailbox,
+        tls: bool,
+    ) -> None:
+        self.options = options
+        self.mailbox = mailbox
+        self.stats = FakeStats()
+        self.context = None
+        if tls:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(*self_signed_cert())
+        super().__init__((FAKE_HOST, port), handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class FakeServers:
+    """a fake SMTP server and a fake POP3 server sharing one mailbox"""
+
+    smtp: FakeServer = None
+    pop3: FakeServer = None
+    mailbox: FakeMailbox = None
+
+    def __init__(self, config: dict) -> None:
+        fake = config.get("fake", {})
+        options = FakeOptions(**fake)
+        self.mailbox = FakeMailbox()
+        self.smtp = FakeServer(
+            fake.get("smtp_port", 0),
+            FakeSMTPHandler,
+            options=options,
+            mailbox=self.mailbox,
+            tls=config["smtp"].get("ssl", True),
+        )
+        self.pop3 = FakeServer(
+            fake.get("pop3_port", 0),
+            FakePOP3Handler,
+            options=options,
+            mailbox=self.mailbox,
+            tls=config["pop3"].get("ssl", True),
+        )
+        logging.info(
+            f"Fake SMTP server listening on {FAKE_HOST}:{self.smtp.port}, "
+            f"fake POP3 server on {FAKE_HOST}:{self.pop3.port}"
+        )
+
+    def shutdown(self) -> None:
+        for server in (self.smtp, self.pop3):
+            server.shutdown()
+            server.server_close()
+
+
+def start_fake_servers(config: dict) -> FakeServers:
+    """start the fake servers described by config if they are not running yet"""
+    global running_servers
+    with running_lock:
+        if running_servers is None:
+            running_servers = FakeServers(config)
+        return running_servers
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+__all__ = ["SendJournal", "SENT", "FAILED", "BOUNCED"]
+
+JOURNAL_FILE = "send-journal.jsonl"
+
+SENT = "sent"
+FAILED = "failed"
+# accepted by the server, but bounced back later
+BOUNCED = "bounced"
+
+
+class SendJournal:
+    """
+    append-only record of the outcome of every email of a letter,
+    each record is flushed and fsync'd before the next email is sent,
+    so a crashed campaign can be resumed where it stopped
+    """
+
+    path: Path = None
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.__lock = threading.Lock()
+        self.__file = None
+        # (row, email) -> latest status
+        self.__status = {}
+        self.load()
+
+    @classmethod
+    def for_letter(cls, letter_path: str) -> "SendJournal":
+        return cls(Path(letter_path) / JOURNAL_FILE)
+
+    def load(self) -> None:
+        """build the index of recorded outcomes"""
+        self.__status = {}
+        if not self.path.is_file():
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self.__status[(record["row"], record["email"])] = record["status"]
+                except (ValueError, KeyError, TypeError):
+                    # the last line is incomplete if we crashed while writing it
+                    logging.warning(f"Skipping corrupted journal record: {line!r}")
+
+    def status(self, row: int, email: str) -> str:
+        return self.__status.get((row, email))
+
+    def is_delivered(self, row: int, email: str) -> bool:
+        return self.__status.get((row, email)) == SENT
+
+    def is_settled(self, row: int, email: str) -> bool:
+        """whether sending to this recipient again would be pointless"""
+        return self.__status.get((row, email)) in (SENT, BOUNCED)
+
+    @property
+    def delivered_count(self) -> int:
+        return sum(1 for status in self.__status.values() if status == SENT)
+
+    def record(self, row: int, email: str, status: str, **details) -> None:
+        """append the outcome of an email and make sure it is on disk"""
+        line = json.dumps(
+            {
+                "time": time.time(),
+                "row": row,
+                "email": email,
+                "status": status,
+                **details,
+            },
+            ensure_ascii=False,
+        )
+        with self.__lock:
+            if self.__file is None:
+                self.__file = open(self.path, "a", encoding="utf-8")
+            self.__file.write(line + "\n")
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__status[(row, email)] = status
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def __enter__(self) -> "SendJournal":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -1,22 +1,25 @@
-import csv
+import copy
 import logging
 import os
-import re
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formataddr, formatdate
+import secrets
 from pathlib import Path, PurePath
-from string import Template
+from itertools import islice
 from typing import List
 
 import yaml
 from cerberus import Validator
-from email_validator import caching_resolver, validate_email
 
 from .utils import *
+from .Attachment import attachment_cache
+from .MessageSkeleton import Email, MessageSkeleton
+from .Journal import SendJournal
+from .Recipients import RESERVED_FIELDS, RecipientList, load_recipients
+from .LetterTemplate import LetterTemplate, TemplateSyntaxError
+from .Metrics import metrics
+from .Rendering import RenderedRow, RowRenderer, render_in_processes
+from .Suppressions import SuppressionList
 
-__all__ = ["Letter"]
+__all__ = ["Letter", "LetterCheck"]
 
 letter_config_schema = {
     "subject": {"type": "string", "required": True},
@@ -30,8 +33,58 @@ letter_config_schema = {
 
 v = Validator(letter_config_schema)
 
-RESERVED_FIELDS = ("email", "cc", "bcc")
-REQUIRED_FIELDS = ("email", "name")
+
+# number of emails rendered ahead of the one being sent
+DEFAULT_LOOKAHEAD = 8
+
+# recipients of one bulk email, servers must accept at least 100 (RFC 5321)
+DEFAULT_BULK_SIZE = 100
+# the To header of bulk emails, every recipient is in Bcc
+BULK_TO = "undisclosed-recipients:;"
+
+
+def has_personal_parts(fields: set, rows: List[dict]) -> bool:
+    """whether a template with `fields` sent to `rows` differs between recipients"""
+    if len(fields) > 0:
+        return True
+    return any(row.get("cc", "") != "" or row.get("bcc", "") != "" for row in rows)
+
+
+class LetterCheck:
+    """
+    everything loaded while checking a letter, truthy when the letter is valid,
+    pass it to Letter so nothing is loaded and validated twice
+    """
+
+    is_valid: bool = False
+    paths: dict = None
+    config: dict = None
+    template: LetterTemplate = None
+    recipients: RecipientList = None
+
+    def __init__(
+        self,
+        is_valid: bool,
+        paths: dict,
+        config: dict = None,
+        template: LetterTemplate = None,
+        recipients: RecipientList = None,
+    ) -> None:
+        self.is_valid = is_valid
+        self.paths = paths
+        self.config = config
+        self.template = template
+        self.recipients = recipients
+
+    def __bool__(self) -> bool:
+        return self.is_valid
+
+    @property
+    def is_personalized(self) -> bool:
+        """Letter.is_personalized, without building the letter"""
+        return has_personal_parts(
+            self.template.fields - {"sender"}, self.recipients.rows
+        )
 
 
 class Letter:
@@ -39,16 +92,36 @@ class Letter:
     config: dict = None
     csv: List = None
     email_addrs: List = None
-    emails: List = None
-
-    def __init__(self, letter_path: str, sender_name: str, *, test_mode: bool = False):
-        if not self.validate_letter_dir(letter_path, verbose=True):
-            richError(f"{letter_path} is not a valid letter directory")
+    from_addr: str = None
+    verp: bool = False
+    campaign: str = None
+    skipped_rows: set = None
+    test_mode: bool = False
+    lookahead: int = DEFAULT_LOOKAHEAD
+    # worker processes rendering emails, 1 renders them in the sending process
+    render_processes: int = 1
+    # recipients per email in bulk mode, None when every recipient gets
+    # their own email
+    bulk_size: int = None
+
+    def __init__(
+        self,
+        letter_path: str,
+        sender_name: str,
+        *,
+        test_mode: bool = False,
+        lookahead: int = DEFAULT_LOOKAHEAD,
+        checked: LetterCheck = None,
+    ):
+        if checked is None:
+            checked = self.check_letter(letter_path, verbose=True)
+        if not checked:
+            richError(f"{letter_path} is not a valid letter")
 
-        self.paths = self.get_paths(letter_path)
+        self.paths = checked.paths
 
         self.config = {
-            **self.__load_letter_config(),
+            **self.__complete_letter_config(checked.config),
             "sender_name": sender_name,
             "attachments": [],
         }
@@ -62,154 +135,248 @@ class Letter:
                     Path(self.paths["attachments"]) / a for a in attachments
                 ]
 
-        self.csv = self.__load_recipients()
-        self.email_addrs = [row["email"] for row in self.csv]
-        self.emails = self.__generate_emails(test_mode=test_mode)
-
-    def set_from_addr(self, from_addr: str):
-        for email in self.emails:
-            email["From"] = formataddr((self.config["from"], from_addr))
-
-            if "bcc" in self.config:
-                if "bccToSender" in self.config and self.config["bccToSender"]:
-                    bccs = [*self.config["bcc"], from_addr]
-                    email["Bcc"] = ",".join(bccs)
-                else:
-                    email["Bcc"] = ",".join(self.config["bcc"])
-            elif "bccToSender" in self.config and self.config["bccToSender"]:
-                email["Bcc"] = from_addr
-
-    def __load_letter_config(self):
-        path = self.paths["config"]
-        if not Path(path).is_file():
-            logging.error(f"{path} is not a file")
-            richError(
-                f"failed to load letter config at {path}, please enter a valid letter path"
-            )
-
-        letter_config = self.load_file(path)
+        self.test_mode = test_mode
+        self.lookahead = lookahead
+        self.skipped_rows = set()
+        # identifies the emails of this run in Message-IDs and VERP addresses
+        self.campaign = secrets.token_hex(8)
+        self.csv = checked.recipients.rows
+        self.email_addrs = checked.recipients.email_addrs
+        self.skip(checked.recipients.suppressed.keys())
+        self.__prepare_emails(checked.template)
+
+    def resume(self, journal: SendJournal) -> int:
+        """
+        skip recipients that the journal records as delivered or bounced,
+        returns how many
+        """
+        delivered = {
+            i
+            for i, recipient in enumerate(self.csv)
+            if journal.is_settled(i, recipient["email"])
+        }
+        self.skip(delivered - self.skipped_rows)
+        return len(delivered)
+
+    @property
+    def pending_rows(self) -> List[int]:
+        """rows of the recipients that are not skipped, in order"""
+        return [i for i in range(len(self.csv)) if i not in self.skipped_rows]
+
+    def shard(self, rows: set) -> "Letter":
+        """
+        a copy of this letter only sending to the recipients at `rows`, it
+        shares everything rendered so far but can be given its own sender
+        """
+        shard = copy.copy(self)
+        shard.skipped_rows = set(self.skipped_rows)
+        shard.select(rows)
+        return shard
+
+    def select(self, rows: set) -> None:
+        """only send to the recipients at the given rows"""
+        self.skip(set(range(len(self.csv))) - set(rows))
+
+    def skip(self, rows: set) -> None:
+        """do not send to the recipients at the given rows"""
+        self.skipped_rows |= set(rows)
+        self.email_addrs = [
+            recipient["email"]
+            for i, recipient in enumerate(self.csv)
+            if i not in self.skipped_rows
+        ]
+
+    @property
+    def is_personalized(self) -> bool:
+        """
+        whether recipients get different emails: the template has fields other
+        than $sender, or rows have their own cc or bcc
+        """
+        return has_personal_parts(self.email_template.fields, self.csv)
+
+    @property
+    def fixed_recipient_count(self) -> int:
+        """recipients every email is sent to: cc, bcc and the sender if bccToSender"""
+        return (
+            len(self.config.get("cc", []))
+            + len(self.config.get("bcc", []))
+            + (1 if self.config.get("bccToSender") else 0)
+        )
 
-        if not self.validate_letter_config(letter_config, verbose=True):
-            logging.error(f"{path} is not a valid letter config")
-            richError(
-                f"failed to load letter config at {path}, please enter a valid letter path"
+    @property
+    def bulk_rows(self) -> int:
+        """rows of recipients.csv per bulk email, what `bulk_size` leaves"""
+        return self.bulk_size - self.fixed_recipient_count
+
+    def set_bulk(self, bulk_size: int = DEFAULT_BULK_SIZE) -> None:
+        """
+        send one email to up to `bulk_size` recipients at a time, all of them
+        in Bcc, only letters that are not personalized can be sent in bulk,
+        `bulk_size` counts the fixed recipients too so no email has more
+        """
+        if self.is_personalized:
+            raise ValueError("personalized letters cannot be sent in bulk")
+        fixed = self.fixed_recipient_count
+        if bulk_size <= fixed:
+            raise ValueError(
+                f"a bulk size of {bulk_size} leaves no room for recipients, "
+                f"every email already goes to {fixed} cc, bcc or sender address(es)"
             )
-
+        self.bulk_size = bulk_size
+
+    def set_render_processes(self, processes: int) -> None:
+        """
+        render emails in that many worker processes, so rendering big
+        personalized letters uses every core while emails are being sent
+        """
+        self.render_processes = max(processes, 1)
+
+    def set_from_addr(self, from_addr: str, *, verp: bool = False):
+        """
+        set the sender address of every email generated from now on,
+        with `verp`, every email gets its own envelope sender
+        (user+token@domain), so bounce-backs can be traced back to it
+        """
+        self.from_addr = from_addr
+        self.verp = verp
+        self.__compile_skeleton()
+
+    @staticmethod
+    def __complete_letter_config(letter_config: dict) -> dict:
+        letter_config = dict(letter_config)
         if "cc" in letter_config:
-            letter_config["cc"] = letter_config["cc"] = complete_school_email(
-                letter_config["cc"]
-            )
+            letter_config["cc"] = complete_school_email(letter_config["cc"])
         if "bcc" in letter_config:
             letter_config["bcc"] = complete_school_email(letter_config["bcc"])
 
         return letter_config
 
-    def __load_recipients(self):
-        """load recipients from csv file"""
-        path = self.paths["recipients"]
-        recipients = self.load_file(path)
-
-        is_valid = self.validate_recipients(recipients, verbose=True)
-
-        if not is_valid:
-            logging.error(
-                f"letter csv: {Path(self.paths['recipients']).read_text(encoding='utf-8')}"
-            )
-            richError(f"failed to load recipients from {self.paths['recipients']}")
-            return
-
-        return recipients
-
-    def __generate_emails(self, *, test_mode: bool = False):
-        """generate emails from csv file"""
-        emails = []
-
-        email_template = Path(self.paths["content"]).read_text(encoding="utf-8")
+    def __prepare_emails(self, email_template: LetterTemplate):
+        """prepare the email template and attachments shared by every email"""
+        self.email_template = email_template.bind(sender=self.config["sender_name"])
+
+        # a fixed boundary spares us from scanning the attachments for a
+        # collision, base64 lines can never contain it
+        self.boundary = f"{'=' * 15}{secrets.token_hex(16)}=="
+
+        # attachments are encoded once and shared by every email
+        self.mime_attachments = [
+            attachment_cache.get(attachment)
+            for attachment in self.config["attachments"]
+        ]
+
+        self.__compile_skeleton()
+
+    def __compile_skeleton(self):
+        """render the parts shared by every email"""
+        self.skeleton = MessageSkeleton(
+            self.config["subject"],
+            self.boundary,
+            self.mime_attachments,
+            from_name=self.config.get("from"),
+            from_addr=self.from_addr,
+        )
 
-        if not self.validate_email_content(
-            email_template, self.csv[0].keys(), verbose=True
-        ):
+    def __generate_emails(self):
+        """generate emails from csv file, one at a time"""
+        if self.bulk_size is not None:
+            yield from self.__generate_bulk_emails()
             return
 
-        email_template = Template(email_template)
-
-        # create attachments
-        mime_attachments = []
-        for attachment in self.config["attachments"]:
-            with open(attachment, "rb") as f:
-                mime_attachment = MIMEApplication(
-                    f.read(), Name=os.path.basename(attachment)
-                )
+        renderer = self.__renderer()
+        rows = ((i, self.csv[i]) for i in self.pending_rows)
+        if self.test_mode:
+            rows = islice(rows, 1)
 
-            mime_attachment[
-                "Content-Disposition"
-            ] = f"attachment; filename={os.path.basename(attachment)}"
+        if self.render_processes > 1 and not self.test_mode:
+            rendered_rows = render_in_processes(renderer, rows, self.render_processes)
+        else:
+            rendered_rows = (renderer.render(i, recipient) for i, recipient in rows)
+
+        for rendered in rendered_rows:
+            yield self.__assemble(rendered)
+
+    def __renderer(self) -> RowRenderer:
+        """renders the rows with the current sender"""
+        return RowRenderer(
+            self.config,
+            self.email_template,
+            self.skeleton,
+            self.campaign,
+            self.from_addr,
+            self.verp,
+        )
 
-            mime_attachments.append(mime_attachment)
+    def __assemble(self, rendered: RenderedRow) -> Email:
+        """the email of a rendered row, with the attachments"""
+        metrics.observe("render_seconds", rendered.render_seconds)
+        metrics.observe("serialize_seconds", rendered.serialize_seconds)
+        return Email(
+            self.from_addr,
+            rendered.to_addrs,
+            rendered.cc_addrs,
+            rendered.bcc_addrs,
+            rendered.head + self.skeleton.tail,
+            row=rendered.row,
+            token=rendered.token,
+            envelope_from=rendered.envelope_from,
+        )
 
-        for recipient in self.csv:
-            email = self.__generate_email(recipient, email_template, mime_attachments)
-            emails.append(email)
-            if test_mode:
+    def __generate_bulk_emails(self):
+        """generate one email per `bulk_rows` recipients, test mode sends one"""
+        bulk_size = 1 if self.test_mode else self.bulk_rows
+        rows = self.pending_rows
+        for start in range(0, len(rows), bulk_size):
+            yield self.__generate_bulk_email(rows[start : start + bulk_size])
+            if self.test_mode:
                 break
-        return emails
 
-    def __generate_email(
-        self,
-        recipient: dict,
-        email_template: Template,
-        mime_attachments: List[MIMEApplication],
-    ):
-        """generate email from recipient"""
-
-        email = MIMEMultipart()
-        email["Date"] = formatdate(localtime=True)
-
-        email["Subject"] = self.config["subject"]
-
-        email["To"] = recipient["email"]
-
-        cc_list = []
-        if "cc" in self.config:
-            cc_list += self.config["cc"]
-        if "cc" in recipient and recipient["cc"] != "":
-            cc_list += recipient["cc"].split(" ")
-        if len(cc_list) > 0:
-            email["Cc"] = ",".join(cc_list)
-
-        bcc_list = []
-        if "bcc" in self.config:
-            bcc_list += self.config["bcc"]
-        if "bcc" in recipient and recipient["bcc"] != "":
-            bcc_list += recipient["bcc"].split(" ")
-        if len(bcc_list) > 0:
-            email["Bcc"] = ",".join(bcc_list)
-
-        if "recipientTitle" in self.config:
-            if "lastNameOnly" in self.config and self.config["lastNameOnly"]:
-                # only supports chinese names
-                recipient["name"] = recipient["name"][0]
-            recipient["name"] = recipient["name"] + self.config["recipientTitle"]
-
-        email.attach(
-            MIMEText(
-                email_template.substitute(
-                    {**recipient, "sender": self.config["sender_name"]}
-                ),
-                "html",
-            )
+    def __generate_bulk_email(self, rows: List[int]):
+        """generate one email to the recipients at `rows`, all of them in Bcc"""
+        cc_list = list(self.config.get("cc", []))
+        bcc_list = list(self.config.get("bcc", []))
+        if self.config.get("bccToSender") and self.from_addr is not None:
+            bcc_list.append(self.from_addr)
+
+        with metrics.timer("render_seconds"):
+            html = self.email_template.render({})
+
+        to_list = [self.csv[row]["email"] for row in rows]
+        # every recipient still gets a token of their own in the journal and
+        # the message index, bounce-backs are matched by address, the token
+        # of the email itself is not indexed
+        batch = [
+            (row, email, f"{self.campaign}.{row}") for row, email in zip(rows, to_list)
+        ]
+
+        token = f"{self.campaign}.b{rows[0]}"
+        envelope_from, domain = self.__renderer().envelope(token)
+
+        with metrics.timer("serialize_seconds"):
+            data = self.skeleton.render([BULK_TO], cc_list, html, f"<{token}@{domain}>")
+
+        return Email(
+            self.from_addr,
+            to_list,
+            cc_list,
+            bcc_list,
+            data,
+            row=rows[0],
+            token=token,
+            envelope_from=envelope_from,
+            batch=batch,
         )
 
-        for mime_attachment in mime_attachments:
-            email.attach(mime_attachment)
-
-        return email
-
     def __iter__(self):
-        return iter(self.emails)
+        """
+        yield emails lazily, at most `lookahead` emails are rendered ahead of
+        the consumer, so memory usage does not grow with the number of recipients
+        """
+        return prefetch(self.__generate_emails(), self.lookahead)
 
     def __len__(self):
-        return len(self.emails)
+        pending = len(self.csv) - len(self.skipped_rows)
+        return min(pending, 1) if self.test_mode else pending
 
     @classmethod
     def load_file(cls, file_path: str):
@@ -225,58 +392,68 @@ class Letter:
             return letter_config
 
         elif file_name == "recipients.csv":
-            with open(file_path, encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                recipients = [row for row in reader]
-
-                stripped_recipients = []
-                for row in recipients:
-                    temp_row = {}
-                    for key, value in row.items():
-                        temp_row[key.strip()] = value.strip()
-
-                    if "email" in temp_row:
-                        temp_row["email"] = complete_school_email(
-                            temp_row["email"].lower()
-                        )
-                    if "cc" in temp_row:
-                        temp_row["cc"] = complete_school_email(temp_row["cc"].lower())
-                    if "bcc" in temp_row:
-                        temp_row["bcc"] = complete_school_email(temp_row["bcc"].lower())
-
-                    stripped_recipients.append(temp_row)
-
-            return stripped_recipients
+            return load_recipients(file_path, validate=False).rows
 
         else:
             return None
 
     @classmethod
-    def check_letter(cls, letter_path: str, verbose=False) -> bool:
-        """check letter"""
-        is_valid = True
-
-        is_valid &= cls.validate_letter_dir(letter_path, verbose=verbose)
-        if not is_valid:
-            return False
-
+    def check_letter(
+        cls, letter_path: str, verbose=False, *, offline=False, suppress=True
+    ) -> LetterCheck:
+        """
+        check letter, the result is truthy when the letter is valid,
+        `offline` only checks the syntax of email addresses, with `suppress`,
+        recipients in the suppression list are found and skipped when sending
+        """
         paths = cls.get_paths(letter_path)
 
+        if not cls.validate_letter_dir(letter_path, verbose=verbose):
+            return LetterCheck(False, paths)
+
         config_file = cls.load_file(paths["config"])
-        content_file = cls.load_file(paths["content"])
-        recipients_file = cls.load_file(paths["recipients"])
+        suppressions = SuppressionList() if suppress else None
+        try:
+            recipients = load_recipients(
+                paths["recipients"],
+                fail_fast=not verbose,
+                offline=offline,
+                suppressions=suppressions,
+            )
+        finally:
+            if suppressions is not None:
+                suppressions.close()
 
-        is_valid &= cls.validate_letter_config(config_file, verbose=verbose)
+        is_valid = cls.validate_letter_config(config_file, verbose=verbose)
 
-        is_valid &= cls.validate_recipients(recipients_file, verbose=verbose)
-        if not is_valid:
-            return False
+        if verbose:
+            recipients.report()
+            recipients.report_suppressed(verbose=True)
+        is_valid &= recipients.is_valid
 
-        is_valid &= cls.validate_email_content(
-            content_file, recipients_file[0], verbose=verbose
-        )
+        template = cls.load_template(paths["content"], verbose=verbose)
+        is_valid &= template is not None
 
-        return is_valid
+        if is_valid:
+            is_valid &= cls.validate_email_content(
+                template, recipients.fieldnames, verbose=verbose
+            )
+
+        return LetterCheck(is_valid, paths, config_file, template, recipients)
+
+    @classmethod
+    def load_template(cls, content_path: str, verbose=False) -> LetterTemplate:
+        """compile content.html, None if it has syntax errors"""
+        try:
+            return LetterTemplate.load(content_path)
+        except TemplateSyntaxError as e:
+            if verbose:
+                message = f"invalid email template {content_path}: {e}"
+                if e.reserved is not None:
+                    message = f"{e.reserved} is a reserved field, it cannot be used in email template: {e}"
+                logging.error(f"{content_path}: {e}")
+                richError(message, terminate=False)
+            return None
 
     @classmethod
     def validate_letter_dir(cls, letter_path: str, verbose=False) -> bool:
@@ -316,79 +493,25 @@ class Letter:
         return is_valid
 
     @classmethod
-    def validate_recipients(cls, stripped_recipients: list, verbose=False) -> bool:
+    def validate_recipients(
+        cls, recipients_path: str, verbose=False, *, offline=False
+    ) -> bool:
         """validate recipients"""
-
-        is_valid = True
-
-        for required in REQUIRED_FIELDS:
-            if required not in stripped_recipients[0]:
-                if verbose:
-                    logging.error(
-                        f"{required} is a required field in the csv file, but not found"
-                    )
-                    richError(
-                        f"{required} is a required field in the csv file, but not found",
-                        terminate=False,
-                    )
-                    is_valid = False
-                else:
-                    return False
-
-        for row in stripped_recipients:
-            for i, (key, value) in enumerate(row.items()):
-                if key is None:
-                    if verbose:
-                        logging.error(f"too many fields at row {i} in recipients.csv")
-                        richError(
-                            f"too many fields at row {i} in recipients.csv",
-                            terminate=False,
-                        )
-                        is_valid = False
-                        continue
-                    else:
-                        return False
-
-                if key in REQUIRED_FIELDS and value == "":
-                    if verbose:
-                        logging.error(
-                            f"{key} cannot be empty, recipients.csv has no {key} at row {i}"
-                        )
-                        richError(
-                            f"{key} cannot be empty, recipients.csv has no {key} at row {i}",
-                            terminate=False,
-                        )
-                        is_valid = False
-                    else:
-                        return False
-
-        resolver = caching_resolver()
-
-        for i, row in enumerate(stripped_recipients):
-            row["email"] = complete_school_email(row["email"].lower())
-            try:
-                validate_email(row["email"], dns_resolver=resolver)
-            except:
-                if verbose:
-                    logging.error(
-                        f"recipients.csv has invalid email: {row['email']}, at row {i}"
-                    )
-                    richError(
-                        f"invalid email {row['email']} detected at row {i} in recipients.csv",
-                        terminate=False,
-                    )
-                    is_valid = False
-                else:
-                    return False
-
-        return is_valid
+        recipients = load_recipients(
+            recipients_path, fail_fast=not verbose, offline=offline
+        )
+        if verbose:
+            recipients.report()
+        return recipients.is_valid
 
     @classmethod
     def validate_email_content(
-        cls, email_template: str, csv_indexes: list, verbose=False
+        cls, email_template: LetterTemplate, csv_indexes: list, verbose=False
     ) -> bool:
-        """validate email content"""
-        template_fields = re.findall(r"\$([_a-z][_a-z0-9]*)", email_template, re.M)
+        """validate the fields used by email content against the csv header"""
+        if isinstance(email_template, str):
+            email_template = LetterTemplate(email_template)
+        template_fields = email_template.fields
         is_valid = True
 
         for reserved in RESERVED_FIELDS:
@@ -405,8 +528,8 @@ class Letter:
                 else:
                     return False
 
-        csv_indexes = [f.strip() for f in template_fields] + ["sender"]
-        for field in template_fields:
+        csv_indexes = [f.strip() for f in csv_indexes] + ["sender"]
+        for field in sorted(template_fields):
             if field not in csv_indexes:
                 if verbose:
                     logging.error(
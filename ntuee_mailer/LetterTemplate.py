@@ -0,0 +1,357 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import ChainMap
+from pathlib import Path
+from typing import List, Mapping, Set
+
+from .globals import *
+
+__all__ = ["LetterTemplate", "TemplateSyntaxError", "RESERVED_NAMES"]
+
+TEMPLATE_CACHE_DIR = APP_DIR / "template-cache"
+
+# bump when the compiled form changes, so stale cache entries are ignored
+COMPILER_VERSION = "2"
+
+# items of a field looped over with $for are separated by this
+LIST_SEPARATOR = ";"
+
+FIELD = "field"
+IF = "if"
+FOR = "for"
+
+# names of the directives, they cannot be used as fields
+RESERVED_NAMES = (IF, FOR, "else", "endif", "endfor")
+
+identifier = r"[_a-z][_a-z0-9]*"
+
+token_re = re.compile(
+    rf"""
+    \$(?:
+        (?P<escaped>\$)
+        | (?P<directive>if|for)\((?P<args>[^)]*)\)
+        | (?P<keyword>else|endif|endfor)\b
+        | (?P<named>{identifier})
+        | {{(?P<braced>{identifier})}}
+        | (?P<invalid>)
+    )
+    """,
+    re.I | re.X | re.A,
+)
+condition_re = re.compile(
+    rf"\s*(?P<negate>!?)\s*(?P<field>{identifier})\s*$", re.I | re.A
+)
+loop_re = re.compile(
+    rf"\s*(?P<var>{identifier})\s+in\s+(?P<field>{identifier})\s*$", re.I | re.A
+)
+
+
+class TemplateSyntaxError(ValueError):
+    """`reserved` is the reserved name the error is about, if any"""
+
+    def __init__(
+        self, message: str, text: str, position: int, reserved: str = None
+    ) -> None:
+        self.line = text.count("\n", 0, position) + 1
+        self.reserved = reserved
+        super().__init__(f"{message} at line {self.line} of the template")
+
+
+def compile_template(text: str) -> list:
+    """
+    compile a template into a list of nodes, a node is either a literal string,
+    (FIELD, name), (IF, name, negate, then nodes, else nodes)
+    or (FOR, var, name, body nodes)
+
+    $name and ${name} are replaced by fields, $$ is a literal $,
+    $if(name) ... $else ... $endif keeps its first part when the field is not
+    empty, $if(!name) when it is, $for(item in name) ... $endfor repeats its
+    body for every item of a field separated by `LIST_SEPARATOR`
+    """
+    root = []
+    # [kind, node, position of the directive, enclosing nodes, in $else]
+    stack = []
+    nodes = root
+    literal = []
+    position = 0
+
+    def flush():
+        text = "".join(literal)
+        literal.clear()
+        if text != "":
+            nodes.append(text)
+
+    def check_name(name: str, match) -> str:
+        if name.lower() in RESERVED_NAMES:
+            raise TemplateSyntaxError(
+                f"{name} is reserved, it cannot be used as a field",
+                text,
+                match.start(),
+                reserved=name,
+            )
+        return name
+
+    for match in token_re.finditer(text):
+        literal.append(text[position : match.start()])
+        position = match.end()
+
+        if match.group("escaped") is not None:
+            literal.append("$")
+            continue
+
+        flush()
+        name = match.group("named") or match.group("braced")
+        directive = (match.group("directive") or "").lower()
+        keyword = (match.group("keyword") or "").lower()
+
+        if name is not None:
+            nodes.append((FIELD, check_name(name, match)))
+
+        elif directive == IF:
+            condition = condition_re.match(match.group("args"))
+            if condition is None:
+                raise TemplateSyntaxError(
+                    f"invalid condition {match.group()!r}", text, match.start()
+                )
+            node = (
+                IF,
+                check_name(condition.group("field"), match),
+                condition.group("negate") == "!",
+                [],
+                [],
+            )
+            nodes.append(node)
+            stack.append([IF, node, match.start(), nodes, False])
+            nodes = node[3]
+
+        elif directive == FOR:
+            loop = loop_re.match(match.group("args"))
+            if loop is None:
+                raise TemplateSyntaxError(
+                    f"invalid loop {match.group()!r}", text, match.start()
+                )
+            node = (
+                FOR,
+                check_name(loop.group("var"), match),
+                check_name(loop.group("field"), match),
+                [],
+            )
+            nodes.append(node)
+            stack.append([FOR, node, match.start(), nodes, False])
+            nodes = node[3]
+
+        elif keyword in ("else", "endif"):
+            if len(stack) == 0 or stack[-1][0] != IF:
+                raise TemplateSyntaxError(
+                    f"${keyword} without $if", text, match.start(), reserved=keyword
+                )
+            block = stack[-1]
+            if keyword == "else":
+                if block[4]:
+                    raise TemplateSyntaxError("duplicated $else", text, match.start())
+                block[4] = True
+                nodes = block[1][4]
+            else:
+                nodes = stack.pop()[3]
+
+        elif keyword == "endfor":
+            if len(stack) == 0 or stack[-1][0] != FOR:
+                raise TemplateSyntaxError(
+                    "$endfor without $for", text, match.start(), reserved=keyword
+                )
+            nodes = stack.pop()[3]
+
+        else:
+            raise TemplateSyntaxError("invalid placeholder", text, match.start())
+
+    literal.append(text[position:])
+    flush()
+
+    if len(stack) > 0:
+        kind, _, start, _, _ = stack[-1]
+        raise TemplateSyntaxError(f"${kind} is never closed", text, start)
+
+    return root
+
+
+def decode_nodes(nodes: list) -> list:
+    """nodes loaded from json, lists turned back into tuples"""
+    decoded = []
+    for node in nodes:
+        if isinstance(node, str):
+            decoded.append(node)
+        elif node[0] == FIELD:
+            decoded.append((FIELD, node[1]))
+        elif node[0] == IF:
+            decoded.append(
+                (
+                    IF,
+                    node[1],
+                    bool(node[2]),
+                    decode_nodes(node[3]),
+                    decode_nodes(node[4]),
+                )
+            )
+        elif node[0] == FOR:
+            decoded.append((FOR, node[1], node[2], decode_nodes(node[3])))
+        else:
+            raise ValueError(f"unknown template node {node!r}")
+    return decoded
+
+
+def collect_fields(nodes: list, scope: frozenset = frozenset()) -> Set[str]:
+    """fields a template reads, loop variables excluded"""
+    fields = set()
+    for node in nodes:
+        if isinstance(node, str):
+            continue
+        if node[0] == FIELD:
+            if node[1] not in scope:
+                fields.add(node[1])
+        elif node[0] == IF:
+            if node[1] not in scope:
+                fields.add(node[1])
+            fields |= collect_fields(node[3], scope)
+            fields |= collect_fields(node[4], scope)
+        elif node[0] == FOR:
+            if node[2] not in scope:
+                fields.add(node[2])
+            fields |= collect_fields(node[3], scope | {node[1]})
+    return fields
+
+
+def bind_nodes(nodes: list, values: Mapping[str, str]) -> list:
+    """replace the given fields by literals, merging adjacent literals"""
+    bound = []
+
+    def append(node):
+        if isinstance(node, str) and len(bound) > 0 and isinstance(bound[-1], str):
+            bound[-1] += node
+        elif node != "":
+            bound.append(node)
+
+    for node in nodes:
+        if isinstance(node, str):
+            append(node)
+        elif node[0] == FIELD:
+            append(values[node[1]] if node[1] in values else node)
+        elif node[0] == IF:
+            append(
+                (
+                    IF,
+                    node[1],
+                    node[2],
+                    bind_nodes(node[3], values),
+                    bind_nodes(node[4], values),
+                )
+            )
+        elif node[0] == FOR:
+            # the loop variable shadows bound fields
+            inner = {k: v for k, v in values.items() if k != node[1]}
+            append((FOR, node[1], node[2], bind_nodes(node[3], inner)))
+    return bound
+
+
+def render_nodes(nodes: list, values: Mapping[str, str], out: list) -> None:
+    for node in nodes:
+        if isinstance(node, str):
+            out.append(node)
+        elif node[0] == FIELD:
+            out.append(values[node[1]])
+        elif node[0] == IF:
+            is_set = values[node[1]].strip() != ""
+            render_nodes(node[3] if is_set != node[2] else node[4], values, out)
+        elif node[0] == FOR:
+            for item in values[node[2]].split(LIST_SEPARATOR):
+                item = item.strip()
+                if item != "":
+                    render_nodes(node[3], ChainMap({node[1]: item}, values), out)
+
+
+class LetterTemplate:
+    """
+    content.html compiled once into literal segments and field slots,
+    rendering a recipient only fills in the slots
+    """
+
+    text: str = None
+    nodes: list = None
+    fields: Set[str] = None
+    # fields filled in by bind(), blocks may still read them
+    bound: dict = None
+
+    def __init__(self, text: str, nodes: list = None, bound: dict = None) -> None:
+        self.text = text
+        self.nodes = nodes if nodes is not None else compile_template(text)
+        self.bound = bound if bound is not None else {}
+        self.fields = collect_fields(self.nodes) - set(self.bound)
+
+        # templates without blocks are rendered by filling a copy of the
+        # pieces, the slots are (index in pieces, field)
+        self.__pieces = None
+        self.__slots = None
+        if all(isinstance(n, str) or n[0] == FIELD for n in self.nodes):
+            self.__pieces = [n if isinstance(n, str) else "" for n in self.nodes]
+            self.__slots = [
+                (i, n[1]) for i, n in enumerate(self.nodes) if not isinstance(n, str)
+            ]
+
+    @classmethod
+    def load(cls, path: str, cache_dir: Path = TEMPLATE_CACHE_DIR) -> "LetterTemplate":
+        """
+        load and compile a template file, compiled templates are cached in
+        `cache_dir` by the hash of the file
+        """
+        data = Path(path).read_bytes()
+        text = data.decode("utf-8")
+        if cache_dir is None:
+            return cls(text)
+
+        digest = hashlib.sha256(COMPILER_VERSION.encode("ascii") + data).hexdigest()
+        cache_path = Path(cache_dir) / f"{digest}.json"
+
+        try:
+            return cls(text, decode_nodes(json.loads(cache_path.read_text("utf-8"))))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, IndexError) as e:
+            logging.warning(f"Ignoring corrupted template cache {cache_path}: {e}")
+
+        template = cls(text)
+        try:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_name(cache_path.name + ".tmp")
+            temp_path.write_text(json.dumps(template.nodes), encoding="utf-8")
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning(f"Failed to cache compiled template: {e}")
+        return template
+
+    @property
+    def has_blocks(self) -> bool:
+        return self.__pieces is None
+
+    def bind(self, **values: str) -> "LetterTemplate":
+        """a template with some fields filled in for every recipient"""
+        bound = {**self.bound, **values}
+        return LetterTemplate(self.text, bind_nodes(self.nodes, values), bound)
+
+    def render(self, values: Mapping[str, str]) -> str:
+        """fill in a recipient, raises KeyError for missing fields"""
+        if self.__pieces is not None:
+            pieces = self.__pieces.copy()
+            for i, field in self.__slots:
+                pieces[i] = values[field]
+            return "".join(pieces)
+
+        if len(self.bound) > 0:
+            values = ChainMap(self.bound, values)
+        out = []
+        render_nodes(self.nodes, values, out)
+        return "".join(out)
+
+    def missing_fields(self, available: List[str]) -> List[str]:
+        return sorted(self.fields - set(available))
@@ -0,0 +1,89 @@
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+__all__ = ["MessageIndex", "message_token"]
+
+MESSAGE_INDEX_FILE = "message-index.tsv"
+
+# tokens are `<campaign>.<row>`, see Letter
+token_re = re.compile(r"[0-9a-f]{16}\.\d+")
+
+
+def message_token(text: str) -> Optional[str]:
+    """find a message token in a Message-ID or a VERP address"""
+    if text is None:
+        return None
+    match = token_re.search(str(text))
+    return match.group() if match is not None else None
+
+
+class MessageIndex:
+    """
+    maps the token carried by the Message-ID (and the VERP envelope sender)
+    of every sent email to its recipient row, kept in memory as a dict and
+    persisted as an append-only file beside the letter,
+    without a path the index only lives in memory
+    """
+
+    path: Path = None
+
+    def __init__(self, path: str = None) -> None:
+        self.path = Path(path) if path is not None else None
+        self.__lock = threading.Lock()
+        self.__file = None
+        # token -> (row, email)
+        self.__tokens = {}
+        # email -> row
+        self.__addresses = {}
+        self.load()
+
+    @classmethod
+    def for_letter(cls, letter_path: str) -> "MessageIndex":
+        return cls(Path(letter_path) / MESSAGE_INDEX_FILE)
+
+    def load(self) -> None:
+        self.__tokens = {}
+        self.__addresses = {}
+        if self.path is None or not self.path.is_file():
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    token, row, email = line.rstrip("\n").split("\t")
+                    self.__add(token, int(row), email)
+                except ValueError:
+                    logging.warning(f"Skipping corrupted message index entry {line!r}")
+
+    def __add(self, token: str, row: int, email: str) -> None:
+        self.__tokens[token] = (row, email)
+        self.__addresses[email.lower()] = row
+
+    def __len__(self) -> int:
+        return len(self.__tokens)
+
+    def add(self, token: str, row: int, email: str) -> None:
+        with self.__lock:
+            if self.path is not None:
+                if self.__file is None:
+                    self.__file = open(self.path, "a", encoding="utf-8")
+                self.__file.write(f"{token}\t{row}\t{email}\n")
+                self.__file.flush()
+            self.__add(token, row, email)
+
+    def lookup(self, token: str) -> Optional[Tuple[int, str]]:
+        """(row, email) of the email carrying `token`"""
+        return self.__tokens.get(token)
+
+    def row_of(self, email: str) -> Optional[int]:
+        """row of the last email sent to `email`"""
+        return self.__addresses.get(email.lower())
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
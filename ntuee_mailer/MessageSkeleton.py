@@ -0,0 +1,139 @@
+import base64
+from email import policy as email_policy
+from email.utils import formataddr, formatdate
+from typing import List, Tuple
+
+from .Attachment import EncodedAttachment
+
+__all__ = ["MessageSkeleton", "Email"]
+
+CRLF = b"\r\n"
+
+# same folding rules as email.message.Message.as_bytes
+header_policy = email_policy.compat32.clone(linesep="\r\n")
+
+
+class Email:
+    """a rendered email, ready for the SMTP DATA command"""
+
+    from_addr: str = None
+    to_addrs: List[str] = None
+    cc_addrs: List[str] = None
+    bcc_addrs: List[str] = None
+    data: bytes = None
+    row: int = None
+    token: str = None
+    envelope_from: str = None
+    # (row, email, token) of every recipient of a bulk email, None otherwise
+    batch: List[Tuple[int, str, str]] = None
+
+    def __init__(
+        self,
+        from_addr: str,
+        to_addrs: List[str],
+        cc_addrs: List[str],
+        bcc_addrs: List[str],
+        data: bytes,
+        row: int = None,
+        *,
+        token: str = None,
+        envelope_from: str = None,
+        batch: List[Tuple[int, str, str]] = None,
+    ) -> None:
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.cc_addrs = cc_addrs
+        self.bcc_addrs = bcc_addrs
+        self.data = data
+        self.row = row
+        self.token = token
+        # the address bounce-backs are sent to
+        self.envelope_from = envelope_from if envelope_from is not None else from_addr
+        self.batch = batch
+
+    @property
+    def recipients(self) -> List[str]:
+        """envelope recipients"""
+        return [*self.to_addrs, *self.cc_addrs, *self.bcc_addrs]
+
+    @property
+    def deliveries(self) -> List[Tuple[int, str, str]]:
+        """(row, email, token) of every recipient row this email delivers to"""
+        if self.batch is not None:
+            return self.batch
+        return [(self.row, self.to_addrs[0], self.token)]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class MessageSkeleton:
+    """
+    a multipart/mixed message compiled to bytes,
+    headers, boundaries and attachments shared by every recipient are rendered
+    once, only To, Cc and the html body are filled in per recipient
+    """
+
+    head: bytes = None
+    body_head: bytes = None
+    tail: bytes = None
+
+    def __init__(
+        self,
+        subject: str,
+        boundary: str,
+        attachments: List[EncodedAttachment] = (),
+        *,
+        from_name: str = None,
+        from_addr: str = None,
+        date: str = None,
+    ) -> None:
+        headers = [
+            ("Content-Type", f'multipart/mixed; boundary="{boundary}"'),
+            ("MIME-Version", "1.0"),
+            ("Date", date if date is not None else formatdate(localtime=True)),
+            ("Subject", subject),
+        ]
+        if from_addr is not None:
+            headers.append(("From", formataddr((from_name, from_addr))))
+
+        self.head = b"".join(self.render_header(*header) for header in headers)
+
+        delimiter = CRLF + b"--" + boundary.encode("ascii")
+        self.body_head = (
+            CRLF
+            + delimiter[2:]
+            + CRLF
+            + b'Content-Type: text/html; charset="utf-8"\r\n'
+            + b"MIME-Version: 1.0\r\n"
+            + b"Content-Transfer-Encoding: base64\r\n\r\n"
+        )
+        self.tail = (
+            b"".join(delimiter + CRLF + a.rendered for a in attachments)
+            + delimiter
+            + b"--"
+            + CRLF
+        )
+
+    @staticmethod
+    def render_header(name: str, value: str) -> bytes:
+        return header_policy.fold_binary(name, value)
+
+    def render(
+        self,
+        to_addrs: List[str],
+        cc_addrs: List[str],
+        html: str,
+        message_id: str = None,
+    ) -> bytes:
+        """render the message for one recipient"""
+        headers = b""
+        if message_id is not None:
+            headers += self.render_header("Message-ID", message_id)
+        headers += self.render_header("To", ",".join(to_addrs))
+        if len(cc_addrs) > 0:
+            headers += self.render_header("Cc", ",".join(cc_addrs))
+
+        body = base64.encodebytes(html.encode("utf-8")).replace(b"\n", CRLF)
+
+        return b"".join((self.head, headers, self.body_head, body, self.tail))
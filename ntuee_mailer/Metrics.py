@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .utils import percentile
+
+__all__ = ["Metrics", "metrics"]
+
+METRICS_JSON_FILE = "metrics.json"
+METRICS_PROM_FILE = "metrics.prom"
+PROMETHEUS_PREFIX = "ntuee_mailer_"
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    "connect_seconds": "time to open and set up an SMTP connection",
+    "login_seconds": "time to authenticate an SMTP connection",
+    "render_seconds": "time to fill in the template for one recipient",
+    "serialize_seconds": "time to assemble the MIME message of one recipient",
+    "smtp_mail_seconds": "MAIL FROM round-trip",
+    "smtp_rcpt_seconds": "RCPT TO round-trip, one per recipient",
+    "smtp_data_seconds": "DATA round-trip, including the message upload",
+    "smtp_pipeline_seconds": "MAIL, RCPT and DATA sent as one pipelined group",
+    "smtp_send_seconds": "time to send one email, MAIL to the end of DATA",
+    "ratelimit_wait_seconds": "time spent waiting for the rate limiter",
+    "bounce_scan_seconds": "time to scan the POP3 mailbox for bounce-backs",
+    "send_seconds": "wall time of the whole send",
+    "emails_sent_total": "emails accepted by the SMTP server",
+    "emails_failed_total": "emails that could not be delivered",
+    "retries_total": "emails put back for another attempt",
+    "reconnects_total": "SMTP connections reopened after an error",
+    "throttled_total": "times the server asked us to slow down",
+    "bytes_sent_total": "message bytes sent in DATA",
+    "recipients_refused_total": "recipients refused by the server",
+    "bounces_total": "bounce-backs found",
+}
+
+
+class Histogram:
+    """every observed value is kept, so percentiles are exact"""
+
+    def __init__(self) -> None:
+        self.values = []
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.values.append(value)
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return len(self.values)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": round(percentile(self.values, 50), 6),
+            "p95": round(percentile(self.values, 95), 6),
+            "p99": round(percentile(self.values, 99), 6),
+            "max": round(max(self.values, default=0), 6),
+        }
+
+    def buckets(self):
+        """(upper bound, cumulative count) pairs, ending with +Inf"""
+        ordered = sorted(self.values)
+        i = 0
+        for bound in BUCKETS:
+            while i < len(ordered) and ordered[i] <= bound:
+                i += 1
+            yield str(bound), i
+        yield "+Inf", len(ordered)
+
+
+class Metrics:
+    """counters and latency histograms of one run, shared by every thread"""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.started_at = time.time()
+            self.__counters = {}
+            self.__histograms = {}
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.__lock:
+            if name not in self.__histograms:
+                self.__histograms[name] = Histogram()
+            self.__histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """observe how long the block takes, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name: str) -> float:
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def histogram(self, name: str) -> dict:
+        with self.__lock:
+            histogram = self.__histograms.get(name, Histogram())
+            return histogram.summary()
+
+    def to_dict(self) -> dict:
+        with self.__lock:
+            return {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "counters": dict(self.__counters),
+                "histograms": {
+                    name: histogram.summary()
+                    for name, histogram in self.__histograms.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """the text exposition format, for the node exporter textfile collector"""
+        lines = []
+        with self.__lock:
+            for name, value in sorted(self.__counters.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+            for name, histogram in sorted(self.__histograms.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {metric} histogram")
+                for bound, count in histogram.buckets():
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str) -> None:
+        """write metrics.json and metrics.prom into `directory`"""
+        directory = Path(directory)
+        outputs = (
+            (METRICS_JSON_FILE, json.dumps(self.to_dict(), indent=2)),
+            (METRICS_PROM_FILE, self.to_prometheus()),
+        )
+        for file_name, content in outputs:
+            path = directory / file_name
+            # the textfile collector may read at any moment, never show it
+            # a half written file
+            temp_path = path.with_name(file_name + ".tmp")
+            try:
+                temp_path.write_text(content, encoding="utf-8")
+                os.replace(temp_path, path)
+            except OSError as e:
+                logging.error(e)
+                logging.error(f"Failed to write metrics to {path}")
+
+
+# metrics of the current run
+metrics = Metrics()
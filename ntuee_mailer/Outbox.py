@@ -0,0 +1,81 @@
+import threading
+from typing import Callable
+
+from .Letter import Letter
+from .DeadLetters import DeadLetters
+from .Journal import SendJournal
+from .MessageIndex import MessageIndex
+
+__all__ = ["Outbox"]
+
+
+class Outbox:
+    """
+    a letter whose emails are being sent, and where their outcomes are
+    recorded, emails of several outboxes may share one connection pool
+
+    `on_finished` is called once every email of the letter got its final
+    outcome, from the thread that settled the last one
+    """
+
+    letter: Letter = None
+    journal: SendJournal = None
+    dead_letters: DeadLetters = None
+    message_index: MessageIndex = None
+    # task of the letter in the progress bars
+    task = None
+    delivered: int = 0
+    failed: int = 0
+
+    def __init__(
+        self,
+        letter: Letter,
+        journal: SendJournal = None,
+        dead_letters: DeadLetters = None,
+        message_index: MessageIndex = None,
+        on_finished: Callable[["Outbox"], None] = None,
+    ) -> None:
+        self.letter = letter
+        self.journal = journal
+        self.dead_letters = dead_letters
+        self.message_index = message_index
+        self.on_finished = on_finished
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__exhausted = False
+        self.__finished = False
+
+    def emails(self):
+        """
+        the emails of the letter, each of them counted until it is settled,
+        closing the generator leaves the rest of the letter unsent
+        """
+        try:
+            for email in self.letter:
+                with self.__lock:
+                    self.__pending += 1
+                yield email
+        finally:
+            with self.__lock:
+                self.__exhausted = True
+            self.__check_finished()
+
+    def settle(self, delivered: int, failed: int) -> None:
+        """an email got its final outcome, for that many recipients"""
+        with self.__lock:
+            self.__pending -= 1
+            self.delivered += delivered
+            self.failed += failed
+        self.__check_finished()
+
+    @property
+    def finished(self) -> bool:
+        return self.__finished
+
+    def __check_finished(self) -> None:
+        with self.__lock:
+            if self.__finished or not self.__exhausted or self.__pending > 0:
+                return
+            self.__finished = True
+        if self.on_finished is not None:
+            self.on_finished(self)
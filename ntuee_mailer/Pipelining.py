@@ -0,0 +1,95 @@
+import re
+import smtplib
+from typing import Dict, List, Sequence, Tuple
+
+from .Metrics import metrics
+
+__all__ = ["supports_pipelining", "pipelined_transfer"]
+
+CRLF = b"\r\n"
+
+# lines starting with a dot get another one, RFC 5321 section 4.5.2
+leading_dot_re = re.compile(rb"(?m)^\.")
+
+
+def supports_pipelining(server: smtplib.SMTP) -> bool:
+    """whether the server advertised PIPELINING (RFC 2920) in its EHLO reply"""
+    server.ehlo_or_helo_if_needed()
+    return server.does_esmtp and server.has_extn("pipelining")
+
+
+def read_reply(server: smtplib.SMTP) -> Tuple[int, bytes]:
+    code, response = server.getreply()
+    if code == 421:
+        # the server is shutting the connection down, the replies of the
+        # commands after this one will never come
+        server.close()
+    return code, response
+
+
+def pipelined_transfer(
+    server: smtplib.SMTP,
+    from_addr: str,
+    to_addrs: List[str],
+    data: bytes,
+    options: Sequence[str] = (),
+) -> Dict[str, Tuple[int, bytes]]:
+    """
+    send MAIL, every RCPT and DATA in one write and read their replies
+    afterwards, saving a round-trip per command
+
+    raises the same exceptions as smtplib.SMTP.sendmail and, like it, returns
+    {address: (code, response)} of the recipients refused by the server
+    """
+    option_list = "".join(" " + option for option in options)
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{option_list}"]
+    commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}" for addr in to_addrs]
+    commands.append("DATA")
+
+    with metrics.timer("smtp_pipeline_seconds"):
+        server.send("".join(command + "\r\n" for command in commands))
+
+        mail_code, mail_response = read_reply(server)
+        if mail_code == 421:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_response, from_addr)
+
+        refused = {}
+        for addr in to_addrs:
+            code, response = read_reply(server)
+            if code not in (250, 251):
+                refused[addr] = (code, response)
+            if code == 421:
+                raise smtplib.SMTPRecipientsRefused(refused)
+
+        data_code, data_response = read_reply(server)
+        if data_code == 421:
+            raise smtplib.SMTPDataError(data_code, data_response)
+
+    if mail_code != 250 or len(refused) == len(to_addrs):
+        if data_code == 354:
+            # the server should have refused DATA, it now reads the message
+            # and would deliver whatever ends it, even an empty one, to any
+            # recipient it accepted, dropping the connection aborts it
+            server.close()
+        else:
+            server.rset()
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_response, from_addr)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    if data_code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(data_code, data_response)
+
+    with metrics.timer("smtp_data_seconds"):
+        data = leading_dot_re.sub(b"..", data)
+        if not data.endswith(CRLF):
+            data += CRLF
+        server.send(data + b"." + CRLF)
+        code, response = read_reply(server)
+    if code != 250:
+        if code != 421:
+            server.rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    return refused
@@ -0,0 +1,234 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from .globals import *
+from .Metrics import metrics
+
+__all__ = ["TokenBucket", "RateLimiter", "parse_limits", "THROTTLE_CODES"]
+
+# replies that mean the server wants us to slow down
+THROTTLE_CODES = (421, 450, 451, 452)
+
+RATE_STATE_PATH = APP_DIR / "ratelimit.json"
+# limiters of several accounts may save at the same time
+state_lock = threading.Lock()
+
+
+class TokenBucket:
+    """holds up to `capacity` tokens, refilled at `rate` tokens per second"""
+
+    capacity: float = 1
+    rate: float = 1
+    tokens: float = 0
+    updated_at: float = 0
+
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """seconds until a token is available, call refill first"""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self) -> None:
+        self.tokens = 0
+
+
+def parse_limits(limits: str) -> List[Tuple[int, float]]:
+    """parse `count/seconds` pairs such as `130/180, 260/420`"""
+    parsed = []
+    for limit in limits.split(","):
+        limit = limit.strip()
+        if limit == "":
+            continue
+        count, seconds = limit.split("/")
+        parsed.append((int(count), float(seconds)))
+    return parsed
+
+
+class RateLimiter:
+    """
+    token bucket rate limiter shared by every connection to one SMTP host
+
+    the main bucket adapts its rate: it speeds up additively while the server
+    accepts mail, and backs off multiplicatively when the server pushes back.
+    `limits` adds fixed buckets on top of it, each allowing at most `count`
+    emails every `seconds`
+    """
+
+    host: str = None
+    rate: float = 1
+    min_rate: float = 0.1
+    max_rate: float = 10
+    increase: float = 0.05
+    decrease: float = 0.5
+    window: int = 10
+    cooldown: float = 30
+
+    def __init__(
+        self,
+        host: str,
+        *,
+        rate: float = 1,
+        burst: int = 10,
+        min_rate: float = 0.1,
+        max_rate: float = 10,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        window: int = 10,
+        cooldown: float = 30,
+        limits: List[Tuple[int, float]] = (),
+        state_path: Path = RATE_STATE_PATH,
+    ) -> None:
+        self.host = host
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.cooldown = cooldown
+        # without a state path, learned rates are neither loaded nor saved
+        self.state_path = Path(state_path) if state_path is not None else None
+
+        learned_rate = self.__load_rate()
+        if learned_rate is not None:
+            logging.info(f"Using learned rate {learned_rate:.2f}/s for {host}")
+            rate = learned_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+
+        self.bucket = TokenBucket(burst, self.rate)
+        self.buckets = [self.bucket] + [
+            TokenBucket(count, count / seconds) for count, seconds in limits
+        ]
+
+        self.__lock = threading.Lock()
+        self.__paused_until = 0
+        self.__accepted = 0
+
+    @classmethod
+    def from_config(cls, config: dict, key: str = None, **kwargs) -> "RateLimiter":
+        """
+        create a rate limiter from the smtp and ratelimit sections of config.ini,
+        the learned rate is kept under `key`, the SMTP host by default
+        """
+        options = config["ratelimit"]
+        host = key
+        if host is None:
+            host = f"{config['smtp']['host']}:{config['smtp']['port']}"
+        if config.get("fake", {}).get("enabled", False):
+            # runs against the fake servers start from the configured rate
+            # and never touch the rates learned from real ones
+            host = "fake"
+            kwargs.setdefault("state_path", None)
+        return cls(
+            host,
+            rate=options["rate"],
+            burst=options["burst"],
+            min_rate=options["min_rate"],
+            max_rate=options["max_rate"],
+            increase=options["increase"],
+            decrease=options["decrease"],
+            window=options["window"],
+            cooldown=options["cooldown"],
+            limits=parse_limits(options["limits"]),
+            **kwargs,
+        )
+
+    @property
+    def sustained_rate(self) -> float:
+        """emails per second allowed in the long run, bursts aside"""
+        return min(bucket.rate for bucket in self.buckets)
+
+    def acquire(self, on_wait: Callable[[float], None] = None) -> float:
+        """block until an email may be sent, returns the seconds spent waiting"""
+        waited = 0
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                for bucket in self.buckets:
+                    bucket.refill(now)
+                wait = max(
+                    self.__paused_until - now,
+                    *(bucket.wait_time() for bucket in self.buckets),
+                )
+                if wait <= 0:
+                    for bucket in self.buckets:
+                        bucket.tokens -= 1
+                    return waited
+
+            if on_wait is not None:
+                on_wait(wait)
+            time.sleep(wait)
+            waited += wait
+
+    def success(self) -> None:
+        """the server accepted an email"""
+        with self.__lock:
+            self.__accepted += 1
+            if self.__accepted >= self.window:
+                self.__accepted = 0
+                self.__set_rate(self.rate + self.increase)
+
+    def throttled(self) -> None:
+        """the server pushed back, slow down and pause for a while"""
+        with self.__lock:
+            now = time.monotonic()
+            # every connection sees the same push back, slow down once for it
+            if now < self.__paused_until:
+                return
+            self.__accepted = 0
+            self.__set_rate(self.rate * self.decrease)
+            self.bucket.drain()
+            self.__paused_until = now + self.cooldown
+        metrics.inc("throttled_total")
+        logging.warning(
+            f"Throttled by {self.host}, slowing down to {self.rate:.2f} emails/s"
+        )
+
+    def __set_rate(self, rate: float) -> None:
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.bucket.rate = self.rate
+
+    def __load_rate(self) -> float:
+        if self.state_path is None:
+            return None
+        try:
+            state = json.loads(self.state_path.read_text(encoding="utf-8"))
+            return float(state[self.host]["rate"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self) -> None:
+        """remember the current rate as the safe rate for this host"""
+        if self.state_path is None:
+            return
+        with state_lock:
+            try:
+                state = json.loads(self.state_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                state = {}
+
+            state[self.host] = {"rate": self.rate, "updated": time.time()}
+
+            try:
+                self.state_path.parent.mkdir(parents=True, exist_ok=True)
+                self.state_path.write_text(
+                    json.dumps(state, indent=2), encoding="utf-8"
+                )
+            except OSError as e:
+                logging.error(e)
+                logging.error(f"Failed to save learned rate to {self.state_path}")
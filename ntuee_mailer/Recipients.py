@@ -0,0 +1,209 @@
+from rich import print
+
+import csv
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from email_validator import EmailNotValidError, validate_email
+
+from .utils import complete_school_email, richError, richWarning
+from .DomainCache import DomainCache, check_domains
+from .Suppressions import SuppressionList
+
+__all__ = ["RecipientList", "load_recipients", "normalize_addresses"]
+
+RESERVED_FIELDS = ("email", "cc", "bcc")
+REQUIRED_FIELDS = ("email", "name")
+
+
+def normalize_addresses(value: str) -> str:
+    """lowercase and complete space separated school email addresses"""
+    return " ".join(complete_school_email(addr) for addr in value.lower().split())
+
+
+class RecipientList:
+    """
+    rows of recipients.csv, stripped and normalized, along with the errors
+    found while loading them
+    """
+
+    path: Path = None
+    fieldnames: List[str] = None
+    rows: List[dict] = None
+    errors: List[str] = None
+    # row -> suppression entry of the recipients that must not be mailed
+    suppressed: Dict[int, dict] = None
+
+    def __init__(
+        self,
+        path: str,
+        fieldnames: List[str],
+        rows: List[dict],
+        errors: List[str],
+        suppressed: Dict[int, dict] = None,
+    ) -> None:
+        self.path = Path(path)
+        self.fieldnames = fieldnames
+        self.rows = rows
+        self.errors = errors
+        self.suppressed = suppressed if suppressed is not None else {}
+
+    @property
+    def is_valid(self) -> bool:
+        return len(self.errors) == 0
+
+    @property
+    def email_addrs(self) -> List[str]:
+        return [row["email"] for row in self.rows]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.rows)
+
+    def __getitem__(self, index: int) -> dict:
+        return self.rows[index]
+
+    def report(self) -> None:
+        """print every error found while loading"""
+        for error in self.errors:
+            logging.error(error)
+            richError(error, terminate=False)
+
+    def report_suppressed(self, verbose: bool = False) -> None:
+        """print how many rows are skipped because they are suppressed, and why"""
+        if len(self.suppressed) == 0:
+            return
+
+        reasons = {}
+        for entry in self.suppressed.values():
+            reason = entry.get("reason") or "unknown"
+            reasons[reason] = reasons.get(reason, 0) + 1
+        summary = ", ".join(f"{n} {reason}" for reason, n in sorted(reasons.items()))
+        logging.info(f"Skipping {len(self.suppressed)} suppressed rows: {summary}")
+        richWarning(
+            f"skipping {len(self.suppressed)} suppressed recipient(s): {summary}"
+        )
+
+        if verbose:
+            for i, entry in sorted(self.suppressed.items()):
+                detail = f", {entry['detail']}" if entry.get("detail") else ""
+                print(
+                    f"\trow {i}: {self.rows[i]['email']} ({entry.get('reason')}{detail})"
+                )
+
+
+def load_recipients(
+    path: str,
+    *,
+    validate: bool = True,
+    fail_fast: bool = False,
+    offline: bool = False,
+    domain_cache: DomainCache = None,
+    resolver=None,
+    suppressions: SuppressionList = None,
+) -> RecipientList:
+    """
+    parse, strip, normalize and validate recipients.csv in a single pass,
+    every row is read and checked exactly once, with `fail_fast` loading stops
+    at the first error, rows whose email is in `suppressions` are listed in
+    RecipientList.suppressed
+
+    email syntax is checked per row, deliverability once per distinct domain
+    afterwards, through `domain_cache` and `resolver` (a dns.resolver.Resolver
+    or anything with the same resolve method), `offline` skips it
+    """
+    errors = []
+    rows = []
+    fieldnames = []
+    suppressed = {}
+    # domain -> rows with an email at it
+    domains = {}
+
+    def error(message: str) -> bool:
+        errors.append(message)
+        return fail_fast
+
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+
+        header = next(reader, None)
+        if header is None:
+            error("recipients.csv is empty")
+            return RecipientList(path, fieldnames, rows, errors, suppressed)
+
+        fieldnames = [name.strip() for name in header]
+        for required in REQUIRED_FIELDS:
+            if required not in fieldnames and error(
+                f"{required} is a required field in the csv file, but not found"
+            ):
+                return RecipientList(path, fieldnames, rows, errors, suppressed)
+
+        # row numbers count recipients, not lines
+        for i, values in enumerate(filter(None, reader)):
+            if len(values) > len(fieldnames) and error(
+                f"too many fields at row {i} in recipients.csv"
+            ):
+                return RecipientList(path, fieldnames, rows, errors, suppressed)
+
+            row = {
+                name: values[j].strip() if j < len(values) else ""
+                for j, name in enumerate(fieldnames)
+            }
+            if row.get("email", "") != "":
+                row["email"] = complete_school_email(row["email"].lower())
+            for field in ("cc", "bcc"):
+                if field in row:
+                    row[field] = normalize_addresses(row[field])
+            rows.append(row)
+
+            if suppressions is not None and row.get("email", "") != "":
+                entry = suppressions.get(row["email"])
+                if entry is not None:
+                    suppressed[i] = entry
+
+            if not validate:
+                continue
+
+            empty = [key for key in REQUIRED_FIELDS if row.get(key) == ""]
+            for key in empty:
+                if error(
+                    f"{key} cannot be empty, recipients.csv has no {key} at row {i}"
+                ):
+                    return RecipientList(path, fieldnames, rows, errors, suppressed)
+            if row.get("email", "") == "":
+                continue
+
+            try:
+                validated = validate_email(row["email"], check_deliverability=False)
+            except EmailNotValidError:
+                if error(
+                    f"invalid email {row['email']} detected at row {i} in recipients.csv"
+                ):
+                    return RecipientList(path, fieldnames, rows, errors, suppressed)
+                continue
+            domains.setdefault(validated.ascii_domain, []).append(i)
+
+    if validate and not offline and len(domains) > 0:
+        if domain_cache is None:
+            domain_cache = DomainCache()
+        results = check_domains(domains, cache=domain_cache, resolver=resolver)
+
+        undeliverable = sorted(
+            (i, results[domain])
+            for domain, domain_rows in domains.items()
+            if results[domain] is not None
+            for i in domain_rows
+        )
+        for i, reason in undeliverable:
+            if error(
+                f"undeliverable email {rows[i]['email']} detected at row {i} in recipients.csv, {reason}"
+            ):
+                break
+
+    if validate and len(rows) == 0 and len(errors) == 0:
+        error("recipients.csv has no recipients")
+
+    return RecipientList(path, fieldnames, rows, errors, suppressed)
@@ -0,0 +1,194 @@
+import copy
+import multiprocessing
+import os
+import time
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+from .LetterTemplate import LetterTemplate
+from .MessageSkeleton import MessageSkeleton
+
+__all__ = ["RowRenderer", "RenderedRow", "render_in_processes", "cpu_count"]
+
+# rows sent to a worker process at a time
+CHUNK_SIZE = 32
+# chunks in flight per worker process, bounds the rendered emails waiting
+# for the sender
+CHUNKS_PER_PROCESS = 2
+
+# letter options that change what is rendered for a row
+ROW_OPTIONS = ("cc", "bcc", "bccToSender", "recipientTitle", "lastNameOnly")
+
+
+class RenderedRow:
+    """
+    an email rendered for one recipient row, without the attachments,
+    small enough to be sent back from a worker process
+    """
+
+    __slots__ = (
+        "row",
+        "to_addrs",
+        "cc_addrs",
+        "bcc_addrs",
+        "token",
+        "envelope_from",
+        "head",
+        "render_seconds",
+        "serialize_seconds",
+    )
+
+    def __init__(self, **fields) -> None:
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state) -> None:
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class RowRenderer:
+    """
+    renders the emails of a letter row by row, everything but the attachments,
+    which are the same for every recipient and stay with the letter,
+    it only holds small picklable state, so it is sent once to every worker
+    process of render_in_processes
+    """
+
+    config: dict = None
+    template: LetterTemplate = None
+    skeleton: MessageSkeleton = None
+    campaign: str = None
+    from_addr: str = None
+    verp: bool = False
+
+    def __init__(
+        self,
+        letter_config: dict,
+        template: LetterTemplate,
+        skeleton: MessageSkeleton,
+        campaign: str,
+        from_addr: str = None,
+        verp: bool = False,
+    ) -> None:
+        self.config = {k: letter_config[k] for k in ROW_OPTIONS if k in letter_config}
+        self.template = template
+        self.skeleton = copy.copy(skeleton)
+        self.skeleton.tail = b""
+        self.campaign = campaign
+        self.from_addr = from_addr
+        self.verp = verp
+
+    def envelope(self, token: str) -> Tuple[str, str]:
+        """(envelope sender, Message-ID domain) of the email carrying `token`"""
+        domain = "localhost"
+        envelope_from = self.from_addr
+        if self.from_addr is not None:
+            local_part, domain = self.from_addr.rsplit("@", 1)
+            if self.verp:
+                envelope_from = f"{local_part}+{token}@{domain}"
+        return envelope_from, domain
+
+    def render(self, row: int, recipient: dict) -> RenderedRow:
+        cc_list = []
+        if "cc" in self.config:
+            cc_list += self.config["cc"]
+        if "cc" in recipient and recipient["cc"] != "":
+            cc_list += recipient["cc"].split(" ")
+
+        bcc_list = []
+        if "bcc" in self.config:
+            bcc_list += self.config["bcc"]
+        if "bcc" in recipient and recipient["bcc"] != "":
+            bcc_list += recipient["bcc"].split(" ")
+        if self.config.get("bccToSender") and self.from_addr is not None:
+            bcc_list.append(self.from_addr)
+
+        if "recipientTitle" in self.config:
+            recipient = recipient.copy()
+            if "lastNameOnly" in self.config and self.config["lastNameOnly"]:
+                # only supports chinese names
+                recipient["name"] = recipient["name"][0]
+            recipient["name"] = recipient["name"] + self.config["recipientTitle"]
+
+        start = time.perf_counter()
+        html = self.template.render(recipient)
+        rendered = time.perf_counter()
+
+        to_list = [recipient["email"]]
+
+        token = f"{self.campaign}.{row}"
+        envelope_from, domain = self.envelope(token)
+
+        head = self.skeleton.render(to_list, cc_list, html, f"<{token}@{domain}>")
+
+        return RenderedRow(
+            row=row,
+            to_addrs=to_list,
+            cc_addrs=cc_list,
+            bcc_addrs=bcc_list,
+            token=token,
+            envelope_from=envelope_from,
+            head=head,
+            render_seconds=rendered - start,
+            serialize_seconds=time.perf_counter() - rendered,
+        )
+
+
+def cpu_count() -> int:
+    """cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return os.cpu_count() or 1
+
+
+# the renderer of a worker process, set when the process starts
+worker_renderer: RowRenderer = None
+
+
+def start_worker(renderer: RowRenderer) -> None:
+    global worker_renderer
+    worker_renderer = renderer
+
+
+def render_chunk(rows: List[Tuple[int, dict]]) -> List[RenderedRow]:
+    return [worker_renderer.render(row, recipient) for row, recipient in rows]
+
+
+def render_in_processes(
+    renderer: RowRenderer,
+    rows: Iterable[Tuple[int, dict]],
+    processes: int,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[RenderedRow]:
+    """
+    render (row, recipient) pairs in a pool of worker processes, in order,
+    at most CHUNKS_PER_PROCESS chunks per process are rendered ahead of the
+    consumer, so memory stays bounded however slowly emails are sent
+
+    the processes are spawned rather than forked, the sending threads may be
+    holding locks a forked child would inherit
+    """
+    rows = iter(rows)
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(processes, initializer=start_worker, initargs=(renderer,))
+    try:
+        in_flight = deque()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if len(chunk) == 0:
+                break
+            in_flight.append(pool.apply_async(render_chunk, (chunk,)))
+            if len(in_flight) >= CHUNKS_PER_PROCESS * processes:
+                yield from in_flight.popleft().get()
+
+        while len(in_flight) > 0:
+            yield from in_flight.popleft().get()
+    finally:
+        # also when the consumer stops early, nothing rendered is needed anymore
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,169 @@
+import collections
+import heapq
+import itertools
+import random
+import smtplib
+import socket
+import threading
+import time
+
+from .RateLimiter import THROTTLE_CODES
+
+__all__ = [
+    "DeliveryQueue",
+    "ReconnectFailed",
+    "is_transient",
+    "is_throttling",
+    "is_server_drop",
+    "breaks_connection",
+    "backoff_delay",
+]
+
+
+# what smtplib raises when the server closes the connection, with the error
+# appended when reading from the socket failed instead
+SERVER_CLOSED = "Connection unexpectedly closed"
+
+
+class ReconnectFailed(ConnectionError):
+    """no new connection to the SMTP server could be opened"""
+
+
+def error_codes(error: Exception) -> list:
+    """SMTP reply codes carried by an smtplib exception"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return [code for code, _ in error.recipients.values()]
+    if isinstance(error, smtplib.SMTPResponseException):
+        return [error.smtp_code]
+    return []
+
+
+def breaks_connection(error: Exception) -> bool:
+    """whether the connection can no longer be used after this error"""
+    return isinstance(
+        error, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)
+    ) or any(code == 421 for code in error_codes(error))
+
+
+def is_transient(error: Exception) -> bool:
+    """4xx replies, disconnects and timeouts are worth retrying, 5xx are not"""
+    if breaks_connection(error):
+        return True
+    if isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException):
+        # network errors
+        return True
+    codes = error_codes(error)
+    return len(codes) > 0 and all(400 <= code < 500 for code in codes)
+
+
+def is_server_drop(error: Exception) -> bool:
+    """
+    whether the server hung up on us, as servers shedding load do, rather
+    than the connection failing on our side or on the network
+    """
+    return (
+        isinstance(error, smtplib.SMTPServerDisconnected)
+        and str(error) == SERVER_CLOSED
+        and not isinstance(error.__context__, OSError)
+    )
+
+
+def is_throttling(error: Exception) -> bool:
+    """
+    whether an SMTP error means the server wants us to slow down: it dropped
+    the connection or replied 421 or 45x
+    """
+    if is_server_drop(error):
+        return True
+    return any(code in THROTTLE_CODES for code in error_codes(error))
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 300) -> float:
+    """exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class DeliveryQueue:
+    """
+    bounded queue of emails waiting to be sent, failed emails can be put back
+    with a delay, get() returns None once the queue is closed and every email
+    has been marked done, or as soon as it is aborted
+    """
+
+    # the error the queue was aborted with
+    error: BaseException = None
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.__condition = threading.Condition()
+        self.__fresh = collections.deque()
+        # (ready at, sequence, item)
+        self.__delayed = []
+        self.__sequence = itertools.count()
+        self.__outstanding = 0
+        self.__closed = False
+
+    def put(self, item) -> None:
+        """add a new item, blocks while the queue is full"""
+        with self.__condition:
+            while len(self.__fresh) >= self.maxsize and self.error is None:
+                self.__condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.__fresh.append(item)
+            self.__outstanding += 1
+            self.__condition.notify_all()
+
+    def retry(self, item, delay: float) -> None:
+        """put an item back, it will be handed out again after `delay` seconds"""
+        with self.__condition:
+            heapq.heappush(
+                self.__delayed,
+                (time.monotonic() + delay, next(self.__sequence), item),
+            )
+            self.__condition.notify_all()
+
+    def done(self) -> None:
+        """an item got its final outcome"""
+        with self.__condition:
+            self.__outstanding -= 1
+            self.__condition.notify_all()
+
+    def close(self) -> None:
+        """no more new items will be added"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def abort(self, error: BaseException) -> None:
+        """
+        stop handing out items, put() raises `error` from now on, the first
+        error a queue is aborted with is kept
+        """
+        with self.__condition:
+            if self.error is None:
+                self.error = error
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def get(self):
+        with self.__condition:
+            while True:
+                if self.error is not None:
+                    return None
+
+                timeout = None
+                if len(self.__delayed) > 0:
+                    timeout = self.__delayed[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        return heapq.heappop(self.__delayed)[2]
+
+                if len(self.__fresh) > 0:
+                    item = self.__fresh.popleft()
+                    self.__condition.notify_all()
+                    return item
+
+                if self.__closed and self.__outstanding == 0:
+                    return None
+
+                self.__condition.wait(timeout)
@@ -0,0 +1,287 @@
+from rich import print
+from rich.table import Table
+
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from .utils import *
+from .AutoMailer import AutoMailer
+from .Letter import Letter
+from .RateLimiter import RateLimiter
+from .DeadLetters import DeadLetters
+from .MessageIndex import MessageIndex
+from .Journal import SendJournal
+
+__all__ = ["ShardedMailer", "account_config"]
+
+
+def account_config(config: dict, account_id: str) -> dict:
+    """
+    the config of a mailer sending from the [account.<id>] section,
+    its options override those of the smtp and ratelimit sections
+    """
+    account = config["accounts"][account_id]
+    shard_config = dict(config)
+    shard_config["account"] = {**config["account"], "userid": account["userid"]}
+    shard_config["smtp"] = dict(config["smtp"])
+    shard_config["ratelimit"] = dict(config["ratelimit"])
+
+    if "connections" in account:
+        shard_config["smtp"]["connections"] = account["connections"]
+    for option in ("rate", "burst", "max_rate", "limits"):
+        if option in account:
+            shard_config["ratelimit"][option] = account[option]
+    shard_config["ratelimit"]["max_rate"] = max(
+        shard_config["ratelimit"]["max_rate"], shard_config["ratelimit"]["rate"]
+    )
+
+    return shard_config
+
+
+class ShardedMailer:
+    """
+    send a letter from several accounts at once, the school relay limits each
+    account on its own, so every account gets its own SMTP connections and
+    rate limiter, and a share of the recipients in proportion to its rate
+    """
+
+    verbose: bool = True
+    batch: bool = False
+    config: dict = None
+    mailers: Dict[str, AutoMailer] = None
+    results: Dict[str, dict] = None
+    sent_at: float = None
+
+    def __init__(
+        self,
+        config: dict,
+        quiet: bool = False,
+        workers: int = None,
+        accounts: List[str] = None,
+        batch: bool = False,
+    ) -> None:
+        self.config = config
+        self.verbose = not quiet
+        self.batch = batch
+        if not accounts:
+            accounts = list(config["accounts"])
+        for account_id in accounts:
+            if account_id not in config["accounts"]:
+                richError(f"[account.{account_id}] is not in config.ini")
+
+        self.mailers = {}
+        self.results = {}
+        for account_id in accounts:
+            mailer_config = account_config(config, account_id)
+            host, port = mailer_config["smtp"]["host"], mailer_config["smtp"]["port"]
+            # the relay limits every account on its own, so are the rates learned
+            rate_limiter = RateLimiter.from_config(
+                mailer_config, key=f"{mailer_config['account']['userid']}@{host}:{port}"
+            )
+            print(f"Account [blue]{account_id}")
+            self.mailers[account_id] = AutoMailer(
+                mailer_config,
+                quiet=quiet,
+                workers=workers,
+                rate_limiter=rate_limiter,
+                batch=batch,
+            )
+
+    @property
+    def userid(self) -> str:
+        """the user id of the first account"""
+        return next(iter(self.mailers.values())).userid
+
+    @property
+    def senders(self) -> List[str]:
+        """user ids of the accounts that sent emails"""
+        return [sender for mailer in self.mailers.values() for sender in mailer.senders]
+
+    @property
+    def total_count(self) -> int:
+        return sum(mailer.total_count for mailer in self.mailers.values())
+
+    @property
+    def success_count(self) -> int:
+        return sum(mailer.success_count for mailer in self.mailers.values())
+
+    def login(self, password: str = None) -> None:
+        """
+        login every account, asks for the credentials unless `password` is
+        given, which is then used for all of them
+        """
+        if self.batch:
+            self.login_batch(password)
+            return
+
+        for account_id, mailer in self.mailers.items():
+            userid = self.config["accounts"][account_id]["userid"]
+            if password is not None:
+                mailer.login(userid, password)
+            else:
+                print(f"\n[blue]Account {account_id}")
+                mailer.login()
+
+    def login_batch(self, password: str = None) -> None:
+        """
+        login every account without asking, with `password` if given,
+        else with the password of each account in the environment or keyring
+        """
+        for mailer in self.mailers.values():
+            mailer.login_batch(password)
+
+    def shard(self, letter: Letter) -> Dict[str, Letter]:
+        """
+        split the recipients of the letter across the accounts, in proportion
+        to their long-run rates, the rows of every shard are spread over the
+        whole letter
+        """
+        weights = {
+            account_id: max(mailer.rate_limiter.sustained_rate, 1e-6)
+            for account_id, mailer in self.mailers.items()
+        }
+        rows = {account_id: [] for account_id in self.mailers}
+        for row in letter.pending_rows:
+            # the account furthest behind its share takes the next row
+            account_id = min(weights, key=lambda a: (len(rows[a]) + 1) / weights[a])
+            rows[account_id].append(row)
+
+        return {account_id: letter.shard(rows[account_id]) for account_id in rows}
+
+    def send_emails(
+        self,
+        letter: Letter,
+        *,
+        test_mode: bool = False,
+        dry: bool = False,
+        journal: SendJournal = None,
+        dead_letters: DeadLetters = None,
+        message_index: MessageIndex = None,
+        confirm: bool = True,
+    ) -> None:
+        """
+        send the shards of the letter in parallel, each account setting its
+        own sender address, then report the results of every account,
+        the arguments are those of AutoMailer.send_emails, raises the error
+        that stopped the first failed account once the others are done
+        """
+        shards = self.shard(letter)
+        if test_mode:
+            # every account sends one email to itself
+            shards = {
+                account_id: letter.shard(letter.pending_rows[:1])
+                for account_id in self.mailers
+            }
+
+        self.__print_shards(shards)
+        if confirm and not self.batch:
+            next(iter(self.mailers.values())).confirm_sending(letter)
+
+        if self.sent_at is None:
+            self.sent_at = time.time()
+
+        progress = AutoMailer.create_progress()
+        with progress:
+            threads = [
+                threading.Thread(
+                    target=self.__send_shard,
+                    args=(account_id, shard, progress),
+                    kwargs={
+                        "test_mode": test_mode,
+                        "dry": dry,
+                        "journal": journal,
+                        "dead_letters": dead_letters,
+                        "message_index": message_index,
+                    },
+                    daemon=True,
+                )
+                for account_id, shard in shards.items()
+                if len(shard) > 0
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if dry:
+            print("[red]This is a dry run, no emails were actually sent")
+        self.print_report()
+
+        for result in self.results.values():
+            if result["error"] is not None:
+                raise result["error"]
+
+    def __send_shard(self, account_id: str, shard: Letter, progress, **kwargs) -> None:
+        mailer = self.mailers[account_id]
+        start = time.perf_counter()
+        error = None
+        try:
+            mailer.send_emails(shard, confirm=False, progress=progress, **kwargs)
+        except Exception as e:
+            logging.error(e)
+            logging.error(f"Failed to send the emails of account {account_id}")
+            progress.print(f"[red]account {account_id} stopped: {e}")
+            error = e
+
+        self.results[account_id] = {
+            "recipients": len(shard),
+            "seconds": time.perf_counter() - start,
+            "error": error,
+        }
+
+    def __print_shards(self, shards: Dict[str, Letter]) -> None:
+        if not self.verbose:
+            return
+        for account_id, shard in shards.items():
+            mailer = self.mailers[account_id]
+            print(
+                f"[blue]{account_id}[/blue] ({mailer.config['account']['userid']}): "
+                f"{len(shard)} recipient(s), {mailer.workers} connection(s), "
+                f"{mailer.rate_limiter.sustained_rate:.2f} emails/s"
+            )
+        print()
+
+    def print_report(self) -> None:
+        """the results of every account, and of all of them together"""
+        table = Table(title="Accounts")
+        table.add_column("account")
+        table.add_column("user id")
+        for column in ("recipients", "sent", "failed", "seconds", "emails/s"):
+            table.add_column(column, justify="right")
+        table.add_column("rate now", justify="right")
+
+        for account_id, mailer in self.mailers.items():
+            result = self.results.get(account_id)
+            if result is None:
+                continue
+            throughput = mailer.success_count / max(result["seconds"], 1e-9)
+            table.add_row(
+                account_id if result["error"] is None else f"[red]{account_id}",
+                mailer.userid,
+                str(result["recipients"]),
+                str(mailer.success_count),
+                str(mailer.total_count - mailer.success_count),
+                f"{result['seconds']:.1f}",
+                f"{throughput:.2f}",
+                f"{mailer.rate_limiter.rate:.2f}",
+            )
+
+        seconds = max((r["seconds"] for r in self.results.values()), default=0)
+        table.add_row(
+            "[bold]total",
+            "",
+            str(sum(r["recipients"] for r in self.results.values())),
+            str(self.success_count),
+            str(self.total_count - self.success_count),
+            f"{seconds:.1f}",
+            f"{self.success_count / max(seconds, 1e-9):.2f}",
+            "",
+        )
+        print(table)
+
+    def check_bounce_backs(self, journal: SendJournal = None) -> None:
+        """check the mailbox of every account for bounce-backs"""
+        for mailer in self.mailers.values():
+            mailer.check_bounce_backs(journal)
@@ -0,0 +1,348 @@
+import json
+import logging
+import os
+import secrets
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+from .globals import *
+
+__all__ = [
+    "Spool",
+    "SpoolJob",
+    "SpoolWorker",
+    "QUEUED",
+    "SENDING",
+    "DONE",
+    "FAILED",
+    "CANCELLED",
+    "parse_time",
+]
+
+SPOOL_PATH = APP_DIR / "spool"
+
+QUEUED = "queued"
+SENDING = "sending"
+DONE = "done"
+# the letter could not be sent at all, e.g. it became invalid
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%H:%M")
+
+
+def parse_time(text: str) -> float:
+    """
+    a local time such as `2022-09-01 08:00` as a timestamp, a time of day
+    alone is the next time the clock shows it, raises ValueError
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(text.strip(), time_format)
+        except ValueError:
+            continue
+        if time_format == "%H:%M":
+            now = datetime.now()
+            parsed = now.replace(
+                hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0
+            )
+            if parsed <= now:
+                parsed += timedelta(days=1)
+        return parsed.timestamp()
+    raise ValueError(f"unknown time format: {text}")
+
+
+class SpoolJob:
+    """a letter waiting in the spool, one JSON file per job"""
+
+    id: str = None
+    letter_path: str = None
+    status: str = QUEUED
+    queued_at: float = None
+    # not sent before this time, None for as soon as possible
+    not_before: float = None
+    bulk: bool = False
+    offline: bool = False
+    started_at: float = None
+    finished_at: float = None
+    delivered: int = 0
+    failed: int = 0
+    error: str = None
+
+    FIELDS = (
+        "id",
+        "letter_path",
+        "status",
+        "queued_at",
+        "not_before",
+        "bulk",
+        "offline",
+        "started_at",
+        "finished_at",
+        "delivered",
+        "failed",
+        "error",
+    )
+
+    def __init__(self, **fields) -> None:
+        for field in self.FIELDS:
+            if field in fields:
+                setattr(self, field, fields[field])
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def is_due(self, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        return self.not_before is None or self.not_before <= now
+
+
+class Spool:
+    """
+    letters queued for the worker, stored as one JSON file per job under
+    APP_DIR, every change is written to a temporary file and renamed over
+    the job, so the state on disk is never half written
+
+    only one worker should drain a spool at a time
+    """
+
+    path: Path = None
+
+    def __init__(self, path: str = SPOOL_PATH) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def add(
+        self,
+        letter_path: str,
+        *,
+        not_before: float = None,
+        bulk: bool = False,
+        offline: bool = False,
+    ) -> SpoolJob:
+        job = SpoolJob(
+            id=f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}",
+            letter_path=str(Path(letter_path).absolute()),
+            queued_at=time.time(),
+            not_before=not_before,
+            bulk=bulk,
+            offline=offline,
+        )
+        self.save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[SpoolJob]:
+        try:
+            data = json.loads((self.path / f"{job_id}.json").read_text("utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            logging.error(f"Skipping corrupted spool job {job_id}")
+            return None
+        return SpoolJob(**data)
+
+    def jobs(self) -> List[SpoolJob]:
+        """every job, in the order they were queued"""
+        jobs = (self.get(path.stem) for path in self.path.glob("*.json"))
+        return sorted(
+            (job for job in jobs if job is not None),
+            key=lambda job: (job.queued_at, job.id),
+        )
+
+    def pending(self) -> List[SpoolJob]:
+        """jobs still to be sent, due or not"""
+        return [job for job in self.jobs() if job.status in (QUEUED, SENDING)]
+
+    def due(self, now: float = None) -> List[SpoolJob]:
+        return [job for job in self.pending() if job.is_due(now)]
+
+    def next_due_at(self) -> Optional[float]:
+        """when the next job becomes due, None if nothing is pending"""
+        times = [job.not_before or 0 for job in self.pending()]
+        return min(times, default=None)
+
+    def save(self, job: SpoolJob) -> None:
+        path = self.path / f"{job.id}.json"
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_text(json.dumps(job.to_dict(), indent=2), encoding="utf-8")
+        os.replace(temp_path, path)
+
+    def update(self, job: SpoolJob, **fields) -> None:
+        for field, value in fields.items():
+            setattr(job, field, value)
+        self.save(job)
+
+    def remove(self, job_id: str) -> bool:
+        """forget a job, returns whether it existed"""
+        try:
+            (self.path / f"{job_id}.json").unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class SpoolWorker:
+    """
+    drains a spool over one logged in AutoMailer, so every letter shares the
+    same warm connections and the same rate budget
+
+    the emails of the due letters are interleaved one at a time, letters
+    becoming due while others are being sent join in at the next rescan,
+    outcomes go to the journal of each letter, so a worker that is stopped
+    resumes every letter where it left off
+    """
+
+    poll: float = 30
+
+    def __init__(self, mailer, spool: Spool, poll: float = 30) -> None:
+        self.mailer = mailer
+        self.spool = spool
+        self.poll = poll
+        self.__active = set()
+
+    def run(self, once: bool = False) -> None:
+        """
+        send due letters until interrupted, with `once`, stop when nothing
+        else is due
+        """
+        from .AutoMailer import AutoMailer
+
+        while True:
+            if len(self.__due()) > 0:
+                progress = AutoMailer.create_progress()
+                with progress:
+                    self.mailer.send_outboxes(self.__feed(progress), progress)
+                self.mailer.rate_limiter.save()
+                continue
+
+            if once:
+                return
+
+            next_due_at = self.spool.next_due_at()
+            wait = self.poll
+            if next_due_at is not None:
+                wait = min(wait, max(next_due_at - time.time(), 0))
+            if next_due_at is None or wait > 0:
+                logging.info(f"Spool idle, checking again in {wait:.0f} seconds")
+                time.sleep(wait)
+            self.mailer.refresh_pool()
+
+    def __due(self) -> List[SpoolJob]:
+        return [job for job in self.spool.due() if job.id not in self.__active]
+
+    def __feed(self, progress):
+        """
+        emails of every due letter, taking turns, until none is left,
+        the spool is scanned again every `poll` seconds for letters that
+        became due or were cancelled
+        """
+        letters = deque()
+        scanned_at = None
+        while True:
+            now = time.monotonic()
+            if scanned_at is None or now - scanned_at >= self.poll or not letters:
+                for job, outbox, emails in list(letters):
+                    current = self.spool.get(job.id)
+                    if current is None or current.status == CANCELLED:
+                        letters.remove((job, outbox, emails))
+                        emails.close()
+                for job in self.__due():
+                    outbox = self.__open(job, progress)
+                    if outbox is not None:
+                        letters.append((job, outbox, outbox.emails()))
+                scanned_at = now
+                if not letters:
+                    return
+
+            job, outbox, emails = letters.popleft()
+            try:
+                email = next(emails)
+            except StopIteration:
+                continue
+            yield email, outbox
+            letters.append((job, outbox, emails))
+
+    def __open(self, job: SpoolJob, progress):
+        """the outbox of a due job, None if the letter cannot be sent"""
+        from .BounceChecker import BounceChecker
+        from .DeadLetters import DeadLetters
+        from .Journal import SendJournal
+        from .Letter import Letter
+        from .MessageIndex import MessageIndex
+        from .Outbox import Outbox
+
+        letter_path = Path(job.letter_path)
+        config = self.mailer.config
+
+        checked = None
+        if letter_path.is_dir():
+            checked = Letter.check_letter(letter_path, offline=job.offline)
+        if not checked:
+            self.__fail(job, f"{letter_path} is not a valid letter", progress)
+            return None
+
+        if job.bulk and checked.is_personalized:
+            self.__fail(job, "personalized letters cannot be sent in bulk", progress)
+            return None
+
+        letter = Letter(letter_path, config["account"]["name"], checked=checked)
+        if job.bulk:
+            try:
+                letter.set_bulk(config["smtp"]["bulk_size"])
+            except ValueError as e:
+                self.__fail(job, str(e), progress)
+                return None
+
+        journal = SendJournal.for_letter(letter_path)
+        # a job that was interrupted carries on where it stopped
+        letter.resume(journal)
+        dead_letters = DeadLetters.for_letter(letter)
+        message_index = MessageIndex.for_letter(letter_path)
+        self.mailer.set_sender(letter)
+
+        started_at = time.time()
+
+        def on_finished(outbox):
+            # counts the recipients delivered before a restart too
+            delivered = journal.delivered_count
+            journal.close()
+            message_index.close()
+            dead_letters.save()
+            if outbox.delivered > 0:
+                BounceChecker.record_send(letter_path, self.mailer.userid, started_at)
+            current = self.spool.get(job.id)
+            cancelled = current is None or current.status == CANCELLED
+            self.spool.update(
+                job,
+                status=CANCELLED if cancelled else DONE,
+                finished_at=time.time(),
+                delivered=delivered,
+                failed=len(dead_letters),
+            )
+            self.__active.discard(job.id)
+            logging.info(
+                f"Spool job {job.id} done: {outbox.delivered} delivered, "
+                f"{outbox.failed} failed"
+            )
+            progress.print(
+                f"[green]{letter_path.name}: {outbox.delivered} delivered, "
+                f"{outbox.failed} failed"
+            )
+
+        outbox = Outbox(letter, journal, dead_letters, message_index, on_finished)
+        outbox.task = progress.add_task(letter_path.name, total=len(letter))
+        self.__active.add(job.id)
+        self.spool.update(job, status=SENDING, started_at=job.started_at or started_at)
+        logging.info(
+            f"Sending spool job {job.id}: {len(letter)} emails of {letter_path}"
+        )
+        return outbox
+
+    def __fail(self, job: SpoolJob, error: str, progress) -> None:
+        logging.error(f"Spool job {job.id} failed: {error}")
+        progress.print(f"[red]{job.id}: {error}")
+        self.spool.update(job, status=FAILED, error=error, finished_at=time.time())
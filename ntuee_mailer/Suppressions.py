@@ -0,0 +1,135 @@
+import dbm
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from .globals import *
+
+__all__ = ["SuppressionList", "REASON_BOUNCED", "REASON_MANUAL", "BOUNCED_TTL"]
+
+# dbm adds its own extensions to this
+SUPPRESSIONS_PATH = APP_DIR / "suppressions"
+
+# why an address is suppressed
+REASON_BOUNCED = "bounced"
+REASON_MANUAL = "manual"
+
+# a bounced address is mailed again after this many seconds, mailboxes that
+# were full or disabled may work again, if not it bounces and is added back
+BOUNCED_TTL = 365 * 24 * 60 * 60
+
+
+class SuppressionList:
+    """
+    addresses never to be mailed again, shared by every letter, stored as a
+    dbm hash index under APP_DIR, so checking a recipient costs one lookup
+    whatever the size of the list, bounced addresses expire after
+    `bounced_ttl` seconds, the others are kept until removed
+
+    open it for as short as possible, dbm files are not meant to be written
+    by several processes at once:
+
+        with SuppressionList(flag="c") as suppressions:
+            suppressions.add(address, REASON_MANUAL)
+    """
+
+    path: Path = None
+    bounced_ttl: float = BOUNCED_TTL
+
+    def __init__(
+        self,
+        path: str = SUPPRESSIONS_PATH,
+        flag: str = "r",
+        bounced_ttl: float = BOUNCED_TTL,
+    ) -> None:
+        self.path = Path(path)
+        self.bounced_ttl = bounced_ttl
+        self.__lock = threading.Lock()
+        try:
+            self.__db = dbm.open(str(self.path), flag)
+        except dbm.error:
+            # nothing was ever suppressed
+            if flag != "r":
+                raise
+            self.__db = None
+
+    def __enter__(self) -> "SuppressionList":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @staticmethod
+    def key(address: str) -> bytes:
+        return address.strip().lower().encode("utf-8")
+
+    def get(self, address: str) -> Optional[dict]:
+        """
+        {"reason", "detail", "source", "time"} of a suppressed address,
+        None if it is not suppressed
+        """
+        if self.__db is None:
+            return None
+        with self.__lock:
+            value = self.__db.get(self.key(address))
+        if value is None:
+            return None
+        try:
+            entry = json.loads(value)
+        except ValueError:
+            logging.warning(f"Corrupted suppression entry of {address}")
+            return {"reason": None}
+        if self.__is_expired(entry):
+            return None
+        return entry
+
+    def __is_expired(self, entry: dict) -> bool:
+        if entry.get("reason") != REASON_BOUNCED:
+            return False
+        try:
+            return time.time() - float(entry["time"]) >= self.bounced_ttl
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def __contains__(self, address: str) -> bool:
+        return self.get(address) is not None
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __iter__(self) -> Iterator[str]:
+        """the suppressed addresses, in order, expired ones left out"""
+        if self.__db is None:
+            return iter(())
+        with self.__lock:
+            keys = self.__db.keys()
+        addresses = sorted(key.decode("utf-8") for key in keys)
+        return iter([address for address in addresses if address in self])
+
+    def add(
+        self, address: str, reason: str, detail: str = None, source: str = None
+    ) -> None:
+        value = json.dumps(
+            {"reason": reason, "detail": detail, "source": source, "time": time.time()},
+            ensure_ascii=False,
+        )
+        with self.__lock:
+            self.__db[self.key(address)] = value.encode("utf-8")
+
+    def remove(self, address: str) -> bool:
+        """returns whether the address was suppressed"""
+        with self.__lock:
+            try:
+                del self.__db[self.key(address)]
+                return True
+            except KeyError:
+                return False
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
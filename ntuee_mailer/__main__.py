@@ -1,4 +1,6 @@
 from .main import app
 from .globals import APP_NAME
 
-app(prog_name=APP_NAME)
\ No newline at end of file
+# worker processes of the rendering pool import this module again
+if __name__ == "__main__":
+    app(prog_name=APP_NAME)
@@ -0,0 +1,83 @@
+import os
+from typing import Optional, Tuple
+
+from .globals import *
+from .utils import richError
+
+__all__ = [
+    "USERID_ENV",
+    "PASSWORD_ENV",
+    "read_password_fd",
+    "lookup_password",
+    "batch_password",
+    "batch_login_info",
+]
+
+# used when config.ini has no user id
+USERID_ENV = "NTUEE_MAILER_USERID"
+PASSWORD_ENV = "NTUEE_MAILER_PASSWORD"
+
+
+def read_password_fd(fd: int) -> str:
+    """the first line read from file descriptor `fd`, e.g. 3 with `3<password.txt`"""
+    try:
+        with os.fdopen(fd, "r", encoding="utf-8", closefd=True) as f:
+            return f.readline().rstrip("\r\n")
+    except OSError as e:
+        richError(
+            f"Cannot read the password from file descriptor {fd}: {e}",
+            code=EXIT_LOGIN_FAILED,
+        )
+
+
+def lookup_password(userid: str) -> Optional[str]:
+    """
+    the password of `userid` from $NTUEE_MAILER_PASSWORD, or else from the
+    system keyring if the keyring package is installed, None if neither has it
+    """
+    password = os.environ.get(PASSWORD_ENV)
+    if password:
+        return password
+
+    try:
+        import keyring
+    except ImportError:
+        return None
+
+    try:
+        return keyring.get_password(APP_NAME, userid)
+    except Exception:
+        # no usable keyring backend, e.g. on a headless server
+        return None
+
+
+def batch_login_info(config: dict, password: str = None) -> Tuple[str, str]:
+    """
+    the user id and password of the account of `config` without asking,
+    `password` if given takes precedence over the environment and the keyring,
+    exits with EXIT_LOGIN_FAILED if either is missing
+    """
+    userid = config["account"].get("userid") or os.environ.get(USERID_ENV)
+    if not userid:
+        richError(
+            f"No user id: set account.userid in config.ini or ${USERID_ENV}",
+            code=EXIT_LOGIN_FAILED,
+        )
+
+    return userid, batch_password(userid, password)
+
+
+def batch_password(userid: str, password: str = None) -> str:
+    """
+    `password` if given, else the password of `userid` from the environment
+    or the keyring, exits with EXIT_LOGIN_FAILED if there is none
+    """
+    if password is None:
+        password = lookup_password(userid)
+    if not password:
+        richError(
+            f"No password for {userid}: use --password-fd, set ${PASSWORD_ENV} "
+            f"or store it with `keyring set {APP_NAME} {userid}`",
+            code=EXIT_LOGIN_FAILED,
+        )
+    return password
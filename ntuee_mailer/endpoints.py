@@ -0,0 +1,17 @@
+from typing import Tuple
+
+__all__ = ["endpoint"]
+
+
+def endpoint(config: dict, service: str) -> Tuple[str, int]:
+    """
+    (host, port) to connect to for the smtp or pop3 section of config,
+    the fake servers when they are enabled
+    """
+    if config.get("fake", {}).get("enabled", False):
+        # only runs against the fake servers load them
+        from .FakeServers import FAKE_HOST, start_fake_servers
+
+        servers = start_fake_servers(config)
+        return FAKE_HOST, getattr(servers, service).port
+    return config[service]["host"], config[service]["port"]
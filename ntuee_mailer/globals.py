@@ -1,13 +1,27 @@
-import typer
 import os
 import shutil
 from pathlib import Path
 
+# typer.get_app_dir is click's, importing click alone is much cheaper
+from click import get_app_dir
+
 APP_NAME = "ntuee-mailer"
 APP_ROOT = Path(os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__))))
-APP_DIR = Path(typer.get_app_dir(APP_NAME))
-# make APP_DIR if it doesn't exist
-APP_DIR.mkdir(parents=True, exist_ok=True)
+APP_DIR = Path(get_app_dir(APP_NAME))
 CONFIG_PATH = Path(APP_DIR) / "config.ini"
-if not CONFIG_PATH.is_file():
-    shutil.copy(APP_ROOT / "config-default.ini", CONFIG_PATH)
+
+# exit codes, 2 is a usage error reported by typer
+EXIT_OK = 0
+# invalid letter or config, cancelled, or any other error
+EXIT_ERROR = 1
+EXIT_LOGIN_FAILED = 3
+EXIT_CONNECTION_FAILED = 4
+# sent, but some recipients could not be delivered
+EXIT_UNDELIVERED = 5
+
+
+def ensure_app_dir() -> None:
+    """make APP_DIR and a default config.ini if they don't exist"""
+    APP_DIR.mkdir(parents=True, exist_ok=True)
+    if not CONFIG_PATH.is_file():
+        shutil.copy(APP_ROOT / "config-default.ini", CONFIG_PATH)
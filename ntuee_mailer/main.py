@@ -1,22 +1,30 @@
 import typer
 from rich import print
-from rich.prompt import Confirm, Prompt
 
 import os
 import logging
 import shutil
 import time
+from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 from .utils import *
-from .AutoMailer import AutoMailer
-from .Letter import Letter
 from .globals import *
 
+# every invocation, --help and shell completion included, imports this module,
+# modules pulling in heavy dependencies (cerberus, yaml, email_validator,
+# smtplib, poplib) are imported by the commands that use them
+
 app = typer.Typer()
 
 
+@app.callback()
+def main():
+    """an auto mailer to send emails in batch for you"""
+    ensure_app_dir()
+
+
 @app.command()
 def send(
     letter_path: Optional[Path] = typer.Argument(
@@ -38,8 +46,82 @@ def send(
         logging.NOTSET, "--debug", "-d", help="Debug level", min=0, max=5, clamp=True,
     ),
     dry_run: bool = typer.Option(False, "--dry-run", help="Dry run: do not send mails"),
+    workers: Optional[int] = typer.Option(
+        None,
+        "--workers",
+        "-w",
+        help="Number of SMTP connections used in parallel [default: smtp.connections in config.ini]",
+        min=1,
+    ),
+    resume: bool = typer.Option(
+        False, "--resume", help="Skip recipients already delivered by a previous run"
+    ),
+    retry_dead_letters: bool = typer.Option(
+        False,
+        "--dead-letters",
+        help="Only send to the recipients listed in dead-letters.csv",
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help="Only check the syntax of email addresses, without DNS lookups",
+    ),
+    bulk: bool = typer.Option(
+        False,
+        "--bulk",
+        help="Send one email to many recipients in Bcc, for letters that are the "
+        "same for everyone [batch size: smtp.bulk_size in config.ini]",
+    ),
+    include_suppressed: bool = typer.Option(
+        False,
+        "--include-suppressed",
+        help="Also send to recipients in the suppression list",
+    ),
+    accounts: Optional[List[str]] = typer.Option(
+        None,
+        "--account",
+        "-a",
+        help="Only send from these [account.<id>] sections of config.ini "
+        "[default: all of them]",
+    ),
+    render_processes: int = typer.Option(
+        1,
+        "--render-processes",
+        "-p",
+        help="Render emails in this many processes while sending, "
+        "for big personalized letters, 0 for one per CPU core",
+        min=0,
+    ),
+    batch: bool = typer.Option(
+        False,
+        "--batch",
+        help="Batch mode: never ask or pause, for cron jobs and CI, the password "
+        "comes from --password-fd, $NTUEE_MAILER_PASSWORD or the keyring",
+    ),
+    password_fd: Optional[int] = typer.Option(
+        None,
+        "--password-fd",
+        help="Read the password from this file descriptor in batch mode, "
+        "e.g. 3 with 3<password.txt",
+        min=0,
+    ),
 ):
-    """send emails to a list of recipients as configured in your letter"""
+    """
+    send emails to a list of recipients as configured in your letter,
+    with [account.<id>] sections in config.ini, recipients are shared out
+    among those accounts, exits with 5 if some recipients could not be
+    delivered, see README for the other exit codes
+    """
+    from .AutoMailer import AutoMailer
+    from .BounceChecker import BounceChecker
+    from .DeadLetters import DeadLetters
+    from .Journal import SendJournal
+    from .Letter import Letter
+    from .MessageIndex import MessageIndex
+    from .Metrics import metrics
+    from .Rendering import cpu_count
+    from .credentials import read_password_fd
+
     if letter_path is None:
         letter_names = list(
             filter(lambda letter: Path(letter).is_dir(), os.listdir("."),)
@@ -49,13 +131,21 @@ def send(
             richError(
                 f"Can't find any letters in {os.getcwd()}, please specify a letter path"
             )
+        if batch:
+            richError("Please specify a letter path in batch mode")
 
         letter_name = typerSelect("Please select a letter", letter_names)
         letter_path = Path(letter_name).absolute()
 
     print(f"Using letter [blue]{letter_path}\n")
 
-    if not Letter.check_letter(letter_path, verbose=not quiet):
+    checked_letter = Letter.check_letter(
+        letter_path,
+        verbose=not quiet,
+        offline=offline,
+        suppress=not include_suppressed,
+    )
+    if not checked_letter:
         richError(f"Invalid letter: {letter_path}")
         return
 
@@ -63,28 +153,820 @@ def send(
 
     if test_mode:
         print("[blue]Entering test mode...\n")
-        time.sleep(1)
+        if not batch:
+            time.sleep(1)
 
     if dry_run:
         print("[blue]Entering dry run mode...\n")
-        time.sleep(1)
+        if not batch:
+            time.sleep(1)
 
-    auto_mailer_config = AutoMailer.load_mailer_config(config_path)
-    auto_mailer = AutoMailer(auto_mailer_config, quiet=quiet)
+    password = None
+    if batch and password_fd is not None:
+        password = read_password_fd(password_fd)
+
+    auto_mailer_config = AutoMailer.load_mailer_config(config_path, batch=batch)
+    if len(auto_mailer_config["accounts"]) > 0:
+        from .ShardedMailer import ShardedMailer
+
+        auto_mailer = ShardedMailer(
+            auto_mailer_config,
+            quiet=quiet,
+            workers=workers,
+            accounts=accounts,
+            batch=batch,
+        )
+    else:
+        if accounts:
+            richError("There are no [account.<id>] sections in config.ini")
+        auto_mailer = AutoMailer(
+            auto_mailer_config, quiet=quiet, workers=workers, batch=batch
+        )
     emails = Letter(
-        letter_path, auto_mailer_config["account"]["name"], test_mode=test_mode,
+        letter_path,
+        auto_mailer_config["account"]["name"],
+        test_mode=test_mode,
+        checked=checked_letter,
+    )
+
+    emails.set_render_processes(render_processes or cpu_count())
+
+    bulk_size = auto_mailer_config["smtp"]["bulk_size"]
+    if bulk:
+        if emails.is_personalized:
+            richError(
+                "--bulk only works for letters that are the same for every "
+                "recipient: no fields in content.html other than $sender and "
+                "no cc or bcc in recipients.csv"
+            )
+        try:
+            emails.set_bulk(bulk_size)
+        except ValueError as e:
+            richError(f"Cannot send in bulk: {e}, raise smtp.bulk_size in config.ini")
+        print(
+            f"Sending in bulk, up to {emails.bulk_rows} recipients per email "
+            f"besides {emails.fixed_recipient_count} cc, bcc or sender address(es)\n"
+        )
+    elif not emails.is_personalized and len(emails) > 1:
+        print(
+            "[blue]This letter is the same for every recipient, "
+            f"--bulk sends it to up to {bulk_size} recipients per email\n"
+        )
+
+    # test mode and dry runs do not deliver anything worth recording
+    journal = None
+    dead_letters = None
+    message_index = None
+    if not test_mode and not dry_run:
+        journal = SendJournal.for_letter(letter_path)
+        dead_letters = DeadLetters.for_letter(emails)
+        message_index = MessageIndex.for_letter(letter_path)
+
+    if retry_dead_letters:
+        dead_rows = DeadLetters.for_letter(emails).rows
+        if len(dead_rows) == 0:
+            richSuccess("There are no dead letters to send")
+            return
+        emails.select(dead_rows)
+        print(f"Sending to {len(emails)} recipient(s) from dead letters\n")
+
+    if journal is not None:
+        if resume:
+            skipped = emails.resume(journal)
+            print(f"Resuming: skipping {skipped} already delivered recipient(s)\n")
+            logging.info(f"Resuming, {skipped} recipients already delivered")
+            if len(emails) == 0:
+                richSuccess("All recipients have already been delivered")
+                return
+        elif journal.delivered_count > 0 and not retry_dead_letters:
+            richWarning(
+                f"{journal.delivered_count} recipient(s) were already delivered "
+                "by a previous run, use --resume to skip them"
+            )
+
+    metrics.reset()
+    if batch:
+        auto_mailer.login_batch(password)
+    else:
+        auto_mailer.login()
+    try:
+        with metrics.timer("send_seconds"):
+            auto_mailer.send_emails(
+                emails,
+                test_mode=test_mode,
+                dry=dry_run,
+                journal=journal,
+                dead_letters=dead_letters,
+                message_index=message_index,
+            )
+    except Exception as e:
+        # e.g. the journal could not be written, the recipients it missed
+        # would be sent again by --resume
+        logging.exception(e)
+        richError(f"Sending stopped: {e}")
+    finally:
+        if journal is not None:
+            journal.close()
+        if message_index is not None:
+            message_index.close()
+        metrics.write(letter_path)
+
+    richSuccess(
+        f"{auto_mailer.success_count} / {auto_mailer.total_count} emails sent successfully"
+    )
+
+    if journal is not None and auto_mailer.total_count > 0:
+        for userid in auto_mailer.senders:
+            BounceChecker.record_send(letter_path, userid, auto_mailer.sent_at)
+        print(
+            "Bounce-backs may take a while to arrive, check for them with\n"
+            f"[blue]  ntuee-mailer bounces {letter_path} --watch"
+        )
+
+    if not dry_run and auto_mailer.success_count < auto_mailer.total_count:
+        raise typer.Exit(EXIT_UNDELIVERED)
+
+
+class ExportFormat(str, Enum):
+    eml = "eml"
+    maildir = "maildir"
+    mbox = "mbox"
+
+
+@app.command()
+def export(
+    letter_path: Path = typer.Argument(
+        ..., help="Path to letter", exists=True, file_okay=False
+    ),
+    output_path: Path = typer.Argument(
+        ..., help="A new directory, or a new file for mbox, to export the emails to"
+    ),
+    export_format: ExportFormat = typer.Option(
+        "eml",
+        "--format",
+        "-f",
+        help="eml: a directory of .eml files, maildir: a Maildir, mbox: one file",
+    ),
+    config_path: Path = typer.Option(
+        CONFIG_PATH,
+        "--config",
+        "-c",
+        help="Path to config.ini",
+        exists=True,
+        dir_okay=False,
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help="Only check the syntax of email addresses, without DNS lookups",
+    ),
+    bulk: bool = typer.Option(
+        False, "--bulk", help="Export the emails `send --bulk` would send"
+    ),
+    include_suppressed: bool = typer.Option(
+        False,
+        "--include-suppressed",
+        help="Also export emails to recipients in the suppression list",
+    ),
+    render_processes: int = typer.Option(
+        0,
+        "--render-processes",
+        "-p",
+        help="Render emails in this many processes, 0 for one per CPU core",
+        min=0,
+    ),
+    writers: int = typer.Option(
+        4, "--writers", help="Threads writing the .eml and Maildir files", min=1
+    ),
+    sender: str = typer.Option(
+        None,
+        "--from",
+        help="User id of the sender, school emails may omit @ntu.edu.tw "
+        "[default: account.userid in config.ini]",
+    ),
+):
+    """
+    render every email of a letter exactly as `send` would, without sending
+    anything, along with their envelopes, `load-test --fixture` sends them
+    to the fake servers
+    """
+    from .AutoMailer import AutoMailer
+    from .credentials import USERID_ENV
+    from .Exporter import create_exporter, envelopes_path
+    from .Letter import Letter
+    from .Rendering import cpu_count
+
+    if output_path.is_dir() and export_format != ExportFormat.mbox:
+        if any(output_path.iterdir()):
+            richError(f"{output_path} is not empty, please export to a new directory")
+    elif output_path.exists():
+        richError(f"{output_path} already exists, please export to a new path")
+
+    checked_letter = Letter.check_letter(
+        letter_path, offline=offline, suppress=not include_suppressed
+    )
+    if not checked_letter:
+        richError(f"Invalid letter: {letter_path}")
+
+    config = AutoMailer.load_mailer_config(config_path)
+    letter = Letter(letter_path, config["account"]["name"], checked=checked_letter)
+    letter.set_render_processes(render_processes or cpu_count())
+    if bulk:
+        if letter.is_personalized:
+            richError(f"{letter_path} is personalized, it cannot be sent in bulk")
+        try:
+            letter.set_bulk(config["smtp"]["bulk_size"])
+        except ValueError as e:
+            richError(f"Cannot export in bulk: {e}")
+    # the sender `send` would use, emails without one could not be sent as is
+    sender = sender or config["account"].get("userid") or os.environ.get(USERID_ENV)
+    if not sender:
+        richError(
+            "No sender: use --from, set account.userid in config.ini "
+            f"or ${USERID_ENV}"
+        )
+    letter.set_from_addr(complete_school_email(sender), verp=config["smtp"]["verp"])
+
+    exporter = create_exporter(
+        output_path, export_format.value, letter.skeleton.tail, writers
+    )
+    start = time.perf_counter()
+    with AutoMailer.create_progress() as progress, exporter:
+        task = progress.add_task("Exporting emails...", total=len(letter))
+        for email in letter:
+            exporter.write(email)
+            progress.advance(task, len(email.deliveries))
+    elapsed = time.perf_counter() - start
+
+    logging.info(f"Exported {exporter.count} emails of {letter_path} to {output_path}")
+    richSuccess(
+        f"{exporter.count} emails exported to {output_path} in {elapsed:.2f} seconds"
+    )
+    print(
+        f"Envelopes are in {envelopes_path(output_path)}, "
+        "send the emails to the fake servers with\n"
+        f"[blue]  ntuee-mailer load-test --fixture {output_path}"
+    )
+
+
+@app.command()
+def bounces(
+    letter_path: Path = typer.Argument(
+        ..., help="Path to a letter that was sent", exists=True, file_okay=False
+    ),
+    config_path: Path = typer.Option(
+        CONFIG_PATH,
+        "--config",
+        "-c",
+        help="Path to config.ini",
+        exists=True,
+        dir_okay=False,
+    ),
+    watch: bool = typer.Option(
+        False, "--watch", "-w", help="Keep checking until interrupted or --duration"
+    ),
+    interval: float = typer.Option(
+        30, "--interval", help="Seconds between checks in watch mode", min=1
+    ),
+    max_interval: float = typer.Option(
+        900,
+        "--max-interval",
+        help="Checks back off up to this many seconds while nothing bounces",
+        min=1,
+    ),
+    duration: float = typer.Option(
+        24 * 60 * 60, "--duration", help="Stop watching after this many seconds", min=0
+    ),
+    debugLevel: int = typer.Option(
+        logging.NOTSET,
+        "--debug",
+        "-d",
+        help="Debug level",
+        min=0,
+        max=5,
+        clamp=True,
+    ),
+    batch: bool = typer.Option(
+        False,
+        "--batch",
+        help="Batch mode: never ask or pause, for cron jobs and CI, the password "
+        "comes from --password-fd, $NTUEE_MAILER_PASSWORD or the keyring",
+    ),
+    password_fd: Optional[int] = typer.Option(
+        None,
+        "--password-fd",
+        help="Read the password from this file descriptor in batch mode, "
+        "e.g. 3 with 3<password.txt",
+        min=0,
+    ),
+):
+    """
+    check for bounce-backs of a letter sent before, and record them in its journal,
+    the mailbox of every account the letter was sent from is checked
+    """
+    from .AutoMailer import AutoMailer
+    from .BounceChecker import BounceChecker, record_bounces
+    from .Journal import SendJournal
+    from .MessageIndex import MessageIndex
+    from .Suppressions import SuppressionList
+    from .credentials import batch_password, read_password_fd
+
+    setup_logger(letter_path / "log.txt", debugLevel)
+
+    message_index = MessageIndex.for_letter(letter_path)
+    if len(message_index) == 0:
+        richError(f"No emails of {letter_path} were sent, nothing to check")
+
+    auto_mailer_config = AutoMailer.load_mailer_config(config_path, batch=batch)
+    # bounce-backs go to the mailbox of the account that sent the email
+    userids = BounceChecker.senders(letter_path)
+    if len(userids) == 0:
+        # sent before the accounts were recorded, from the saved account
+        userids = [auto_mailer_config["account"].get("userid")]
+
+    checkers = []
+    if batch:
+        password = None
+        if password_fd is not None:
+            password = read_password_fd(password_fd)
+        for userid in userids:
+            if userid is None:
+                richError("Please set account.userid in config.ini in batch mode")
+            checkers.append(
+                BounceChecker.for_letter(
+                    auto_mailer_config,
+                    userid,
+                    batch_password(userid, password),
+                    letter_path,
+                )
+            )
+    elif userids == [None]:
+        userid, password = AutoMailer.prompt_login_info(auto_mailer_config)
+        checkers.append(
+            BounceChecker.for_letter(auto_mailer_config, userid, password, letter_path)
+        )
+    else:
+        for userid in userids:
+            password = AutoMailer.prompt_password(userid)
+            checkers.append(
+                BounceChecker.for_letter(
+                    auto_mailer_config, userid, password, letter_path
+                )
+            )
+
+    found = 0
+    failed = False
+    deadline = time.monotonic() + duration
+    wait = interval
+    with SendJournal.for_letter(letter_path) as journal:
+        while True:
+            bounced = None
+            try:
+                for checker in checkers:
+                    try:
+                        messages = checker.scan(since=checker.sent_at)
+                    except Exception as e:
+                        logging.error(e)
+                        logging.error(f"Failed to check {checker.mailbox} for bounces")
+                        richError(
+                            f"Failed to check bounce-backs of {checker.mailbox}",
+                            terminate=False,
+                        )
+                        failed = True
+                        continue
+                    bounced = (bounced or []) + checker.resolve(messages, message_index)
+            except KeyboardInterrupt:
+                break
+
+            if bounced:
+                with SuppressionList(flag="c") as suppressions:
+                    record_bounces(journal, bounced, suppressions)
+                print_bounces(bounced)
+                found += sum(1 for bounce in bounced if not bounce.delayed)
+                wait = interval
+            elif bounced is not None and not watch:
+                print_bounces(bounced)
+
+            if not watch or time.monotonic() + wait > deadline:
+                break
+
+            print(f"[blue]checking again in {wait:.0f} seconds...")
+            try:
+                time.sleep(wait)
+            except KeyboardInterrupt:
+                break
+
+            # back off while nothing bounces
+            if not bounced:
+                wait = min(wait * 2, max_interval)
+
+    logging.info(f"Found {found} bounce-backs")
+    richSuccess(f"{found} new bounce-back(s) recorded in {journal.path}")
+    if failed and not watch:
+        raise typer.Exit(EXIT_ERROR)
+
+
+@app.command()
+def suppress(
+    addresses: Optional[List[str]] = typer.Argument(
+        None, help="Email addresses, school emails may omit @ntu.edu.tw"
+    ),
+    remove: bool = typer.Option(
+        False, "--remove", "-r", help="Mail the addresses again instead"
+    ),
+    list_suppressed: bool = typer.Option(
+        False, "--list", "-l", help="List suppressed addresses"
+    ),
+    note: Optional[str] = typer.Option(
+        None, "--note", "-n", help="Why the addresses are suppressed"
+    ),
+):
+    """
+    keep addresses from being mailed by any letter,
+    addresses that bounce back for good are added by `bounces`
+    """
+    from .Suppressions import SuppressionList, REASON_MANUAL
+
+    if list_suppressed:
+        with SuppressionList() as suppressions:
+            for address in suppressions:
+                entry = suppressions.get(address)
+                added = time.strftime("%Y/%m/%d", time.localtime(entry.get("time", 0)))
+                details = (entry.get(key) for key in ("reason", "detail", "source"))
+                print(address, added, *filter(None, details), sep="\t")
+            print(f"{len(suppressions)} suppressed address(es)")
+        return
+
+    if not addresses:
+        richError("Please give the addresses to suppress, or --list them")
+
+    addresses = [complete_school_email(a.strip().lower()) for a in addresses]
+    with SuppressionList(flag="c") as suppressions:
+        for address in addresses:
+            if not remove:
+                suppressions.add(address, REASON_MANUAL, detail=note)
+                logging.info(f"Suppressed {address}")
+            elif suppressions.remove(address):
+                logging.info(f"Removed {address} from the suppression list")
+            else:
+                richWarning(f"{address} is not suppressed")
+
+    if remove:
+        richSuccess("Addresses removed from the suppression list")
+    else:
+        richSuccess(f"{len(addresses)} address(es) will not be mailed again")
+
+
+@app.command()
+def queue(
+    letter_paths: Optional[List[Path]] = typer.Argument(
+        None, help="Paths to letters", exists=True, file_okay=False
+    ),
+    at: Optional[str] = typer.Option(
+        None,
+        "--at",
+        help="Do not send before this local time, e.g. '2022-09-01 08:00' or '08:00'",
+    ),
+    bulk: bool = typer.Option(
+        False,
+        "--bulk",
+        help="Send in bulk, see `send --bulk`",
+    ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help="Only check the syntax of email addresses, without DNS lookups",
+    ),
+    list_jobs: bool = typer.Option(False, "--list", "-l", help="List queued letters"),
+    cancel: Optional[List[str]] = typer.Option(
+        None, "--cancel", help="Cancel the queued letter with this id"
+    ),
+    clean: bool = typer.Option(
+        False, "--clean", help="Forget letters that are done, failed or cancelled"
+    ),
+):
+    """
+    queue letters to be sent by `ntuee-mailer worker`, letters are checked
+    when queued and again when they are sent
+    """
+    from .Spool import Spool, parse_time, QUEUED, SENDING, CANCELLED
+
+    spool = Spool()
+
+    if list_jobs:
+        for job in spool.jobs():
+            when = "now"
+            if job.not_before is not None:
+                when = time.strftime("%Y/%m/%d %H:%M", time.localtime(job.not_before))
+            details = f"{job.delivered} delivered, {job.failed} failed"
+            if job.error is not None:
+                details = job.error
+            print(job.id, job.status, when, job.letter_path, details, sep="\t")
+        return
+
+    if cancel:
+        for job_id in cancel:
+            job = spool.get(job_id)
+            if job is None:
+                richWarning(f"{job_id} is not in the spool")
+            elif job.status not in (QUEUED, SENDING):
+                richWarning(f"{job_id} is already {job.status}")
+            else:
+                spool.update(job, status=CANCELLED, finished_at=time.time())
+                richSuccess(f"{job_id} cancelled")
+        return
+
+    if clean:
+        finished = [job for job in spool.jobs() if job.status not in (QUEUED, SENDING)]
+        for job in finished:
+            spool.remove(job.id)
+        richSuccess(f"{len(finished)} finished letter(s) removed from the spool")
+        return
+
+    if not letter_paths:
+        richError("Please give the letters to queue, or --list them")
+
+    not_before = None
+    if at is not None:
+        try:
+            not_before = parse_time(at)
+        except ValueError as e:
+            richError(str(e))
+
+    from .Letter import Letter
+
+    for letter_path in letter_paths:
+        checked_letter = Letter.check_letter(letter_path, verbose=True, offline=offline)
+        if not checked_letter:
+            richError(f"Invalid letter: {letter_path}")
+        if bulk and checked_letter.is_personalized:
+            richError(f"{letter_path} is personalized, it cannot be sent in bulk")
+
+    for letter_path in letter_paths:
+        job = spool.add(letter_path, not_before=not_before, bulk=bulk, offline=offline)
+        logging.info(f"Queued {letter_path} as {job.id}")
+        richSuccess(f"{letter_path} queued as {job.id}")
+
+    print("Start [blue]ntuee-mailer worker[/blue] to send queued letters")
+
+
+@app.command()
+def worker(
+    config_path: Path = typer.Option(
+        CONFIG_PATH,
+        "--config",
+        "-c",
+        help="Path to config.ini",
+        exists=True,
+        dir_okay=False,
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        "--workers",
+        "-w",
+        help="Number of SMTP connections used in parallel [default: smtp.connections in config.ini]",
+        min=1,
+    ),
+    poll: float = typer.Option(
+        30, "--poll", help="Seconds between checks of the spool", min=1
+    ),
+    once: bool = typer.Option(
+        False, "--once", help="Exit once no queued letter is due, instead of waiting"
+    ),
+    debugLevel: int = typer.Option(
+        logging.NOTSET,
+        "--debug",
+        "-d",
+        help="Debug level",
+        min=0,
+        max=5,
+        clamp=True,
+    ),
+    batch: bool = typer.Option(
+        False,
+        "--batch",
+        help="Batch mode: never ask or pause, for cron jobs and CI, the password "
+        "comes from --password-fd, $NTUEE_MAILER_PASSWORD or the keyring",
+    ),
+    password_fd: Optional[int] = typer.Option(
+        None,
+        "--password-fd",
+        help="Read the password from this file descriptor in batch mode, "
+        "e.g. 3 with 3<password.txt",
+        min=0,
+    ),
+):
+    """
+    send the letters queued with `ntuee-mailer queue` over one set of SMTP
+    connections, letters due at the same time take turns, a stopped worker
+    carries on where it left off when started again
+    """
+    from .AutoMailer import AutoMailer
+    from .Spool import Spool, SpoolWorker
+    from .credentials import read_password_fd
+
+    setup_logger(APP_DIR / "worker-log.txt", debugLevel)
+
+    auto_mailer_config = AutoMailer.load_mailer_config(config_path, batch=batch)
+    auto_mailer = AutoMailer(
+        auto_mailer_config, quiet=True, workers=workers, batch=batch
     )
-    auto_mailer.login()
-    auto_mailer.send_emails(emails, test_mode=test_mode, dry=dry_run)
-    auto_mailer.check_bounce_backs()
+    if batch:
+        password = None
+        if password_fd is not None:
+            password = read_password_fd(password_fd)
+        auto_mailer.login_batch(password)
+    else:
+        auto_mailer.login()
+
+    spool = Spool()
+    print(f"Sending letters queued in [blue]{spool.path}[/blue], Ctrl+C to stop")
+    try:
+        SpoolWorker(auto_mailer, spool, poll=poll).run(once=once)
+    except KeyboardInterrupt:
+        logging.info("Worker stopped")
+        richWarning("Worker stopped, queued letters are sent when it starts again")
+        return
+
     richSuccess(
         f"{auto_mailer.success_count} / {auto_mailer.total_count} emails sent successfully"
     )
+    if auto_mailer.success_count < auto_mailer.total_count:
+        raise typer.Exit(EXIT_UNDELIVERED)
+
+
+@app.command("load-test")
+def load_test(
+    config_path: Path = typer.Option(
+        CONFIG_PATH,
+        "--config",
+        "-c",
+        help="Path to config.ini, its [fake] section configures the fake servers",
+        exists=True,
+        dir_okay=False,
+    ),
+    recipients: int = typer.Option(
+        1000, "--recipients", "-n", help="Number of recipients", min=1
+    ),
+    attachment_mb: float = typer.Option(
+        0, "--attachment-mb", help="Total size of attachments", min=0
+    ),
+    workers: Optional[int] = typer.Option(
+        None,
+        "--workers",
+        "-w",
+        help="Number of SMTP connections used in parallel",
+        min=1,
+    ),
+    rate: Optional[float] = typer.Option(
+        None,
+        "--rate",
+        help="Emails per second to start with, lifting ratelimit.limits [default: ratelimit.rate]",
+        min=0.01,
+    ),
+    latency: Optional[float] = typer.Option(
+        None, "--latency", help="Seconds the fake servers take to reply", min=0
+    ),
+    error_rate: Optional[float] = typer.Option(
+        None, "--error-rate", help="Share of emails getting a 4xx reply", min=0, max=1
+    ),
+    disconnect_rate: Optional[float] = typer.Option(
+        None,
+        "--disconnect-rate",
+        help="Share of emails dropping the connection",
+        min=0,
+        max=1,
+    ),
+    bounce_rate: Optional[float] = typer.Option(
+        None, "--bounce-rate", help="Share of recipients bouncing back", min=0, max=1
+    ),
+    render_processes: int = typer.Option(
+        1,
+        "--render-processes",
+        "-p",
+        help="Render emails in this many processes, 0 for one per CPU core",
+        min=0,
+    ),
+    fixture: Optional[Path] = typer.Option(
+        None,
+        "--fixture",
+        help="Send the emails exported by `ntuee-mailer export` to this path "
+        "instead of a synthetic letter",
+        exists=True,
+    ),
+    debugLevel: int = typer.Option(
+        logging.NOTSET,
+        "--debug",
+        "-d",
+        help="Debug level",
+        min=0,
+        max=5,
+        clamp=True,
+    ),
+):
+    """send a synthetic letter to fake SMTP and POP3 servers and report throughput"""
+    import tempfile
+
+    from .AutoMailer import AutoMailer
+    from .Exporter import ExportedEmails
+    from .FakeServers import start_fake_servers
+    from .Letter import Letter
+    from .Metrics import metrics
+    from .Rendering import cpu_count
+    from .ShardedMailer import ShardedMailer
+    from .synthetic import generate_letter
+
+    config = AutoMailer.load_mailer_config(config_path)
+    config["fake"]["enabled"] = True
+    overrides = {
+        "latency": latency,
+        "error_rate": error_rate,
+        "disconnect_rate": disconnect_rate,
+        "bounce_rate": bounce_rate,
+    }
+    for key, value in overrides.items():
+        if value is not None:
+            config["fake"][key] = value
+    if rate is not None:
+        config["ratelimit"]["rate"] = rate
+        config["ratelimit"]["max_rate"] = max(config["ratelimit"]["max_rate"], rate)
+        # the fixed limits of the school relay would cap the given rate
+        config["ratelimit"]["limits"] = ""
+
+    servers = start_fake_servers(config)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if fixture is not None:
+            setup_logger(Path(tmp) / "log.txt", debugLevel)
+            try:
+                letter = ExportedEmails(fixture)
+            except FileNotFoundError as e:
+                richError(f"{e}, export a letter with `ntuee-mailer export` first")
+        else:
+            letter_path = generate_letter(
+                Path(tmp) / "letter", recipients, attachment_mb
+            )
+            setup_logger(letter_path / "log.txt", debugLevel)
+
+            checked_letter = Letter.check_letter(
+                letter_path, offline=True, suppress=False
+            )
+            letter = Letter(
+                letter_path, config["account"]["name"], checked=checked_letter
+            )
+            letter.set_render_processes(render_processes or cpu_count())
+
+        metrics.reset()
+        if fixture is None and len(config["accounts"]) > 0:
+            # sharded across the accounts, the fake server accepts any login
+            auto_mailer = ShardedMailer(config, quiet=True, workers=workers, batch=True)
+            auto_mailer.login_batch(password="loadtest")
+        else:
+            auto_mailer = AutoMailer(config, quiet=True, workers=workers, batch=True)
+            auto_mailer.login("loadtest", "loadtest")
+
+        start = time.perf_counter()
+        if fixture is not None:
+            # sent as exported, from the sender they were rendered for
+            auto_mailer.send_as_is(letter)
+        else:
+            auto_mailer.send_emails(letter, confirm=False)
+        elapsed = time.perf_counter() - start
+
+        sent = auto_mailer.success_count
+        if fixture is None:
+            # exported emails are not in a message index to match bounces with
+            auto_mailer.check_bounce_backs()
+
+    stats = servers.smtp.stats
+    print()
+    print(f"sent {sent} of {auto_mailer.total_count} emails in {elapsed:.2f} seconds")
+    print(f"throughput: [blue]{sent / elapsed:.2f}[/blue] emails/s")
+    for phase in ("connect", "login", "render", "smtp_send", "ratelimit_wait"):
+        histogram = metrics.histogram(f"{phase}_seconds")
+        if histogram["count"] == 0:
+            continue
+        print(
+            f"{phase} latency: "
+            + ", ".join(
+                f"{q} {histogram[q] * 1000:.1f} ms"
+                for q in ("p50", "p95", "p99", "max")
+            )
+        )
+    print(
+        f"server: {stats['connections']} connections, {stats['messages']} messages, "
+        f"{stats['bytes'] / 2**20:.1f} MiB, {stats['errors']} injected errors, "
+        f"{stats['disconnects']} disconnects, {stats['throttled']} throttled, "
+        f"{stats['bounces']} bounces"
+    )
+    print(f"bounce-backs found: {sent - auto_mailer.success_count}")
 
 
 @app.command()
 def new(letter_name: Optional[str] = typer.Argument(..., help="Name of letter")):
     """create a new letter from template"""
+    from rich.prompt import Prompt
+
     print("Creating a new letter")
 
     TEMPLATE_PATH = APP_ROOT / "template_letter"
@@ -105,6 +987,11 @@ def check(
     letter_path: Path = typer.Argument(
         ..., help="Path to letter directory", exists=True, file_okay=False,
     ),
+    offline: bool = typer.Option(
+        False,
+        "--offline",
+        help="Only check the syntax of email addresses, without DNS lookups",
+    ),
 ):
     """
     check wether a directory is a valid letter\n
@@ -119,9 +1006,14 @@ def check(
     └── recipients.csv\n
     ```\n
     """
+    from .Letter import Letter
 
     print("Checking letter")
-    if Letter.check_letter(letter_path, verbose=True):
+    checked_letter = Letter.check_letter(letter_path, verbose=True, offline=offline)
+    if checked_letter.template is not None:
+        fields = ", ".join(sorted(checked_letter.template.fields)) or "none"
+        print(f"Template fields: [blue]{fields}")
+    if checked_letter:
         richSuccess("Letter is valid")
     else:
         richError("Letter is invalid")
@@ -151,12 +1043,27 @@ def config(
     host=smtps.ntu.edu.tw\n
     port=465\n
     timeout=5\n
+    connections=1\n
+    retries=3\n
+    retry_delay=5\n
+    verp=false\n
+    ssl=true\n
+    pipelining=true\n
+    bulk_size=100\n
     [pop3]\n
     host=msa.ntu.edu.tw\n
     port=995\n
     timeout=5\n
+    ssl=true\n
     [account]\n
     name=John Doe\n
+    \n
+    optional [account.<id>] sections share the recipients out among several\n
+    accounts, each with its own connections and rate:\n
+    [account.club]\n
+    userid=b09901000\n
+    connections=2\n
+    rate=1.0\n
     """
 
     if list_config:
@@ -168,7 +1075,9 @@ def config(
         richSuccess("Config file reset to default")
         return
 
-    APP_DIR.mkdir(parents=True, exist_ok=True)
+    from rich.prompt import Confirm, Prompt
+
+    from .AutoMailer import AutoMailer
 
     if new_config_path is not None:
         if not AutoMailer.validate_config(CONFIG_PATH):
@@ -181,7 +1090,10 @@ def config(
 
     config = AutoMailer.load_mailer_config(CONFIG_PATH)
 
-    for section, vals in config.items():
+    # only the options written in config.ini are asked about, not the defaults
+    sections = AutoMailer.config_sections(config)
+    written = AutoMailer.read_config_file(CONFIG_PATH)
+    for section, vals in AutoMailer.config_sections(config, written).items():
         for key, value in vals.items():
             print(f"\n{section}.{key} = {value}")
             if Confirm.ask(
@@ -191,7 +1103,7 @@ def config(
                     f"Enter new value for [blue]{section}.{key}",
                     password=(key == "password"),
                 )
-                config[section][key] = new_value
+                sections[section][key] = new_value
                 richSuccess(f"{section}.{key} updated")
 
     AutoMailer.save_config(config)
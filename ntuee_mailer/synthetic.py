@@ -0,0 +1,113 @@
+"""
+generate synthetic letter directories for benchmarks and load tests
+
+usage: python -m ntuee_mailer.synthetic LETTER_PATH [--recipients N] [--attachment-mb MB]
+"""
+import argparse
+import csv
+import os
+import random
+from pathlib import Path
+
+SURNAMES = "陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴周徐蘇葉莊呂江何蕭羅高"
+GIVEN = "家宏志明俊傑建文偉華淑芬美玲雅婷怡君佳慧冠宇柏翰承恩品妤欣"
+DOMAINS = ("ntu.edu.tw", "gmail.com", "yahoo.com.tw", "ntu.im", "outlook.com")
+
+SUBJECT = "臺大電機系學會 {recipients} 人測試信件"
+CONTENT = """<!DOCTYPE html>
+<html>
+<body>
+  <h3>$name 您好：</h3>
+  <p>感謝您參加本學期的活動，以下是您的報名資料：</p>
+  <p>學號：$student_id，組別：$group</p>
+  $if(note)<p>備註：$note</p>$endif
+  {lorem}
+  <br/>
+  $sender 敬上
+</body>
+</html>
+"""
+LOREM = "電機工程學系學術部 lorem ipsum dolor sit amet, consectetur adipisicing elit. "
+
+
+def random_name(rng: random.Random) -> str:
+    return rng.choice(SURNAMES) + "".join(rng.choices(GIVEN, k=rng.randint(1, 2)))
+
+
+def generate_letter(
+    letter_path: str,
+    recipients: int,
+    attachment_mb: float = 0,
+    *,
+    attachments: int = 1,
+    body_kb: float = 4,
+    seed: int = 0,
+) -> Path:
+    """
+    write a letter with `recipients` rows of CJK names, a mix of school ids and
+    external addresses, and `attachment_mb` of random attachments split
+    across `attachments` files
+    """
+    rng = random.Random(seed)
+    letter_path = Path(letter_path)
+    (letter_path / "attachments").mkdir(parents=True, exist_ok=True)
+
+    (letter_path / "config.yml").write_text(
+        f"subject: {SUBJECT.format(recipients=recipients)}\n"
+        "from: 臺大電機系學會學術部\n"
+        "recipientTitle: 同學\n",
+        encoding="utf-8",
+    )
+
+    lorem = LOREM * max(1, int(body_kb * 1024 / len(LOREM.encode("utf-8"))))
+    (letter_path / "content.html").write_text(
+        CONTENT.format(lorem=lorem), encoding="utf-8"
+    )
+
+    with open(letter_path / "recipients.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "email", "cc", "student_id", "group", "note"])
+        for i in range(recipients):
+            student_id = f"b{rng.randint(5, 12):02d}901{i % 1000:03d}"
+            if rng.random() < 0.7:
+                # completed to a school address
+                email = student_id.upper()
+            else:
+                email = f"user{i}@{rng.choice(DOMAINS)}"
+            cc = f"cc{i}@{rng.choice(DOMAINS)}" if rng.random() < 0.1 else ""
+            note = "素食" if rng.random() < 0.2 else ""
+            writer.writerow(
+                [random_name(rng), email, cc, student_id, rng.randint(1, 20), note]
+            )
+
+    if attachment_mb > 0:
+        size = int(attachment_mb * 1024 * 1024 / attachments)
+        for i in range(attachments):
+            (letter_path / "attachments" / f"附件{i + 1}.pdf").write_bytes(
+                os.urandom(size)
+            )
+
+    return letter_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("letter_path")
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--attachment-mb", type=float, default=0)
+    parser.add_argument("--attachments", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = generate_letter(
+        args.letter_path,
+        args.recipients,
+        args.attachment_mb,
+        attachments=args.attachments,
+        seed=args.seed,
+    )
+    print(f"letter written to {path}")
+
+
+if __name__ == "__main__":
+    main()
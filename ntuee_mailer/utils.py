@@ -1,10 +1,9 @@
-import typer
 from rich import print
-from rich.progress import Progress, TextColumn
-from rich.prompt import Confirm
-from cerberus.errors import ValidationError, ErrorList
 
 import logging
+import math
+import queue
+import threading
 import time
 from pathlib import Path
 
@@ -12,14 +11,18 @@ from .globals import *
 
 
 def richError(
-    *objects: any, end: str = "\n", prefix: str = "Error: ", terminate: bool = True
+    *objects: any,
+    end: str = "\n",
+    prefix: str = "Error: ",
+    terminate: bool = True,
+    code: int = EXIT_ERROR,
 ) -> None:
     print(f"[red]{prefix}", end="")
     for o in objects:
         print(f"[red]{o}", end="")
     print("", end=end)
     if terminate:
-        exit(1)
+        exit(code)
 
 
 def richWarning(text: str, end: str = "\n", prefix: bool = True) -> None:
@@ -32,8 +35,10 @@ def richSuccess(text: str, end: str = "\n") -> None:
     print(f"[green]{text}[/green]", end=end)
 
 
-def parse_validation_error(errors: ErrorList) -> None:
-    def _parse(error: ValidationError, indent: int = 1) -> None:
+def parse_validation_error(errors: "ErrorList") -> None:
+    from cerberus.errors import ErrorList
+
+    def _parse(error: "ValidationError", indent: int = 1) -> None:
         if type(error) == ErrorList:
             for e in error:
                 _parse(e, indent)
@@ -95,7 +100,39 @@ def complete_school_email(email_addr) -> list:
         return email_addr
 
 
+def to_bool(value) -> bool:
+    """coerce a config.ini value such as `true`, `yes`, `1` or `off` to a bool"""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def print_bounces(bounces: list, print=print) -> None:
+    """list bounced recipients, `bounces` as returned by BounceChecker.resolve"""
+    failed = [bounce for bounce in bounces if not bounce.delayed]
+    delayed = [bounce for bounce in bounces if bounce.delayed]
+
+    def print_rows(rows: list) -> None:
+        for bounce in sorted(rows, key=lambda b: b.row):
+            status = f" ({bounce.status})" if bounce.status else ""
+            print(f"\trow {bounce.row}: {bounce.email}{status},")
+
+    if len(failed) > 0:
+        print("[red]Emails sent to these addresses are bounced back (failed):")
+        print_rows(failed)
+        print("[red]Please check these emails.")
+    if len(delayed) > 0:
+        print("[yellow]Emails sent to these addresses are delayed (still trying):")
+        print_rows(delayed)
+    if len(bounces) == 0:
+        print("[green]No bounce-backs found, all emails are delivered successfully")
+    elif len(failed) == 0:
+        print("[green]No emails bounced back for good")
+
+
 def typerSelect(message: str, options: list) -> str:
+    import typer
+
     def process_options(n):
         n = int(n)
         if n < 0 or n >= len(options):
@@ -124,6 +161,9 @@ def typerSelect(message: str, options: list) -> str:
 
 
 def countdownConfirm(message: str, default=True, countdown: int = 0) -> bool:
+    from rich.progress import Progress, TextColumn
+    from rich.prompt import Confirm
+
     prompt_message = f"\n{message}"
     if countdown == 0:
         result = Confirm.ask(prompt_message, default=default)
@@ -144,6 +184,53 @@ def countdownConfirm(message: str, default=True, countdown: int = 0) -> bool:
     return result
 
 
+def prefetch(iterable, size: int):
+    """
+    iterate over `iterable` in a background thread,
+    keeping at most `size` items ready for the consumer
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            ok, item = buffer.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stopped.set()
+
+
 DEBUG_LEVELS = [
     logging.NOTSET,
     logging.DEBUG,
@@ -168,6 +255,16 @@ def setup_logger(file_path, level):
     )
 
 
+def percentile(values: list, q: float) -> float:
+    """the q-th percentile (0-100) of values, nearest rank"""
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    # the smallest value with at least q% of the values at or below it
+    rank = min(len(ordered), max(1, math.ceil(q * len(ordered) / 100)))
+    return ordered[rank - 1]
+
+
 if __name__ == "__main__":
     richSuccess("Success")
     richWarning("Warning")
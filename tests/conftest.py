@@ -0,0 +1,30 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# the template cache, learned rates and suppression list of the tests are
+# kept out of the real config directory, it is read when ntuee_mailer loads
+config_home = tempfile.mkdtemp(prefix="ntuee-mailer-tests-")
+os.environ["XDG_CONFIG_HOME"] = config_home
+atexit.register(shutil.rmtree, config_home, ignore_errors=True)
+
+
+@pytest.fixture
+def make_letter(tmp_path):
+    """builds a synthetic letter, see ntuee_mailer.synthetic"""
+    from ntuee_mailer.Letter import Letter
+    from ntuee_mailer.synthetic import generate_letter
+
+    def make(recipients=10, content=None, **options):
+        letter_path = generate_letter(tmp_path / "letter", recipients, **options)
+        if content is not None:
+            (letter_path / "content.html").write_text(content, encoding="utf-8")
+        checked = Letter.check_letter(letter_path, offline=True, suppress=False)
+        letter = Letter(letter_path, "Tester", checked=checked)
+        letter.set_from_addr("b01@ntu.edu.tw")
+        return letter
+
+    return make
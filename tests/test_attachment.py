@@ -0,0 +1,51 @@
+from ntuee_mailer.Attachment import AttachmentCache, EncodedAttachment
+
+
+def write(path, size):
+    path.write_bytes(bytes(range(256)) * (size // 256))
+    return path
+
+
+def test_encoded_attachment(tmp_path):
+    attachment = EncodedAttachment(write(tmp_path / "report.pdf", 1024))
+    head, _, body = attachment.rendered.partition(b"\r\n\r\n")
+
+    assert attachment.name == "report.pdf"
+    assert b"Content-Disposition: attachment; filename=report.pdf" in head
+    assert b"Content-Transfer-Encoding: base64" in head
+    assert b"\n" not in body.replace(b"\r\n", b"")
+
+
+def test_cache_reuses_and_reencodes_changed_files(tmp_path):
+    path = write(tmp_path / "a.bin", 1024)
+    cache = AttachmentCache()
+
+    first = cache.get(path)
+    assert cache.get(path) is first
+
+    write(path, 2048)
+    assert cache.get(path) is not first
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    paths = [write(tmp_path / f"{i}.bin", 4096) for i in range(3)]
+    size = len(EncodedAttachment(paths[0]))
+    cache = AttachmentCache(max_size=2 * size)
+
+    a = cache.get(paths[0])
+    cache.get(paths[1])
+    assert cache.get(paths[0]) is a
+    # a was used last, b goes
+    cache.get(paths[2])
+
+    assert cache.size == 2 * size
+    assert cache.get(paths[0]) is a
+    assert cache.size == 2 * size
+
+
+def test_attachments_larger_than_the_cache_are_not_kept(tmp_path):
+    path = write(tmp_path / "big.bin", 4096)
+    cache = AttachmentCache(max_size=1024)
+
+    assert len(cache.get(path)) > 1024
+    assert cache.size == 0
@@ -0,0 +1,155 @@
+from email import message_from_string
+
+import pytest
+
+from ntuee_mailer.BounceChecker import (
+    Bounce,
+    BounceChecker,
+    is_delay,
+    looks_like_dsn,
+    parse_address_field,
+    parse_dsn,
+    record_bounces,
+)
+from ntuee_mailer.MessageIndex import MessageIndex
+from ntuee_mailer.utils import print_bounces
+
+TOKEN = "0123456789abcdef.41"
+
+
+def dsn(*recipients, to=f"b01+{TOKEN}@ntu.edu.tw", original=None):
+    """a multipart/report with one delivery-status group per recipient"""
+    groups = "".join(
+        f"\nFinal-Recipient: rfc822; {address}\nAction: {action}\nStatus: {status}\n"
+        f"Diagnostic-Code: smtp; {status} something happened\n"
+        for address, action, status in recipients
+    )
+    original_part = ""
+    if original is not None:
+        original_part = (
+            "--B\nContent-Type: text/rfc822-headers\n\n"
+            f"Message-ID: <{original}@ntu.edu.tw>\nSubject: hello\n\n"
+        )
+    return message_from_string(
+        f"To: {to}\n"
+        "Subject: Delivery Status Notification (Failure)\n"
+        'Content-Type: multipart/report; report-type=delivery-status; boundary="B"\n'
+        "\n--B\nContent-Type: text/plain\n\nundeliverable\n"
+        "--B\nContent-Type: message/delivery-status\n\n"
+        f"Reporting-MTA: dns; mx.example.com\n{groups}\n"
+        f"{original_part}--B--\n"
+    )
+
+
+def test_failed_recipients_and_verp_token():
+    token, recipients = parse_dsn(
+        dsn(
+            ("Amy@Example.com", "failed", "5.1.1"),
+            ("bob@example.com", "failed", "5.2.2"),
+        )
+    )
+    assert token == TOKEN
+    assert [(a, s, d) for a, s, _, d in recipients] == [
+        ("amy@example.com", "5.1.1", False),
+        ("bob@example.com", "5.2.2", False),
+    ]
+
+
+def test_token_from_the_returned_headers():
+    token, _ = parse_dsn(
+        dsn(("amy@example.com", "failed", "5.1.1"), to="b01@ntu.edu.tw", original=TOKEN)
+    )
+    assert token == TOKEN
+
+
+def test_delivered_recipients_are_ignored():
+    _, recipients = parse_dsn(
+        dsn(
+            ("amy@example.com", "delivered", "2.0.0"),
+            ("bob@example.com", "relayed", "2.0.0"),
+        )
+    )
+    assert recipients == []
+
+
+@pytest.mark.parametrize(
+    "action, status, delayed",
+    [
+        ("failed", "5.1.1", False),
+        ("delayed", "4.4.1", True),
+        # a temporary status is not a bounce, whatever the action says
+        ("failed", "4.4.7", True),
+        ("delayed", "5.0.0", False),
+        ("failed", None, False),
+        ("delayed", None, True),
+    ],
+)
+def test_delays(action, status, delayed):
+    assert is_delay(action, status) == delayed
+
+
+def test_parse_address_field():
+    assert parse_address_field("rfc822; <Amy@Example.com>") == "amy@example.com"
+    assert parse_address_field("rfc822; not an address") is None
+    assert parse_address_field(None) is None
+
+
+def test_looks_like_dsn():
+    assert looks_like_dsn(dsn(("amy@example.com", "failed", "5.1.1")))
+    assert looks_like_dsn(
+        message_from_string("Subject: Undelivered Mail Returned to Sender\n\nx")
+    )
+    assert not looks_like_dsn(message_from_string("Subject: hello\n\nx"))
+
+
+class StubJournal:
+    def __init__(self):
+        self.records = []
+
+    def record(self, row, email, status, **details):
+        self.records.append((row, email, status))
+
+
+def test_delays_are_not_recorded():
+    journal = StubJournal()
+    record_bounces(
+        journal,
+        [
+            Bounce(1, "amy@example.com", "5.1.1"),
+            Bounce(2, "bob@example.com", "4.4.1", delayed=True),
+        ],
+    )
+    assert journal.records == [(1, "amy@example.com", "bounced")]
+
+
+def test_a_failure_takes_precedence_over_delays():
+    index = MessageIndex()
+    index.add(TOKEN, 41, "amy@example.com")
+    checker = BounceChecker({}, "b01", "password")
+
+    bounces = checker.resolve(
+        [
+            dsn(("amy@example.com", "delayed", "4.4.1")),
+            dsn(("amy@example.com", "failed", "5.4.7")),
+            dsn(("amy@example.com", "delayed", "4.4.1")),
+        ],
+        index,
+    )
+
+    assert [(b.row, b.email, b.status, b.delayed) for b in bounces] == [
+        (41, "amy@example.com", "5.4.7", False)
+    ]
+
+
+def test_bounces_are_listed_by_journal_row():
+    lines = []
+    print_bounces(
+        [
+            Bounce(2, "bob@example.com", "4.4.1", delayed=True),
+            Bounce(0, "amy@example.com", "5.1.1"),
+        ],
+        print=lines.append,
+    )
+    # rows count recipients from 0, as in the journal and the check errors
+    assert "\trow 0: amy@example.com (5.1.1)," in lines
+    assert "\trow 2: bob@example.com (4.4.1)," in lines
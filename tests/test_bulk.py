@@ -0,0 +1,114 @@
+from email import message_from_bytes
+
+import pytest
+
+from ntuee_mailer.Letter import BULK_TO, Letter
+
+
+@pytest.fixture
+def bulk_letter(tmp_path):
+    """a letter that is the same for everyone, sent to `recipients` rows"""
+
+    def make(recipients=7, config="", content="<p>hello from $sender</p>"):
+        (tmp_path / "attachments").mkdir()
+        (tmp_path / "config.yml").write_text(f"subject: hello\n{config}")
+        (tmp_path / "content.html").write_text(content)
+        (tmp_path / "recipients.csv").write_text(
+            "name,email\n"
+            + "".join(f"user {i},user{i}@example.com\n" for i in range(recipients))
+        )
+        checked = Letter.check_letter(tmp_path, offline=True, suppress=False)
+        letter = Letter(tmp_path, "Tester", checked=checked)
+        letter.set_from_addr("b01@ntu.edu.tw")
+        return letter
+
+    return make
+
+
+def test_batches_of_bulk_size(bulk_letter):
+    letter = bulk_letter(recipients=7)
+    assert not letter.is_personalized
+    letter.set_bulk(3)
+
+    emails = list(letter)
+
+    assert [[row for row, _, _ in email.batch] for email in emails] == [
+        [0, 1, 2],
+        [3, 4, 5],
+        [6],
+    ]
+    for email in emails:
+        assert email.to_addrs == [address for _, address, _ in email.batch]
+        assert email.deliveries == email.batch
+        message = message_from_bytes(email.data)
+        assert message["To"] == BULK_TO
+        assert "user" not in str(message)
+
+
+def test_fixed_recipients_count_towards_bulk_size(bulk_letter):
+    letter = bulk_letter(
+        recipients=7, config="cc: [cc@example.com]\nbccToSender: true\n"
+    )
+    letter.set_bulk(5)
+
+    emails = list(letter)
+
+    assert letter.bulk_rows == 3
+    assert [len(email.batch) for email in emails] == [3, 3, 1]
+    for email in emails:
+        assert len(email.recipients) <= 5
+        assert email.cc_addrs == ["cc@example.com"]
+        assert email.bcc_addrs == ["b01@ntu.edu.tw"]
+
+
+def test_bulk_size_must_leave_room_for_recipients(bulk_letter):
+    letter = bulk_letter(config="cc: [cc@example.com]\nbcc: [bcc@example.com]\n")
+    with pytest.raises(ValueError, match="leaves no room"):
+        letter.set_bulk(2)
+
+
+def test_personalized_letters_are_not_sent_in_bulk(bulk_letter):
+    letter = bulk_letter(content="<p>hello $name</p>")
+    assert letter.is_personalized
+    with pytest.raises(ValueError):
+        letter.set_bulk(3)
+
+
+@pytest.mark.parametrize(
+    "content, cc, personalized",
+    [
+        ("<p>hello from $sender</p>", "", False),
+        ("<p>hello $name</p>", "", True),
+        ("$if(name)hi$endif", "", True),
+        ("<p>hello</p>", "cc@example.com", True),
+    ],
+)
+def test_checked_letter_knows_whether_it_is_personalized(
+    tmp_path, content, cc, personalized
+):
+    (tmp_path / "attachments").mkdir()
+    (tmp_path / "config.yml").write_text("subject: hello\n")
+    (tmp_path / "content.html").write_text(content)
+    (tmp_path / "recipients.csv").write_text(
+        f"name,email,cc\namy,amy@example.com,{cc}\nbob,bob@example.com,\n"
+    )
+    checked = Letter.check_letter(tmp_path, offline=True, suppress=False)
+
+    assert checked.is_personalized == personalized
+    assert Letter(tmp_path, "Tester", checked=checked).is_personalized == personalized
+
+
+def test_skipped_rows_and_test_mode(bulk_letter):
+    letter = bulk_letter(recipients=7)
+    letter.set_bulk(3)
+    letter.skip({0, 4})
+
+    assert [[row for row, _, _ in email.batch] for email in letter] == [
+        [1, 2, 3],
+        [5, 6],
+    ]
+
+    letter.test_mode = True
+    assert [email.batch for email in letter] == [
+        [(1, "user1@example.com", letter.campaign + ".1")]
+    ]
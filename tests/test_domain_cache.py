@@ -0,0 +1,90 @@
+import json
+import time
+from types import SimpleNamespace
+
+import dns.exception
+import dns.resolver
+
+from ntuee_mailer.DomainCache import DomainCache, check_domains
+
+
+class StubResolver:
+    """answers MX queries from a dict, every other domain does not exist"""
+
+    def __init__(self, mx: dict, timeouts=()) -> None:
+        self.mx = mx
+        self.timeouts = set(timeouts)
+        self.queries = []
+
+    def resolve(self, domain, record):
+        self.queries.append((domain, record))
+        if domain in self.timeouts:
+            raise dns.exception.Timeout()
+        if record == "MX" and domain in self.mx:
+            return [SimpleNamespace(preference=10, exchange=self.mx[domain])]
+        raise dns.resolver.NXDOMAIN()
+
+
+def test_check_domains_caches_results(tmp_path):
+    cache = DomainCache(tmp_path / "domain-cache.json")
+    resolver = StubResolver({"ntu.edu.tw": "mx.ntu.edu.tw."})
+
+    results = check_domains(
+        ["ntu.edu.tw", "nowhere.invalid", "ntu.edu.tw"],
+        cache=cache,
+        resolver=resolver,
+    )
+
+    assert results["ntu.edu.tw"] is None
+    assert results["nowhere.invalid"] is not None
+    assert "ntu.edu.tw" in cache and "nowhere.invalid" in cache
+
+    # a second run, even from disk, resolves nothing
+    reloaded = DomainCache(tmp_path / "domain-cache.json")
+    resolver.queries.clear()
+    assert (
+        check_domains(
+            ["ntu.edu.tw", "nowhere.invalid"], cache=reloaded, resolver=resolver
+        )
+        == results
+    )
+    assert resolver.queries == []
+
+
+def test_timeouts_are_not_cached(tmp_path):
+    cache = DomainCache(tmp_path / "domain-cache.json")
+    resolver = StubResolver({}, timeouts=["slow.example"])
+
+    results = check_domains(["slow.example"], cache=cache, resolver=resolver)
+
+    assert results == {"slow.example": None}
+    assert "slow.example" not in cache
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    path = tmp_path / "domain-cache.json"
+    checked_at = time.time() - 120
+    path.write_text(
+        json.dumps(
+            {
+                "old.example": {"error": None, "checked_at": checked_at},
+                "broken.example": "not an entry",
+            }
+        ),
+        encoding="utf-8",
+    )
+
+    assert "old.example" in DomainCache(path, ttl=300)
+    cache = DomainCache(path, ttl=60)
+    assert "old.example" not in cache
+    assert "broken.example" not in cache
+
+
+def test_save_creates_the_directory(tmp_path):
+    path = tmp_path / "not" / "yet" / "domain-cache.json"
+    cache = DomainCache(path)
+    check_domains(["ntu.edu.tw"], cache=cache, resolver=StubResolver({}))
+
+    cache.save()
+
+    assert "ntu.edu.tw" in DomainCache(path)
@@ -0,0 +1,64 @@
+import mailbox
+from email import message_from_bytes
+
+import pytest
+
+from ntuee_mailer.Exporter import FORMATS, ExportedEmails, create_exporter
+
+# a line an mbox reader would take for the start of the next message
+CONTENT = "<p>hello $name</p>\nFrom the club\n>From the club, quoted\n"
+
+
+@pytest.fixture
+def letter(make_letter):
+    letter = make_letter(recipients=12, content=CONTENT, attachment_mb=0.01)
+    letter.set_from_addr("b01@ntu.edu.tw", verp=True)
+    return letter
+
+
+def export(letter, path, export_format):
+    with create_exporter(path, export_format, letter.skeleton.tail) as exporter:
+        exported = list(letter)
+        assert exporter.export(exported) == len(exported)
+    return exported
+
+
+@pytest.mark.parametrize("export_format", FORMATS)
+def test_round_trip(tmp_path, letter, export_format):
+    path = tmp_path / ("letter.mbox" if export_format == "mbox" else "letter")
+
+    exported = export(letter, path, export_format)
+    read_back = ExportedEmails(path)
+
+    assert read_back.export_format == export_format
+    # counted in recipients, as the letter is
+    assert len(read_back) == sum(len(email.recipients) for email in exported)
+    assert len(list(read_back)) == len(exported)
+    for original, email in zip(exported, read_back):
+        assert email.data == original.data
+        assert email.token == original.token
+        assert email.envelope_from == original.envelope_from
+        assert email.recipients == original.recipients
+        assert email.deliveries == [
+            (email.row, recipient, original.token) for recipient in original.recipients
+        ]
+
+
+def test_standard_readers(tmp_path, letter):
+    exported = export(letter, tmp_path / "letter.mbox", "mbox")
+    subjects = [message_from_bytes(email.data)["Subject"] for email in exported]
+
+    messages = list(mailbox.mbox(str(tmp_path / "letter.mbox")))
+    assert [message["Subject"] for message in messages] == subjects
+    # mboxrd quoting is undone by the reader, not seen by the recipient
+    body = messages[0].get_payload()[0].get_payload(decode=True).decode("utf-8")
+    assert "\nFrom the club\n>From the club, quoted" in body.replace("\r\n", "\n")
+
+    export(letter, tmp_path / "maildir", "maildir")
+    maildir = mailbox.Maildir(str(tmp_path / "maildir"))
+    assert sorted(message["Subject"] for message in maildir) == sorted(subjects)
+
+    export(letter, tmp_path / "eml", "eml")
+    files = sorted((tmp_path / "eml").glob("*.eml"))
+    assert len(files) == len(exported)
+    assert files[0].read_bytes() == exported[0].data
@@ -0,0 +1,60 @@
+import os
+
+from ntuee_mailer.Journal import BOUNCED, FAILED, SENT, SendJournal
+
+
+def test_every_record_is_synced(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+
+    with SendJournal(tmp_path / "send-journal.jsonl") as journal:
+        journal.record(0, "amy@ntu.edu.tw", SENT)
+        journal.record(1, "bob@ntu.edu.tw", FAILED, error="550")
+        assert len(synced) == 2
+        # on disk before the next email is sent
+        assert SendJournal(journal.path).status(1, "bob@ntu.edu.tw") == FAILED
+
+
+def test_latest_status_wins(tmp_path):
+    path = tmp_path / "send-journal.jsonl"
+    with SendJournal(path) as journal:
+        journal.record(0, "amy@ntu.edu.tw", FAILED)
+        journal.record(0, "amy@ntu.edu.tw", SENT)
+        journal.record(1, "bob@ntu.edu.tw", SENT)
+        journal.record(1, "bob@ntu.edu.tw", BOUNCED)
+
+    journal = SendJournal(path)
+    assert journal.is_delivered(0, "amy@ntu.edu.tw")
+    assert not journal.is_delivered(1, "bob@ntu.edu.tw")
+    assert journal.is_settled(1, "bob@ntu.edu.tw")
+    assert journal.delivered_count == 1
+
+
+def test_incomplete_last_record_is_skipped(tmp_path):
+    path = tmp_path / "send-journal.jsonl"
+    with SendJournal(path) as journal:
+        journal.record(0, "amy@ntu.edu.tw", SENT)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"row": 1, "email": "bob@ntu.ed')
+
+    journal = SendJournal(path)
+    assert journal.is_delivered(0, "amy@ntu.edu.tw")
+    assert journal.status(1, "bob@ntu.edu.tw") is None
+
+
+def test_resume_skips_settled_recipients(tmp_path, make_letter):
+    letter = make_letter(recipients=5)
+    emails = [recipient["email"] for recipient in letter.csv]
+    with SendJournal(tmp_path / "send-journal.jsonl") as journal:
+        journal.record(0, emails[0], SENT)
+        journal.record(1, emails[1], BOUNCED)
+        journal.record(2, emails[2], FAILED)
+        # the address of a row changed since, it is sent to again
+        journal.record(4, emails[0], SENT)
+
+        assert letter.resume(journal) == 2
+
+    assert letter.pending_rows == [2, 3, 4]
+    assert len(letter) == 3
+    assert [email.row for email in letter] == [2, 3, 4]
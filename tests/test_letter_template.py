@@ -0,0 +1,123 @@
+import pytest
+
+from ntuee_mailer.LetterTemplate import (
+    FIELD,
+    FOR,
+    IF,
+    LetterTemplate,
+    TemplateSyntaxError,
+    compile_template,
+)
+
+
+def test_fields_and_escapes():
+    assert compile_template("Hi $name, ${x}y $$5") == [
+        "Hi ",
+        (FIELD, "name"),
+        ", ",
+        (FIELD, "x"),
+        "y $5",
+    ]
+
+
+def test_if_else_compiles_to_a_block():
+    assert compile_template("$if(!paid)pay$else thanks$endif") == [
+        (IF, "paid", True, ["pay"], [" thanks"])
+    ]
+    assert compile_template("$if(a)$endif") == [(IF, "a", False, [], [])]
+
+
+def test_for_loop_variable_is_not_a_field():
+    template = LetterTemplate("$for(item in items)<li>$item $unit</li>$endfor")
+    assert template.nodes == [
+        (FOR, "item", "items", ["<li>", (FIELD, "item"), " ", (FIELD, "unit"), "</li>"])
+    ]
+    assert template.fields == {"items", "unit"}
+    assert template.has_blocks
+
+
+@pytest.mark.parametrize(
+    "values, expected",
+    [
+        ({"name": "Amy", "room": "BL-112"}, "Dear Amy, see you in BL-112."),
+        ({"name": "Amy", "room": "  "}, "Dear Amy, <i>to be announced</i>."),
+    ],
+)
+def test_render_if(values, expected):
+    template = LetterTemplate(
+        "Dear $name, $if(room)see you in $room$else<i>to be announced</i>$endif."
+    )
+    assert template.render(values) == expected
+
+
+def test_render_for_skips_empty_items():
+    template = LetterTemplate("$for(x in xs)[$x]$endfor")
+    assert template.render({"xs": "a; b;;c ;"}) == "[a][b][c]"
+    assert template.render({"xs": ""}) == ""
+
+
+def test_bind_keeps_blocks_reading_bound_fields():
+    template = LetterTemplate("$if(sender)from $sender$endif to $name").bind(
+        sender="Bob"
+    )
+    assert template.fields == {"name"}
+    assert template.render({"name": "Amy"}) == "from Bob to Amy"
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ("$if(a)x", "$if is never closed"),
+        ("$for(a in b)x$endif", "$endif without $if"),
+        ("$if(a)x$else y$else z$endif", "duplicated $else"),
+        ("$endfor", "$endfor without $for"),
+        ("line\n$if(a b)x$endif", "invalid condition"),
+        ("$for(a)x$endfor", "invalid loop"),
+        ("costs $5", "invalid placeholder"),
+    ],
+)
+def test_syntax_errors(text, message):
+    with pytest.raises(TemplateSyntaxError, match=message.replace("$", r"\$")):
+        compile_template(text)
+
+
+@pytest.mark.parametrize(
+    "text, reserved",
+    [
+        ("$else", "else"),
+        ("a $endif", "endif"),
+        ("$endfor", "endfor"),
+        ("$if and ${for}", "if"),
+        ("${Else}", "Else"),
+        ("$if(endif)x$endif", "endif"),
+        ("$for(if in courses)x$endfor", "if"),
+    ],
+)
+def test_reserved_names(text, reserved):
+    with pytest.raises(TemplateSyntaxError) as error:
+        compile_template(text)
+    assert error.value.reserved == reserved
+
+
+def test_other_errors_are_not_about_reserved_names():
+    with pytest.raises(TemplateSyntaxError) as error:
+        compile_template("costs $5")
+    assert error.value.reserved is None
+
+
+def test_syntax_error_reports_the_line():
+    with pytest.raises(TemplateSyntaxError) as error:
+        compile_template("<p>\n</p>\n$if(a)")
+    assert error.value.line == 3
+
+
+def test_load_reuses_the_compiled_cache(tmp_path):
+    path = tmp_path / "content.html"
+    path.write_text("$if(a)$a$endif", encoding="utf-8")
+    cache_dir = tmp_path / "cache"
+
+    first = LetterTemplate.load(path, cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+    second = LetterTemplate.load(path, cache_dir)
+    assert second.nodes == first.nodes
+    assert second.render({"a": "x"}) == "x"
@@ -0,0 +1,106 @@
+import smtplib
+
+import pytest
+
+from ntuee_mailer.FakeServers import (
+    FakeMailbox,
+    FakeOptions,
+    FakeServer,
+    FakeSMTPHandler,
+)
+from ntuee_mailer.Pipelining import pipelined_transfer, supports_pipelining
+from ntuee_mailer.Retry import breaks_connection
+
+DATA = b"Subject: hello\r\n\r\n.leading dot\r\nbody\r\n"
+RECIPIENTS = ["amy@example.com", "bob@example.com", "cy@example.com"]
+
+
+@pytest.fixture
+def smtp_server():
+    servers = []
+
+    def start(**options):
+        server = FakeServer(
+            0,
+            FakeSMTPHandler,
+            options=FakeOptions(**options),
+            mailbox=FakeMailbox(),
+            tls=False,
+        )
+        servers.append(server)
+        client = smtplib.SMTP("127.0.0.1", server.port, timeout=5)
+        client.ehlo()
+        return server, client
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_all_accepted(smtp_server):
+    server, client = smtp_server()
+    assert supports_pipelining(client)
+
+    assert pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA) == {}
+    assert server.stats["messages"] == 1
+    assert server.stats["bytes"] == len(DATA)
+    # the connection is ready for the next email
+    assert pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA) == {}
+    assert server.stats["messages"] == 2
+
+
+def test_partly_refused_recipients(smtp_server):
+    server, client = smtp_server(reject_pattern="^bob@")
+
+    refused = pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA)
+
+    assert list(refused) == ["bob@example.com"]
+    assert refused["bob@example.com"][0] == 550
+    assert server.stats["messages"] == 1
+
+
+@pytest.mark.parametrize("lenient_data", [False, True])
+def test_refused_mail_is_never_completed(smtp_server, lenient_data):
+    server, client = smtp_server(
+        error_rate=1, error_code=550, lenient_data=lenient_data
+    )
+
+    with pytest.raises(smtplib.SMTPSenderRefused) as error:
+        pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA)
+
+    assert error.value.smtp_code == 550
+    assert server.stats["messages"] == 0
+    assert server.stats["empty_transactions"] == 0
+    # a server that took DATA anyway can only be stopped by hanging up
+    assert (client.sock is None) == lenient_data
+
+
+@pytest.mark.parametrize("lenient_data", [False, True])
+def test_all_recipients_refused_is_never_completed(smtp_server, lenient_data):
+    server, client = smtp_server(
+        reject_pattern="@example.com$", lenient_data=lenient_data
+    )
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as error:
+        pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA)
+
+    assert sorted(error.value.recipients) == sorted(RECIPIENTS)
+    assert server.stats["messages"] == 0
+    assert server.stats["empty_transactions"] == 0
+    assert (client.sock is None) == lenient_data
+    if not lenient_data:
+        # RSET left the connection usable
+        assert client.noop()[0] == 250
+
+
+def test_421_in_the_middle_of_the_recipients(smtp_server):
+    server, client = smtp_server(reject_pattern="^bob@", reject_code=421)
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as error:
+        pipelined_transfer(client, "b01@ntu.edu.tw", RECIPIENTS, DATA)
+
+    assert error.value.recipients["bob@example.com"][0] == 421
+    assert breaks_connection(error.value)
+    assert client.sock is None
+    assert server.stats["messages"] == 0
@@ -0,0 +1,157 @@
+import json
+
+import pytest
+
+from ntuee_mailer import RateLimiter as rate_limiter
+from ntuee_mailer.RateLimiter import RateLimiter, TokenBucket, parse_limits
+
+
+class FakeClock:
+    """stands in for the time module, sleeping only moves the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # a rounding error short of a token must still move the clock
+        self.now += max(seconds, 1e-9)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def limiter(**options):
+    options.setdefault("state_path", None)
+    return RateLimiter("smtps.ntu.edu.tw:465", **options)
+
+
+def test_bucket_refill_is_capped(clock):
+    bucket = TokenBucket(5, 2)
+    bucket.drain()
+
+    bucket.refill(clock.now + 1)
+    assert bucket.tokens == 2
+    bucket.refill(clock.now + 10)
+    assert bucket.tokens == 5
+
+
+def test_bucket_wait_time(clock):
+    bucket = TokenBucket(5, 2)
+    assert bucket.wait_time() == 0
+    bucket.tokens = 0.5
+    assert bucket.wait_time() == 0.25
+
+
+def test_parse_limits():
+    assert parse_limits("10/10, 130/150,260/320.5") == [
+        (10, 10.0),
+        (130, 150.0),
+        (260, 320.5),
+    ]
+    assert parse_limits("") == []
+
+
+def test_burst_then_the_rate(clock):
+    limiter_ = limiter(rate=2, burst=5)
+    start = clock.now
+
+    for _ in range(5):
+        assert limiter_.acquire() == 0
+    assert clock.now == start
+
+    assert limiter_.acquire() == pytest.approx(0.5)
+    assert limiter_.acquire() == pytest.approx(0.5)
+
+
+def test_limits_windows(clock):
+    limiter_ = limiter(rate=1000, burst=1000, limits=parse_limits("10/10, 130/150"))
+    start = clock.now
+
+    for _ in range(10):
+        limiter_.acquire()
+    assert clock.now == start
+    # the 11th email waits for the first window
+    limiter_.acquire()
+    assert clock.now - start == pytest.approx(1)
+    assert limiter_.sustained_rate == pytest.approx(130 / 150)
+
+
+def test_a_window_lets_its_count_through_then_keeps_its_pace(clock):
+    limiter_ = limiter(rate=1000, burst=1000, limits=parse_limits("130/150"))
+    start = clock.now
+
+    for _ in range(130):
+        limiter_.acquire()
+    assert clock.now == start
+    for _ in range(130):
+        limiter_.acquire()
+    assert clock.now - start == pytest.approx(150)
+
+
+def test_rate_adapts(clock):
+    limiter_ = limiter(rate=1, increase=0.5, window=2, decrease=0.5, cooldown=30)
+
+    limiter_.success()
+    assert limiter_.rate == 1
+    limiter_.success()
+    assert limiter_.rate == 1.5
+
+    limiter_.throttled()
+    assert limiter_.rate == 0.75
+    # the pause after a push back
+    assert limiter_.acquire() == pytest.approx(30)
+
+
+def test_throttled_once_per_cooldown(clock):
+    limiter_ = limiter(rate=4, decrease=0.5, cooldown=30)
+
+    # every pooled connection hits the same 421
+    for _ in range(4):
+        limiter_.throttled()
+    assert limiter_.rate == 2
+    start = clock.now
+    limiter_.acquire()
+    assert clock.now - start == pytest.approx(30)
+
+    # a push back after the cooldown counts again
+    limiter_.throttled()
+    assert limiter_.rate == 1
+
+
+def test_rate_is_clamped(clock):
+    limiter_ = limiter(rate=100, min_rate=0.5, max_rate=3, cooldown=0)
+    assert limiter_.rate == 3
+    for _ in range(10):
+        clock.sleep(1)
+        limiter_.throttled()
+    assert limiter_.rate == 0.5
+
+
+def test_learned_rate_is_persisted(clock, tmp_path):
+    state_path = tmp_path / "not" / "yet" / "ratelimit.json"
+    first = limiter(rate=4, decrease=0.5, state_path=state_path)
+    first.throttled()
+    first.save()
+
+    state = json.loads(state_path.read_text())
+    assert state["smtps.ntu.edu.tw:465"]["rate"] == 2
+    assert limiter(rate=4, state_path=state_path).rate == 2
+
+    # other hosts keep their own rates
+    other = RateLimiter("smtp.example.com:465", rate=5, state_path=state_path)
+    assert other.rate == 5
+    other.save()
+    assert set(json.loads(state_path.read_text())) == {
+        "smtps.ntu.edu.tw:465",
+        "smtp.example.com:465",
+    }
@@ -0,0 +1,61 @@
+from ntuee_mailer import Letter as letter_module
+from ntuee_mailer.Rendering import RowRenderer, render_in_processes
+
+
+def snapshot(letter):
+    return [
+        (
+            email.row,
+            email.token,
+            email.envelope_from,
+            email.to_addrs,
+            email.cc_addrs,
+            email.bcc_addrs,
+            email.data,
+        )
+        for email in letter
+    ]
+
+
+def test_processes_render_the_same_emails(make_letter, monkeypatch):
+    pools = []
+
+    def spy(renderer, rows, processes):
+        pools.append(processes)
+        return render_in_processes(renderer, rows, processes)
+
+    monkeypatch.setattr(letter_module, "render_in_processes", spy)
+
+    # enough rows for several chunks per process
+    letter = make_letter(recipients=150, attachment_mb=0.01)
+    letter.set_from_addr("b01@ntu.edu.tw", verp=True)
+    letter.skip({3, 70})
+    in_process = snapshot(letter)
+
+    letter.set_render_processes(2)
+    in_processes = snapshot(letter)
+
+    assert pools == [2]
+    assert len(in_processes) == 148
+    assert [row for row, *_ in in_processes] == letter.pending_rows
+    assert in_processes == in_process
+
+
+def test_the_pool_stops_with_the_consumer(make_letter):
+    letter = make_letter(recipients=100)
+    renderer = RowRenderer(
+        letter.config,
+        letter.email_template,
+        letter.skeleton,
+        letter.campaign,
+        letter.from_addr,
+        letter.verp,
+    )
+    rows = ((i, letter.csv[i]) for i in range(100))
+
+    rendered = render_in_processes(renderer, rows, 2, chunk_size=4)
+    assert [next(rendered).row for _ in range(5)] == [0, 1, 2, 3, 4]
+    rendered.close()
+
+    # the rows were only read as far as the chunks in flight
+    assert len(list(rows)) > 0
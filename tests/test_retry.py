@@ -0,0 +1,139 @@
+import smtplib
+import socket
+import threading
+
+import pytest
+
+from ntuee_mailer.Retry import (
+    DeliveryQueue,
+    ReconnectFailed,
+    backoff_delay,
+    breaks_connection,
+    is_server_drop,
+    is_throttling,
+    is_transient,
+)
+
+
+def server_drop():
+    """what smtplib raises when the server closes the connection"""
+    return smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+
+def network_failure():
+    """what smtplib raises when reading the reply fails"""
+    try:
+        try:
+            raise socket.timeout("timed out")
+        except OSError as e:
+            raise smtplib.SMTPServerDisconnected(f"Connection unexpectedly closed: {e}")
+    except smtplib.SMTPServerDisconnected as e:
+        return e
+
+
+def refused(*codes):
+    return smtplib.SMTPRecipientsRefused(
+        {f"user{i}@ntu.edu.tw": (code, b"") for i, code in enumerate(codes)}
+    )
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        refused(450),
+        refused(451, 452),
+        smtplib.SMTPDataError(451, b"try again later"),
+        smtplib.SMTPSenderRefused(421, b"closing", "b01@ntu.edu.tw"),
+        server_drop(),
+        network_failure(),
+        ReconnectFailed("failed to reconnect"),
+        socket.timeout("timed out"),
+        ConnectionResetError(),
+        OSError("network is unreachable"),
+    ],
+)
+def test_transient(error):
+    assert is_transient(error)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        refused(550),
+        # one permanent failure is not worth retrying the others for
+        refused(450, 550),
+        smtplib.SMTPDataError(554, b"rejected"),
+        smtplib.SMTPAuthenticationError(535, b"bad credentials"),
+        smtplib.SMTPException("no reply code"),
+        ValueError("not an smtp error"),
+    ],
+)
+def test_permanent(error):
+    assert not is_transient(error)
+
+
+def test_breaks_connection():
+    assert breaks_connection(smtplib.SMTPDataError(421, b"closing"))
+    assert breaks_connection(smtplib.SMTPServerDisconnected())
+    assert not breaks_connection(smtplib.SMTPDataError(451, b"later"))
+
+
+def test_throttling():
+    assert is_throttling(server_drop())
+    assert is_throttling(smtplib.SMTPDataError(421, b"slow down"))
+    assert is_throttling(refused(250, 452))
+    assert not is_throttling(refused(550))
+
+
+def test_only_the_server_hanging_up_is_throttling():
+    assert is_server_drop(server_drop())
+    for error in (
+        network_failure(),
+        ReconnectFailed("failed to reconnect"),
+        smtplib.SMTPServerDisconnected("please run connect() first"),
+        ConnectionResetError(),
+    ):
+        assert not is_server_drop(error)
+        assert not is_throttling(error)
+        assert is_transient(error)
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(20):
+        assert 0 <= backoff_delay(attempt, 1, cap=30) <= 30
+    assert backoff_delay(0, 2) <= 2
+
+
+def test_retried_item_comes_back_before_the_queue_ends():
+    queue = DeliveryQueue(maxsize=4)
+    queue.put("a")
+    queue.close()
+
+    assert queue.get() == "a"
+    # put back without being done, it is still outstanding
+    queue.retry("a", 0.01)
+    assert queue.get() == "a"
+    queue.done()
+    assert queue.get() is None
+
+
+def test_abort_wakes_a_blocked_put():
+    queue = DeliveryQueue(maxsize=1)
+    queue.put("a")
+    error = RuntimeError("journal is not writable")
+    raised = []
+
+    def feed():
+        try:
+            queue.put("b")
+        except RuntimeError as e:
+            raised.append(e)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    queue.abort(error)
+    feeder.join(timeout=5)
+
+    assert not feeder.is_alive()
+    assert raised == [error]
+    assert queue.get() is None
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+from ntuee_mailer.RateLimiter import RateLimiter, parse_limits
+from ntuee_mailer.ShardedMailer import ShardedMailer, account_config
+
+CONFIG = {
+    "account": {"name": "Tester"},
+    "accounts": {
+        "club": {"userid": "b01", "connections": 3, "rate": 20.0},
+        "officer": {"userid": "b02", "limits": "10/10"},
+    },
+    "smtp": {"host": "smtps.ntu.edu.tw", "port": 465, "connections": 1},
+    "ratelimit": {"rate": 1.0, "burst": 10, "max_rate": 10.0, "limits": ""},
+}
+
+
+def test_account_config_overrides_smtp_and_ratelimit():
+    club = account_config(CONFIG, "club")
+    assert club["account"] == {"name": "Tester", "userid": "b01"}
+    assert club["smtp"]["connections"] == 3
+    assert club["ratelimit"]["rate"] == 20.0
+    # max_rate never caps the rate the account was given
+    assert club["ratelimit"]["max_rate"] == 20.0
+
+    officer = account_config(CONFIG, "officer")
+    assert officer["account"]["userid"] == "b02"
+    assert officer["smtp"]["connections"] == 1
+    assert officer["ratelimit"]["limits"] == "10/10"
+    # the shared sections are left alone
+    assert CONFIG["smtp"]["connections"] == 1
+    assert CONFIG["ratelimit"]["max_rate"] == 10.0
+
+
+def sharded_mailer(**accounts):
+    """a ShardedMailer with only the rate limiters of its accounts"""
+    mailer = ShardedMailer.__new__(ShardedMailer)
+    mailer.mailers = {
+        account_id: SimpleNamespace(
+            rate_limiter=RateLimiter(
+                account_id,
+                rate=rate,
+                max_rate=rate,
+                limits=parse_limits(limits),
+                state_path=None,
+            )
+        )
+        for account_id, (rate, limits) in accounts.items()
+    }
+    return mailer
+
+
+def test_rows_are_shared_in_proportion_to_the_rates(make_letter):
+    letter = make_letter(recipients=40)
+    # a fixed limit counts, not only the adaptive rate
+    mailer = sharded_mailer(a=(3.0, ""), b=(10.0, "1/1"))
+
+    shards = mailer.shard(letter)
+
+    assert {account_id: len(shard) for account_id, shard in shards.items()} == {
+        "a": 30,
+        "b": 10,
+    }
+    rows = {account_id: shard.pending_rows for account_id, shard in shards.items()}
+    # every row goes to one account
+    assert sorted(rows["a"] + rows["b"]) == list(range(40))
+    # spread over the whole letter, not the first rows to the fastest account
+    assert rows["b"][0] < 4 and rows["b"][-1] >= 36
+
+
+def test_shards_leave_out_skipped_rows_and_the_letter_alone(make_letter):
+    letter = make_letter(recipients=10)
+    letter.skip({0, 1})
+    mailer = sharded_mailer(a=(1.0, ""), b=(1.0, ""))
+
+    shards = mailer.shard(letter)
+
+    assert sorted(shards["a"].pending_rows + shards["b"].pending_rows) == list(
+        range(2, 10)
+    )
+    assert len(shards["a"]) == len(shards["b"]) == 4
+    assert letter.pending_rows == list(range(2, 10))
+    # each shard sends from its own account
+    shards["a"].set_from_addr("b01@ntu.edu.tw")
+    shards["b"].set_from_addr("b02@ntu.edu.tw")
+    assert {email.from_addr for email in shards["a"]} == {"b01@ntu.edu.tw"}
+    assert {email.from_addr for email in shards["b"]} == {"b02@ntu.edu.tw"}
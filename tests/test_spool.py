@@ -0,0 +1,145 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from ntuee_mailer.Journal import SENT, SendJournal
+from ntuee_mailer.Recipients import load_recipients
+from ntuee_mailer.Spool import (
+    CANCELLED,
+    DONE,
+    FAILED,
+    QUEUED,
+    SENDING,
+    Spool,
+    SpoolWorker,
+)
+from ntuee_mailer.synthetic import generate_letter
+
+
+class StubMailer:
+    """delivers every email of the feed at once, in the order it is fed"""
+
+    userid = "b01"
+
+    def __init__(self, on_send=None):
+        self.config = {
+            "account": {"name": "Tester"},
+            "smtp": {"bulk_size": 100, "verp": False},
+        }
+        self.rate_limiter = SimpleNamespace(save=lambda: None)
+        self.on_send = on_send
+        self.sent = []
+
+    def set_sender(self, letter):
+        letter.set_from_addr("b01@ntu.edu.tw")
+
+    def refresh_pool(self):
+        pass
+
+    def send_outboxes(self, feed, progress):
+        for email, outbox in feed:
+            self.sent.append((outbox.letter.paths["content"].parent.name, email.row))
+            for row, address, _ in email.deliveries:
+                outbox.journal.record(row, address, SENT)
+            outbox.settle(1, 0)
+            if self.on_send is not None:
+                self.on_send(email, outbox)
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return Spool(tmp_path / "spool")
+
+
+def letter(tmp_path, name, recipients=3):
+    return generate_letter(tmp_path / name, recipients)
+
+
+def test_jobs_are_kept_on_disk_in_order(tmp_path, spool):
+    first = spool.add(letter(tmp_path, "a"), offline=True)
+    later = spool.add(letter(tmp_path, "b"), not_before=time.time() + 3600)
+
+    reopened = Spool(spool.path)
+    assert [job.id for job in reopened.jobs()] == [first.id, later.id]
+    assert [job.id for job in reopened.due()] == [first.id]
+    assert reopened.next_due_at() == 0
+    assert reopened.get(later.id).to_dict() == later.to_dict()
+
+    reopened.update(reopened.get(first.id), status=DONE)
+    assert [job.id for job in reopened.pending()] == [later.id]
+    assert reopened.next_due_at() == later.not_before
+
+    assert reopened.remove(first.id)
+    assert not reopened.remove(first.id)
+    assert reopened.get(first.id) is None
+
+
+def test_worker_interleaves_due_letters(tmp_path, spool):
+    a = spool.add(letter(tmp_path, "a", 3), offline=True)
+    b = spool.add(letter(tmp_path, "b", 2), offline=True)
+    later = spool.add(letter(tmp_path, "c"), not_before=time.time() + 3600)
+    statuses = set()
+    mailer = StubMailer(
+        on_send=lambda email, outbox: statuses.add(spool.get(a.id).status)
+    )
+
+    SpoolWorker(mailer, spool, poll=0).run(once=True)
+
+    assert mailer.sent == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2)]
+    # claimed while its emails are being sent
+    assert statuses == {SENDING}
+    assert (spool.get(a.id).status, spool.get(a.id).delivered) == (DONE, 3)
+    assert (spool.get(b.id).status, spool.get(b.id).delivered) == (DONE, 2)
+    assert spool.get(later.id).status == QUEUED
+    assert SendJournal.for_letter(tmp_path / "a").delivered_count == 3
+
+
+def test_cancelled_jobs_stop(tmp_path, spool):
+    cancelled = spool.add(letter(tmp_path, "a"), offline=True)
+    stopped = spool.add(letter(tmp_path, "b", 5), offline=True)
+    spool.update(spool.get(cancelled.id), status=CANCELLED)
+
+    def cancel(email, outbox):
+        # `ntuee-mailer queue --cancel` while the letter is being sent
+        if email.row == 1:
+            spool.update(spool.get(stopped.id), status=CANCELLED)
+
+    mailer = StubMailer(on_send=cancel)
+    SpoolWorker(mailer, spool, poll=0).run(once=True)
+
+    assert mailer.sent == [("b", 0), ("b", 1)]
+    assert spool.get(cancelled.id).delivered == 0
+    job = spool.get(stopped.id)
+    assert (job.status, job.delivered) == (CANCELLED, 2)
+
+
+def test_interrupted_jobs_resume(tmp_path, spool):
+    letter_path = letter(tmp_path, "a", 3)
+    job = spool.add(letter_path, offline=True)
+    spool.update(job, status=SENDING)
+    rows = load_recipients(letter_path / "recipients.csv", validate=False).rows
+    with SendJournal.for_letter(letter_path) as journal:
+        journal.record(0, rows[0]["email"], SENT)
+
+    mailer = StubMailer()
+    SpoolWorker(mailer, spool, poll=0).run(once=True)
+
+    assert mailer.sent == [("a", 1), ("a", 2)]
+    job = spool.get(job.id)
+    # the recipient delivered before the restart counts too
+    assert (job.status, job.delivered) == (DONE, 3)
+
+
+def test_invalid_letters_fail(tmp_path, spool):
+    missing = spool.add(tmp_path / "missing", offline=True)
+    personalized = spool.add(letter(tmp_path, "a"), bulk=True, offline=True)
+
+    mailer = StubMailer()
+    SpoolWorker(mailer, spool, poll=0).run(once=True)
+
+    assert mailer.sent == []
+    assert spool.get(missing.id).status == FAILED
+    assert "not a valid letter" in spool.get(missing.id).error
+    assert spool.get(personalized.id).status == FAILED
+    assert "personalized" in spool.get(personalized.id).error
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from ntuee_mailer.Recipients import load_recipients
+from ntuee_mailer.Suppressions import REASON_BOUNCED, REASON_MANUAL, SuppressionList
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "suppressions"
+
+
+def test_add_and_lookup(path):
+    with SuppressionList(path, flag="c") as suppressions:
+        suppressions.add(" Amy@Example.com ", REASON_BOUNCED, "5.1.1", "letter")
+        suppressions.add("bob@example.com", REASON_MANUAL)
+
+    with SuppressionList(path) as suppressions:
+        entry = suppressions.get("amy@example.com")
+        assert (entry["reason"], entry["detail"], entry["source"]) == (
+            REASON_BOUNCED,
+            "5.1.1",
+            "letter",
+        )
+        assert "AMY@example.com" in suppressions
+        assert "cy@example.com" not in suppressions
+        assert list(suppressions) == ["amy@example.com", "bob@example.com"]
+        assert len(suppressions) == 2
+
+
+def test_remove(path):
+    with SuppressionList(path, flag="c") as suppressions:
+        suppressions.add("amy@example.com", REASON_MANUAL)
+        assert suppressions.remove("Amy@example.com")
+        assert not suppressions.remove("amy@example.com")
+        assert "amy@example.com" not in suppressions
+
+
+def test_nothing_suppressed_yet(path):
+    with SuppressionList(path) as suppressions:
+        assert "amy@example.com" not in suppressions
+        assert len(suppressions) == 0
+        assert list(suppressions) == []
+
+
+def test_bounced_addresses_expire(path, monkeypatch):
+    with SuppressionList(path, flag="c") as suppressions:
+        suppressions.add("amy@example.com", REASON_BOUNCED)
+        suppressions.add("bob@example.com", REASON_MANUAL)
+
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+
+    with SuppressionList(path, bounced_ttl=300) as suppressions:
+        assert "amy@example.com" in suppressions
+    with SuppressionList(path, bounced_ttl=60) as suppressions:
+        assert "amy@example.com" not in suppressions
+        # only bounces expire
+        assert "bob@example.com" in suppressions
+        assert list(suppressions) == ["bob@example.com"]
+        assert len(suppressions) == 1
+
+    # bouncing again suppresses it again
+    with SuppressionList(path, flag="c", bounced_ttl=60) as suppressions:
+        suppressions.add("amy@example.com", REASON_BOUNCED)
+        assert "amy@example.com" in suppressions
+
+
+def test_suppressed_rows_are_listed_while_loading(path, tmp_path):
+    csv_path = tmp_path / "recipients.csv"
+    csv_path.write_text(
+        "name,email\namy,AMY@example.com\nbob,bob@example.com\ncy,b01\n",
+        encoding="utf-8",
+    )
+    with SuppressionList(path, flag="c") as suppressions:
+        suppressions.add("amy@example.com", REASON_BOUNCED, "5.1.1")
+        suppressions.add("b01@ntu.edu.tw", REASON_MANUAL)
+
+        recipients = load_recipients(csv_path, offline=True, suppressions=suppressions)
+
+    assert recipients.is_valid
+    assert {row: entry["reason"] for row, entry in recipients.suppressed.items()} == {
+        0: REASON_BOUNCED,
+        2: REASON_MANUAL,
+    }
@@ -0,0 +1,23 @@
+import pytest
+
+from ntuee_mailer.utils import percentile
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [(0, 1), (10, 1), (30, 3), (50, 5), (55, 6), (90, 9), (95, 10), (100, 10)],
+)
+def test_percentile_nearest_rank(q, expected):
+    assert percentile(list(range(10, 0, -1)), q) == expected
+
+
+def test_percentile_exact_ranks():
+    # 7 / 100 * 100 is not exactly 7 in floating point
+    assert percentile(list(range(1, 101)), 7) == 7
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_percentile_single_and_empty():
+    assert percentile([4.2], 50) == 4.2
+    assert percentile([4.2], 99) == 4.2
+    assert percentile([], 50) == 0.0